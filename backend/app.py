@@ -1,32 +1,95 @@
 import os
+import click
 from datetime import timedelta, datetime
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, abort, make_response, Response
+from werkzeug.security import safe_join
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, JWTManager
 from sqlalchemy.orm import joinedload, selectinload 
 from sqlalchemy import or_, and_
 from dotenv import load_dotenv
 from flask_cors import CORS
-import uuid
 
 from models import (
     db, Usuario, Produto, Imagem, Categoria, Mensagem,
-    Solicitacao, Transacao, EnderecoUsuario,
-    StatusSolicitacao, StatusProduto, TipoDeInterese, tabela_produto_categoria,
-    SolicitacaoProdutoOfertado
+    Solicitacao, EnderecoUsuario,
+    StatusSolicitacao, StatusProduto, tabela_produto_categoria,
+    SolicitacaoProdutoOfertado, ProdutoLocalidade, SolicitacaoArquivada
 )
+from busca import normalizar_texto, indexar_produto, remover_do_indice, reindexar_todos, consulta_busca, aplicar_cursor_ranking
+from paginacao import (
+    CursorInvalido, obter_limite, obter_id, aplicar_keyset_desc, paginar,
+    codificar_cursor_ranking, decodificar_cursor_ranking
+)
+from localidade import (
+    NIVEIS, NIVEL_MAXIMO_POR_PARAMETRO, localidade_do_usuario, paginar_por_proximidade,
+    indexar_localidade_produtos, remover_localidade, reindexar_localidades
+)
+from versoes import com_etag
+from metricas import Metricas, orcamento_consultas
+from serializacao import ProvedorJSONRapido
+from compressao import Compressao
+from banco import configurar_banco
+from replicas import ler_da_replica, registrar_escritas, CABECALHO_ULTIMA_ESCRITA
+from imagens import ProcessadorImagens
+from chat_eventos import CentralMensagens, criar_token_stream, ler_token_stream
+from senhas import HasherSenhas, SenhasSobrecarregadas
+from negociacoes_leitura import negociacoes_do_usuario, negociacao_arquivada
+from campos import (
+    CamposInvalidos, ESQUEMA_PRODUTO, ESQUEMA_PRODUTO_DETALHE, ESQUEMA_MEUS_PRODUTOS, ESQUEMA_NEGOCIACAO,
+    selecao_da_requisicao, opcoes_produto, produto_para_dict
+)
+from mensagens import (
+    mensagens_por_ids, mensagens_apos, mensagens_antes, ultimas_mensagens,
+    LIMITE_PADRAO_MENSAGENS, LIMITE_MAXIMO_MENSAGENS
+)
+from armazenamento import (
+    receber_uploads, receber_uploads_da_requisicao, descartar, publicar, registrar_referencia,
+    liberar_referencia, remover_se_sem_referencia, limpar_arquivos_sem_referencia,
+    pasta_uploads, eh_imutavel
+)
+from solicitacoes import SolicitacaoInvalida, MAXIMO_SOLICITACOES_LOTE, preparar_solicitacoes, solicitacoes_detalhadas
+from estados_solicitacao import (
+    aprovar_solicitacao, recusar_solicitacao, cancelar_solicitacao_pendente, ativar_solicitacao, abrir_negociacao,
+    criar_pendentes
+)
+from importacao import importar_usuarios, importar_produtos
+from disponibilidade import recalcular_toda_disponibilidade
+from idempotencia import Idempotencia, idempotente, depois_do_commit, depois_do_rollback, limpar_respostas_expiradas
+from rascunhos import RascunhosNegociacao, rascunho_para_dict, limpar_solicitacoes_processando
+from arquivamento import arquivar_negociacoes
 
 # Configuracão
 load_dotenv(dotenv_path='./venv/.env')
-app = Flask(__name__, static_url_path='', static_folder='uploads')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Os uploads são servidos apenas pela rota /uploads (ver uploaded_file)
+app = Flask(__name__, static_folder=None)
+# Banco primário, opções do pool e réplicas de leitura (ver banco.py)
+configurar_banco(app)
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=24)
-CORS(app)
+# Envio dos uploads: 'flask' (padrão), 'x-accel' (nginx) ou 'x-sendfile' (Apache/lighttpd)
+app.config['UPLOADS_MODO_ENVIO'] = os.environ.get('UPLOADS_MODO_ENVIO', 'flask')
+# Location interna do nginx que aponta para a pasta uploads/ (modo x-accel)
+app.config['UPLOADS_X_ACCEL_PREFIXO'] = os.environ.get('UPLOADS_X_ACCEL_PREFIXO', '/uploads-internos/')
+app.config['USE_X_SENDFILE'] = app.config['UPLOADS_MODO_ENVIO'] == 'x-sendfile'
+# Negociações RECUSADAS/CANCELADAS paradas há mais dias que isso vão para o arquivo (flask arquivar-negociacoes)
+app.config['ARQUIVAMENTO_DIAS'] = int(os.environ.get('ARQUIVAMENTO_DIAS', 90))
+CORS(app, expose_headers=[CABECALHO_ULTIMA_ESCRITA])
+# Marca as respostas de escrita para o cliente ler do primário logo depois (ver replicas.py)
+registrar_escritas(app)
+app.json_provider_class = ProvedorJSONRapido
+app.json = ProvedorJSONRapido(app)
+metricas = Metricas(app)
+# Depois de Metricas, para que os bytes medidos sejam os comprimidos
+compressao = Compressao(app)
 
 db.init_app(app)
 jwt = JWTManager(app)
+processador_imagens = ProcessadorImagens(app)
+central_mensagens = CentralMensagens(app)
+hasher_senhas = HasherSenhas(app)
+idempotencia = Idempotencia(app)
+rascunhos = RascunhosNegociacao(app)
 
 def parse_date(date_string):
     if not date_string:
@@ -36,6 +99,16 @@ def parse_date(date_string):
     except ValueError:
         return None
 
+def obter_id_categoria(valor):
+    # Aceita o ID da categoria ou o nome (com ou sem acento)
+    if str(valor).isdigit():
+        return int(valor)
+    nome = normalizar_texto(valor)
+    for categoria in Categoria.query.all():
+        if normalizar_texto(categoria.nome_categoria) == nome:
+            return categoria.id_categoria
+    return None
+
 def get_current_user_id_from_token():
     current_user_id_str = get_jwt_identity()
     try:
@@ -74,7 +147,10 @@ def cadastro_usuario():
         cpf=data.get('cpf'),
         data_nascimento=data_nasc
     )
-    novo_usuario.set_password(data['senha'])
+    try:
+        novo_usuario.password_hash = hasher_senhas.gerar_hash(data['senha'])
+    except SenhasSobrecarregadas:
+        return jsonify({'msg': 'Servidor ocupado, tente novamente em instantes.'}), 503, {'Retry-After': '1'}
     
     try:
         db.session.add(novo_usuario)
@@ -111,7 +187,21 @@ def login_usuario():
 
     usuario = Usuario.query.filter_by(email=data['email']).first()
 
-    if usuario and usuario.check_password(data['senha']):
+    senha_correta, novo_hash = False, None
+    if usuario:
+        try:
+            senha_correta, novo_hash = hasher_senhas.verificar(usuario.password_hash, data['senha'])
+        except SenhasSobrecarregadas:
+            return jsonify({'msg': 'Servidor ocupado, tente novamente em instantes.'}), 503, {'Retry-After': '1'}
+    if senha_correta:
+        if novo_hash:
+            # O custo configurado mudou: grava o hash recalculado
+            try:
+                usuario.password_hash = novo_hash
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Erro ao atualizar hash da senha do usuário {usuario.id_usuario}: {e}")
         access_token = create_access_token(identity=str(usuario.id_usuario))
         return jsonify(
             access_token=access_token,
@@ -122,39 +212,156 @@ def login_usuario():
 
 
 # GET - Obter todos produtos (ativos)
+# Parâmetros opcionais: limite, cursor, categoria (id ou nome), status (NOVO/USADO), cidade (do proprietário),
+# perto (cep/cidade/estado/todos): ordena pela proximidade do endereço do usuário logado, até o nível pedido,
+# e fields/expand (ver campos.py)
 @app.route('/produtos', methods=['GET'])
+@orcamento_consultas(13)
 @jwt_required()
+@ler_da_replica
+@com_etag('PRODUTO', 'IMAGEM', 'CATEGORIA', 'USUARIO', 'ENDERECO_USUARIO', 'PRODUTO_LOCALIDADE')
 def obter_todos_produtos_ativos():
     current_user_id = get_current_user_id_from_token()
 
-    # Subconsulta para IDs de produtos desejados em solicitações PENDENTES ou APROVADAS
-    sq_desejados = db.select(Solicitacao.id_produto_desejado.distinct().label("produto_id"))\
-        .where(Solicitacao.status.in_([StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]))\
-        .where(Solicitacao.id_produto_desejado.isnot(None))
+    try:
+        limite = obter_limite(request.args.get('limite'))
+        selecao = selecao_da_requisicao(ESQUEMA_PRODUTO)
+    except (CursorInvalido, CamposInvalidos) as e:
+        return jsonify({'msg': str(e)}), 400
 
-    # Subconsulta para IDs de produtos ofertados em solicitações PENDENTES ou APROVADAS (tabela de relacionamento)
-    sq_ofertados = db.select(SolicitacaoProdutoOfertado.id_produto.distinct().label("produto_id"))\
-        .join(Solicitacao, SolicitacaoProdutoOfertado.id_solicitacao == Solicitacao.id_solicitacao)\
-        .where(Solicitacao.status.in_([StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]))
+    # Filtra produtos que não são do usuário logado e não estão em negociação
+    # (Produto.disponivel é mantido a cada mudança de status das solicitações)
+    query = Produto.query.filter(
+        Produto.disponivel.is_(True),
+        Produto.id_usuario != current_user_id
+    )
 
-    ids_desejados_result = db.session.execute(sq_desejados).scalars().all()
-    ids_ofertados_result = db.session.execute(sq_ofertados).scalars().all()
-    todos_ids_produtos_em_negociacao = list(set(ids_desejados_result + ids_ofertados_result))
+    # Filtros aplicados no banco (antes eram feitos no frontend)
+    categoria = request.args.get('categoria')
+    if categoria:
+        id_categoria = obter_id_categoria(categoria)
+        if id_categoria is None:
+            return jsonify({'msg': f"Categoria '{categoria}' não encontrada"}), 400
+        query = query.filter(Produto.id_categoria == id_categoria)
 
-    # Filtra produtos que não são do usuário logado e não estão em negociação
-    query = Produto.query.filter(Produto.id_usuario != current_user_id)
-    if todos_ids_produtos_em_negociacao:
-        query = query.filter(Produto.id_produto.notin_(todos_ids_produtos_em_negociacao))
-    produtos_ativos = query.all()
+    status = request.args.get('status')
+    if status:
+        try:
+            query = query.filter(Produto.status == StatusProduto[status.upper()])
+        except KeyError:
+            return jsonify({'msg': "Valor inválido para 'status'. Use NOVO ou USADO."}), 400
+
+    # Cidade e proximidade usam o índice de localidade (endereço principal do proprietário)
+    cidade = request.args.get('cidade')
+    perto = request.args.get('perto')
+    if cidade or perto:
+        query = query.join(ProdutoLocalidade, ProdutoLocalidade.id_produto == Produto.id_produto)
+    if cidade:
+        query = query.filter(ProdutoLocalidade.cidade == normalizar_texto(cidade))
+
+    opcoes = opcoes_produto(selecao)
+
+    if perto:
+        nivel_maximo = NIVEL_MAXIMO_POR_PARAMETRO.get(perto.strip().lower())
+        if nivel_maximo is None:
+            return jsonify({'msg': "Valor inválido para 'perto'. Use cep, cidade, estado ou todos."}), 400
+        localidade = localidade_do_usuario(current_user_id)
+        if localidade is None:
+            return jsonify({'msg': 'Cadastre um endereço para ver os produtos perto de você'}), 400
+        try:
+            pagina, proximo_cursor = paginar_por_proximidade(
+                query, localidade, nivel_maximo, limite, request.args.get('cursor')
+            )
+        except CursorInvalido as e:
+            return jsonify({'msg': str(e)}), 400
+
+        produtos_por_id = {}
+        if pagina:
+            produtos_por_id = {
+                p.id_produto: p for p in
+                Produto.query.filter(Produto.id_produto.in_([id_produto for _, id_produto in pagina])).options(*opcoes)
+            }
+        produtos = []
+        for nivel, id_produto in pagina:
+            produto_dict = produto_para_dict(produtos_por_id[id_produto], selecao)
+            produto_dict['proximidade'] = NIVEIS[nivel]
+            produtos.append(produto_dict)
+        return jsonify({'produtos': produtos, 'next_cursor': proximo_cursor}), 200
+
+    query = query.options(*opcoes)
+    try:
+        query = aplicar_keyset_desc(query, Produto.data_cadastro, Produto.id_produto, request.args.get('cursor'))
+    except CursorInvalido as e:
+        return jsonify({'msg': str(e)}), 400
+
+    produtos_ativos, proximo_cursor = paginar(query, limite, lambda p: (p.data_cadastro, p.id_produto))
+
+    return jsonify({
+        'produtos': [produto_para_dict(produto, selecao) for produto in produtos_ativos],
+        'next_cursor': proximo_cursor
+    }), 200
+
+# GET - Buscar produtos por nome e descrição (sem diferenciar acentos)
+# Parâmetros: q (obrigatório), limite, cursor e categoria (id ou nome)
+@app.route('/produtos/busca', methods=['GET'])
+@orcamento_consultas(9)
+@jwt_required()
+@ler_da_replica
+def buscar_produtos():
+    current_user_id = get_current_user_id_from_token()
+
+    ranking = consulta_busca(request.args.get('q', ''))
+    if ranking is None:
+        return jsonify({'msg': "Parâmetro 'q' deve conter ao menos um termo com 2 ou mais letras"}), 400
+
+    try:
+        limite = obter_limite(request.args.get('limite'))
+        posicao = decodificar_cursor_ranking(request.args.get('cursor'))
+    except CursorInvalido as e:
+        return jsonify({'msg': str(e)}), 400
+
+    query = db.session.query(Produto, ranking.c.pontos)\
+        .join(ranking, Produto.id_produto == ranking.c.id_produto)\
+        .filter(Produto.disponivel.is_(True), Produto.id_usuario != current_user_id)
+
+    categoria = request.args.get('categoria')
+    if categoria:
+        id_categoria = obter_id_categoria(categoria)
+        if id_categoria is None:
+            return jsonify({'msg': f"Categoria '{categoria}' não encontrada"}), 400
+        query = query.filter(Produto.id_categoria == id_categoria)
+
+    query = query.options(
+        joinedload(Produto.proprietario),
+        selectinload(Produto.categoria)
+    )
+    query = aplicar_cursor_ranking(query, ranking.c.pontos, posicao)
+
+    resultados, proximo_cursor = paginar(
+        query, limite,
+        lambda linha: (linha.pontos, linha.Produto.id_produto),
+        codificar=codificar_cursor_ranking
+    )
+
+    produtos = []
+    for produto, pontos in resultados:
+        produto_dict = produto.to_dict(include_owner=True)
+        produto_dict['relevancia'] = int(pontos)
+        produtos.append(produto_dict)
 
-    return jsonify([produto.to_dict(include_owner=True) for produto in produtos_ativos]), 200
+    return jsonify({'produtos': produtos, 'next_cursor': proximo_cursor}), 200
 
 # GET - Obter todos produtos vinculados ao ID do usuário (logado)
+# Parâmetros opcionais: fields/expand (ver campos.py)
 @app.route('/produtos/usuario', methods=['GET'])
+@orcamento_consultas(13)
 @jwt_required()
+@ler_da_replica
+@com_etag('PRODUTO', 'IMAGEM', 'CATEGORIA', 'USUARIO', 'SOLICITACAO', 'SOLICITACAO_PRODUTO_OFERTADO')
 def obter_meus_produtos_gerenciaveis(): # Nome pode ser mais descritivo
     try:
         current_user_id = get_current_user_id_from_token()
+        selecao = selecao_da_requisicao(ESQUEMA_MEUS_PRODUTOS)
     except ValueError as e:
         return jsonify({'msg': str(e)}), 400
 
@@ -177,104 +384,97 @@ def obter_meus_produtos_gerenciaveis(): # Nome pode ser mais descritivo
 
     ids_produtos_ja_transacionados = ids_desejados_aprovados.union(ids_ofertados_aprovados)
 
+    # Eager loading só dos relacionamentos pedidos em expand
+    opcoes = opcoes_produto(selecao)
+    if selecao.expande('solicitacoes_pendentes_nele'):
+        # Para pegar solicitações pendentes (o to_dict delas lista os ofertados e o solicitante)
+        opcoes.append(selectinload(Produto.solicitacoes_para_este_produto).options(
+            selectinload(Solicitacao.produtos_ofertados),
+            selectinload(Solicitacao.usuario_solicitante_obj)
+        ))
+
     # Buscar produtos do usuário que NÃO estão na lista de transacionados
     query_produtos_gerenciaveis = Produto.query.filter(
         Produto.id_usuario == current_user_id,
         Produto.id_produto.notin_(ids_produtos_ja_transacionados)
-    ).options( # Eager loading para performance
-        selectinload(Produto.imagens),
-        selectinload(Produto.categoria),
-        selectinload(Produto.solicitacoes_para_este_produto) # Para pegar solicitações pendentes
-    )
+    ).options(*opcoes)
     
     produtos_gerenciaveis = query_produtos_gerenciaveis.all()
 
     resultado_final = []
     for produto in produtos_gerenciaveis:
-        produto_dict = produto.to_dict(include_owner=True, include_imagens=True, include_categoria=True)
+        produto_dict = produto_para_dict(produto, selecao)
         
         # Adicionar informações sobre solicitações PENDENTES para este produto
         # (onde ele é o produto desejado)
-        solicitacoes_pendentes = [
-            s.to_dict() for s in produto.solicitacoes_para_este_produto 
-            if s.status == StatusSolicitacao.PENDENTE
-        ]
-        produto_dict['solicitacoes_pendentes_nele'] = solicitacoes_pendentes
+        if selecao.expande('solicitacoes_pendentes_nele'):
+            produto_dict['solicitacoes_pendentes_nele'] = [
+                s.to_dict() for s in produto.solicitacoes_para_este_produto 
+                if s.status == StatusSolicitacao.PENDENTE
+            ]
         resultado_final.append(produto_dict)
         
     return jsonify(resultado_final), 200
 
 # GET - Obter todas as negociacoes vinculadas ao ID do usuário (logado)
+# Parâmetros opcionais: fields/expand (ver campos.py)
 @app.route('/usuario/negociacoes', methods=['GET'])
+@orcamento_consultas(7)
 @jwt_required()
+@ler_da_replica
+@com_etag('SOLICITACAO', 'SOLICITACAO_PRODUTO_OFERTADO', 'PRODUTO', 'IMAGEM', 'CATEGORIA', 'USUARIO',
+          'SOLICITACAO_ARQUIVO', 'SOLICITACAO_PRODUTO_OFERTADO_ARQUIVO')
 def obter_minhas_negociacoes():
     try:
         current_user_id = get_current_user_id_from_token()
+        selecao = selecao_da_requisicao(ESQUEMA_NEGOCIACAO)
     except ValueError as e:
         return jsonify({'msg': str(e)}), 400
 
-    # Usamos db.or_ para combinar as duas condições
-    negociacoes_query = Solicitacao.query.join(
-        Produto, Solicitacao.id_produto_desejado == Produto.id_produto
-    ).filter(
-        db.or_( # Lembre de importar or_ de sqlalchemy ou usar db.or_
-            Solicitacao.id_usuario_solicitante == current_user_id, # Ele é o solicitante
-            Produto.id_usuario == current_user_id                  # Ele é o dono do produto desejado
-        )
-    ).options(
-        # Eager loading para carregar todos os dados relacionados eficientemente
-        selectinload(Solicitacao.usuario_solicitante_obj),
-        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.proprietario),
-        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.imagens),
-        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.categoria),
-        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.imagens),
-        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.proprietario), # Se precisar do dono dos produtos ofertados
-        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.categoria)  # E categoria dos ofertados
-    ).order_by(Solicitacao.data_solicitacao.desc())
-    
-    negociacoes = negociacoes_query.all()
-    
-    # O método to_dict da Solicitacao já deve incluir 'include_produtos_details=True'
-    # para trazer os detalhes dos produtos envolvidos.
-    # Certifique-se que Solicitacao.to_dict() e Produto.to_dict() carregam
-    # as informações do proprietário do produto e do solicitante.
-    resultado = [s.to_dict(include_produtos_details=True) for s in negociacoes]
-    
+    # Consulta projetada: só as colunas usadas, sem montar objetos ORM
+    resultado = negociacoes_do_usuario(current_user_id, selecao)
+
     return jsonify(resultado), 200
 
 # GET - Obter produto pelo ID
+# Parâmetros opcionais: fields/expand (ver campos.py)
 @app.route('/produto/<int:id_produto>', methods=['GET'])
+@orcamento_consultas(7)
 @jwt_required()
+@ler_da_replica
+@com_etag('PRODUTO', 'IMAGEM', 'CATEGORIA', 'USUARIO', 'SOLICITACAO')
 def obter_produto(id_produto):
     current_user_id = get_current_user_id_from_token()
+    try:
+        selecao = selecao_da_requisicao(ESQUEMA_PRODUTO_DETALHE)
+    except CamposInvalidos as e:
+        return jsonify({'msg': str(e)}), 400
 
-    stmt = db.select(Produto).options(
-        joinedload(Produto.proprietario),
-        selectinload(Produto.imagens),
-        selectinload(Produto.categoria)
-    ).where(Produto.id_produto == id_produto)
+    stmt = db.select(Produto).options(*opcoes_produto(selecao)).where(Produto.id_produto == id_produto)
     produto = db.session.execute(stmt).scalar_one_or_none()
     
     if not produto:
         return jsonify({'msg': 'Produto não encontrado'}), 404
 
-    produto_dict = produto.to_dict(include_owner=True, include_categoria=True, include_imagens=True)
+    produto_dict = produto_para_dict(produto, selecao)
 
     # Busca a solicitação do usuário logado para este produto (se houver)
-    solicitacao = Solicitacao.query.filter_by(
-        id_usuario_solicitante=current_user_id,
-        id_produto_desejado=id_produto
-    ).order_by(Solicitacao.id_solicitacao.desc()).first()
-    if solicitacao:
-        produto_dict['status_solicitacao'] = solicitacao.status.value
-    else:
-        produto_dict['status_solicitacao'] = None
+    if selecao.inclui('status_solicitacao'):
+        solicitacao = Solicitacao.query.filter_by(
+            id_usuario_solicitante=current_user_id,
+            id_produto_desejado=id_produto
+        ).order_by(Solicitacao.id_solicitacao.desc()).first()
+        if solicitacao:
+            produto_dict['status_solicitacao'] = solicitacao.status.value
+        else:
+            produto_dict['status_solicitacao'] = None
 
     return jsonify(produto_dict), 200
 
 # POST - Criar produto
 @app.route('/produto', methods=['POST'])
 @jwt_required()
+@idempotente
 def criar_produto():
     try:
         current_user_id = get_current_user_id_from_token()
@@ -296,6 +496,10 @@ def criar_produto():
     except KeyError:
         return jsonify({'msg': f"Valor inválido para 'status'. Use NOVO ou USADO."}), 400
 
+    # Grava os uploads em disco (calculando o hash) antes de abrir a transação;
+    # com Idempotency-Key, @idempotente já os recebeu antes de reservar a chave
+    recebidos = receber_uploads_da_requisicao('images')
+
     novo_produto = Produto(
         nome_produto=nome_produto,
         descricao=descricao,
@@ -305,31 +509,37 @@ def criar_produto():
         status=status_produto
     )
     db.session.add(novo_produto)
-    db.session.flush()  # Para garantir o ID do produto
 
     # Salvar imagens
-    imagens = request.files.getlist('images')
-    upload_folder = os.path.join(os.getcwd(), 'uploads')
-    os.makedirs(upload_folder, exist_ok=True)
-    for img in imagens:
-        if img and img.filename:
-            ext = os.path.splitext(img.filename)[1]
-            filename = f"{uuid.uuid4().hex}{ext}"
-            filepath = os.path.join(upload_folder, filename)
-            img.save(filepath)
-            nova_imagem = Imagem(
-                url_imagem=f'uploads/{filename}',
-                produto=novo_produto
-            )
-            db.session.add(nova_imagem)
+    novas_imagens = []
+    for recebido in recebidos:
+        nova_imagem = Imagem(
+            url_imagem=recebido.url,
+            produto=novo_produto
+        )
+        db.session.add(nova_imagem)
+        novas_imagens.append(nova_imagem)
 
     try:
+        for recebido in recebidos:
+            registrar_referencia(recebido)
+        db.session.flush()  # Para garantir o ID do produto
+        indexar_produto(novo_produto)
+        indexar_localidade_produtos([novo_produto.id_produto])
+        # Arquivos no lugar antes do commit (ver armazenamento.py)
+        publicar(recebidos)
+        # Com @idempotente o commit abaixo é adiado; se o real falhar, o except não roda
+        depois_do_rollback(lambda: descartar(recebidos))
         db.session.commit()
     except Exception as e:
         db.session.rollback()
+        descartar(recebidos)
         app.logger.error(f"Erro ao criar produto: {e}")
         return jsonify({'msg': 'Erro ao salvar produto no banco de dados.'}), 500
 
+    # Miniaturas e versões WebP são geradas em segundo plano
+    depois_do_commit(lambda: processador_imagens.agendar(novas_imagens))
+
     return jsonify(novo_produto.to_dict(include_owner=True)), 201
 
 
@@ -342,12 +552,6 @@ def alterar_produto(id_produto):
     except ValueError as e:
         return jsonify({'msg': str(e)}), 400
 
-    produto = Produto.query.get(id_produto)
-    if not produto:
-        return jsonify({'msg': 'Produto não encontrado'}), 404
-    if produto.id_usuario != current_user_id:
-        return jsonify({'msg': 'Acesso não autorizado para alterar este produto'}), 403
-
     # Suporte a JSON ou multipart/form-data
     if request.content_type and request.content_type.startswith('multipart/form-data'):
         nome_produto = request.form.get('nome_produto')
@@ -367,6 +571,22 @@ def alterar_produto(id_produto):
         status = data.get('status')
         imagens = []
 
+    try:
+        status_produto = StatusProduto[status.upper()] if status else None
+    except KeyError:
+        return jsonify({'msg': "Valor inválido para 'status'. Use NOVO ou USADO."}), 400
+
+    # Grava os uploads em disco antes de qualquer acesso ao banco
+    recebidos = receber_uploads(imagens)
+
+    produto = Produto.query.get(id_produto)
+    if not produto:
+        descartar(recebidos)
+        return jsonify({'msg': 'Produto não encontrado'}), 404
+    if produto.id_usuario != current_user_id:
+        descartar(recebidos)
+        return jsonify({'msg': 'Acesso não autorizado para alterar este produto'}), 403
+
     if nome_produto:
         produto.nome_produto = nome_produto
     if descricao:
@@ -375,46 +595,44 @@ def alterar_produto(id_produto):
         produto.quantidade = quantidade
     if id_categoria:
         produto.id_categoria = id_categoria
-    if status:
-        try:
-            produto.status = StatusProduto[status.upper()]
-        except KeyError:
-            return jsonify({'msg': "Valor inválido para 'status'. Use NOVO ou USADO."}), 400
+    if status_produto:
+        produto.status = status_produto
 
     # Se vierem novas imagens, remove as antigas e salva as novas
-    if imagens and any(img.filename for img in imagens):
-        # Remove imagens antigas do banco e do disco
-        for img in produto.imagens:
-            img_path = os.path.join(os.getcwd(), img.url_imagem)
-            if os.path.exists(img_path):
-                try:
-                    os.remove(img_path)
-                except Exception as e:
-                    app.logger.error(f"Erro ao remover arquivo {img_path}: {e}")
-            db.session.delete(img)
-        db.session.flush()
-        # Salva novas imagens
-        upload_folder = os.path.join(os.getcwd(), 'uploads')
-        os.makedirs(upload_folder, exist_ok=True)
-        for img in imagens:
-            if img and img.filename:
-                ext = os.path.splitext(img.filename)[1]
-                filename = f"{uuid.uuid4().hex}{ext}"
-                filepath = os.path.join(upload_folder, filename)
-                img.save(filepath)
+    novas_imagens = []
+    urls_liberadas = []
+    try:
+        if recebidos:
+            # Remove imagens antigas do banco; os arquivos só saem do disco
+            # depois do commit, se nenhuma outra imagem usar o mesmo conteúdo
+            for img in produto.imagens:
+                liberar_referencia(img.url_imagem)
+                urls_liberadas.append(img.url_imagem)
+                db.session.delete(img)
+            db.session.flush()
+            # Salva novas imagens
+            for recebido in recebidos:
                 nova_imagem = Imagem(
-                    url_imagem=f'uploads/{filename}',
+                    url_imagem=recebido.url,
                     produto=produto
                 )
                 db.session.add(nova_imagem)
+                novas_imagens.append(nova_imagem)
+                registrar_referencia(recebido)
 
-    try:
+        if nome_produto or descricao:
+            indexar_produto(produto)
+        publicar(recebidos)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
+        descartar(recebidos)
         app.logger.error(f"Erro ao alterar produto {id_produto}: {e}")
         return jsonify({'msg': 'Erro ao atualizar produto no banco de dados.'}), 500
 
+    remover_se_sem_referencia(urls_liberadas, app.logger)
+    processador_imagens.agendar(novas_imagens)
+
     return jsonify(produto.to_dict(include_owner=True, include_categoria=True, include_imagens=True)), 200
 
 # DELETE - Deletar produto
@@ -447,28 +665,30 @@ def deletar_produto(id_produto):
     if solicitacao_como_desejado_ativa or solicitacao_como_ofertado_ativa:
         return jsonify({'msg': 'Produto não pode ser deletado pois está envolvido em negociações ativas.'}), 409
 
-    # Remove imagens do diretório físico
-    for img in produto.imagens:
-        img_path = os.path.join(os.getcwd(), img.url_imagem)
-        if os.path.exists(img_path):
-            try:
-                os.remove(img_path)
-            except Exception as e:
-                app.logger.error(f"Erro ao remover arquivo {img_path}: {e}")
+    # Libera os arquivos das imagens; saem do disco após o commit se não forem mais usados
+    urls_liberadas = [img.url_imagem for img in produto.imagens]
 
     try:
+        for url in urls_liberadas:
+            liberar_referencia(url)
+        remover_do_indice(id_produto)
+        remover_localidade(id_produto)
         db.session.delete(produto)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao deletar produto {id_produto}: {e}")
         return jsonify({'msg': 'Erro ao deletar produto no banco de dados.'}), 500
+
+    remover_se_sem_referencia(urls_liberadas, app.logger)
         
     return jsonify({'msg': 'Produto deletado com sucesso'}), 200
 
 # POST - Enviar mensagem
 @app.route('/mensagem', methods=['POST'])
+@orcamento_consultas(16)
 @jwt_required()
+@idempotente
 def enviar_mensagem():
     try:
         current_user_id = get_current_user_id_from_token()
@@ -479,10 +699,22 @@ def enviar_mensagem():
     if not data:
         return jsonify({'msg': 'Payload da requisição não pode ser vazio'}), 400
 
-    if not all(k in data for k in ('conteudo_mensagem', 'id_solicitacao')):
-        return jsonify({'msg': 'conteudo_mensagem e id_solicitacao são obrigatórios'}), 400
+    # Sem id_solicitacao, id_produto_desejado indica a primeira mensagem de um rascunho
+    if 'conteudo_mensagem' not in data or not ('id_solicitacao' in data or 'id_produto_desejado' in data):
+        return jsonify({'msg': 'conteudo_mensagem e id_solicitacao (ou id_produto_desejado) são obrigatórios'}), 400
 
-    solicitacao = Solicitacao.query.get(data['id_solicitacao'])
+    if 'id_solicitacao' in data:
+        solicitacao = Solicitacao.query.get(data['id_solicitacao'])
+    else:
+        try:
+            id_produto = int(data['id_produto_desejado'])
+        except (TypeError, ValueError):
+            return jsonify({'msg': 'ID do produto desejado inválido.'}), 400
+        try:
+            solicitacao = abrir_negociacao(current_user_id, id_produto)
+        except SolicitacaoInvalida as e:
+            db.session.rollback()
+            return jsonify({'msg': str(e)}), e.status
     if not solicitacao:
         return jsonify({'msg': 'Solicitação não encontrada'}), 404
 
@@ -498,9 +730,11 @@ def enviar_mensagem():
     if solicitacao.status not in [StatusSolicitacao.PENDENTE, StatusSolicitacao.PROCESSANDO]:
         return jsonify({'msg': f'Não é possível enviar mensagens em uma negociação com status "{solicitacao.status.value}". Apenas negociações PROCESSANDO ou PENDENTE aceitam novas mensagens.'}), 403
 
+    id_solicitacao = solicitacao.id_solicitacao
+    id_produto = produto_desejado.id_produto
     nova_mensagem = Mensagem(
         conteudo_mensagem=data['conteudo_mensagem'],
-        id_solicitacao=data['id_solicitacao'],
+        id_solicitacao=id_solicitacao,
         id_usuario=current_user_id
     )
     try:
@@ -508,14 +742,147 @@ def enviar_mensagem():
         db.session.commit()
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Erro ao enviar mensagem para solicitação {data['id_solicitacao']}: {e}")
+        app.logger.error(f"Erro ao enviar mensagem para solicitação {id_solicitacao}: {e}")
         return jsonify({'msg': 'Erro ao salvar mensagem no banco de dados.'}), 500
+
+    rascunhos.descartar(current_user_id, id_produto)
+    # Entrega imediata para quem está com o chat aberto neste processo
+    depois_do_commit(central_mensagens.notificar)
         
-    return jsonify(nova_mensagem.to_dict()), 201
+    # Lê de volta só as colunas da resposta (a mensagem expirou com o commit)
+    resposta = mensagens_por_ids([nova_mensagem.id_mensagem])[0]
+    resposta['id_solicitacao'] = id_solicitacao  # Para o rascunho passar a usar a solicitação gravada
+    return jsonify(resposta), 201
+
+# GET - Histórico de mensagens de uma negociação, em páginas
+# ?after_id= traz as mais novas que o ID; ?before_id= as anteriores; sem nenhum, as últimas
+@app.route('/solicitacao/<int:id_solicitacao>/mensagens', methods=['GET'])
+@orcamento_consultas(6)
+@jwt_required()
+@ler_da_replica
+def obter_mensagens_solicitacao(id_solicitacao):
+    try:
+        current_user_id = get_current_user_id_from_token()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+
+    # Solicitante e dono do produto desejado; se não está nas tabelas principais, procura no arquivo
+    arquivada = False
+    participantes = db.session.execute(
+        db.select(Solicitacao.id_usuario_solicitante, Produto.id_usuario)
+        .outerjoin(Produto, Solicitacao.id_produto_desejado == Produto.id_produto)
+        .where(Solicitacao.id_solicitacao == id_solicitacao)
+    ).first()
+    if participantes is None:
+        arquivada = True
+        participantes = db.session.execute(
+            db.select(SolicitacaoArquivada.id_usuario_solicitante, Produto.id_usuario)
+            .outerjoin(Produto, SolicitacaoArquivada.id_produto_desejado == Produto.id_produto)
+            .where(SolicitacaoArquivada.id_solicitacao == id_solicitacao)
+        ).first()
+    if participantes is None:
+        return jsonify({'msg': 'Solicitação não encontrada'}), 404
+
+    id_solicitante, id_dono = participantes
+    if id_dono is None or current_user_id not in (id_solicitante, id_dono):
+        return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
+
+    try:
+        limite = obter_limite(request.args.get('limit'), LIMITE_PADRAO_MENSAGENS, LIMITE_MAXIMO_MENSAGENS, nome='limit')
+        after_id = obter_id(request.args.get('after_id'), 'after_id')
+        before_id = obter_id(request.args.get('before_id'), 'before_id')
+    except CursorInvalido as e:
+        return jsonify({'msg': str(e)}), 400
+    if after_id is not None and before_id is not None:
+        return jsonify({'msg': 'Use after_id ou before_id, não os dois'}), 400
+
+    if after_id is not None:
+        # Uma a mais para saber se ainda há mensagens depois desta página
+        mensagens = mensagens_apos(id_solicitacao, after_id, limite + 1, arquivada)
+        tem_mais = len(mensagens) > limite
+        mensagens = mensagens[:limite]
+    else:
+        mensagens, tem_mais = mensagens_antes(id_solicitacao, before_id, limite, arquivada)
+
+    return jsonify({'mensagens': mensagens, 'tem_mais': tem_mais}), 200
+
+# GET - Token para abrir o stream de eventos de uma negociação
+# O EventSource do navegador não envia cabeçalhos; em vez do JWT na URL (que
+# acabaria nos logs de acesso), o cliente pede aqui um token que só vale para
+# os eventos desta negociação e expira em CHAT_TOKEN_SEGUNDOS
+@app.route('/solicitacao/<int:id_solicitacao>/eventos/token', methods=['GET'])
+@orcamento_consultas(3)
+@jwt_required()
+def token_stream_mensagens(id_solicitacao):
+    try:
+        current_user_id = get_current_user_id_from_token()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+
+    participantes = db.session.execute(
+        db.select(Solicitacao.id_usuario_solicitante, Produto.id_usuario)
+        .outerjoin(Produto, Solicitacao.id_produto_desejado == Produto.id_produto)
+        .where(Solicitacao.id_solicitacao == id_solicitacao)
+    ).first()
+    if participantes is None:
+        return jsonify({'msg': 'Solicitação não encontrada'}), 404
+    id_solicitante, id_dono = participantes
+    if id_dono is None or current_user_id not in (id_solicitante, id_dono):
+        return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
+
+    resposta = jsonify({
+        'token': criar_token_stream(current_user_id, id_solicitacao),
+        'expira_em': app.config['CHAT_TOKEN_SEGUNDOS'],
+    })
+    resposta.headers['Cache-Control'] = 'no-store'
+    return resposta, 200
+
+# GET - Stream (Server-Sent Events) das novas mensagens de uma negociação
+# Autenticado pelo ?token= de /solicitacao/<id>/eventos/token, que já garante
+# que o usuário participa desta negociação
+@app.route('/solicitacao/<int:id_solicitacao>/eventos', methods=['GET'])
+def stream_mensagens(id_solicitacao):
+    if ler_token_stream(request.args.get('token', ''), id_solicitacao) is None:
+        return jsonify({'msg': 'Token do stream inválido ou expirado'}), 401
+
+    # Última mensagem que o cliente já tem: ?apos_id= (mensagens carregadas
+    # junto com a página ou recebidas pela conexão anterior) ou Last-Event-ID
+    apos_id = request.headers.get('Last-Event-ID') or request.args.get('apos_id')
+    try:
+        apos_id = int(apos_id) if apos_id else None
+    except ValueError:
+        return jsonify({'msg': 'Last-Event-ID/apos_id inválido'}), 400
+    if apos_id is None:
+        apos_id = db.session.execute(
+            db.select(db.func.max(Mensagem.id_mensagem)).where(Mensagem.id_solicitacao == id_solicitacao)
+        ).scalar() or 0
+
+    # Assina antes de ler o histórico: o que for gravado depois da leitura chega pela fila
+    fila = central_mensagens.assinar(id_solicitacao)
+    if fila is None:
+        return jsonify({'msg': 'Muitas conexões abertas. Tente novamente em instantes.'}), 503, {'Retry-After': '5'}
+    try:
+        pendentes = mensagens_apos(id_solicitacao, apos_id)
+    except Exception:
+        central_mensagens.cancelar(id_solicitacao, fila)
+        raise
+    # Devolve a conexão ao pool: o stream pode ficar aberto por minutos
+    db.session.remove()
+
+    resposta = Response(central_mensagens.stream(id_solicitacao, fila, pendentes, apos_id), mimetype='text/event-stream')
+    resposta.headers['Cache-Control'] = 'no-cache'
+    resposta.headers['X-Accel-Buffering'] = 'no'  # Evita que o nginx segure os eventos
+    return resposta
 
 # POST - Criar solicitação (negociação)
+# 18 consultas com Idempotency-Key: 4 da chave (consulta, reserva, trava e
+# resposta), 2 de validação (desejado e ofertados), 2 sob a trava (produtos e
+# solicitações ativas), 3 de gravação (solicitação, ofertados e disponibilidade),
+# 4 da resposta (solicitacoes_detalhadas) e 3 versões de tabela após o commit
 @app.route('/solicitacao', methods=['POST'])
+@orcamento_consultas(20)
 @jwt_required()
+@idempotente
 def criar_solicitacao():
     try:
         current_user_id = get_current_user_id_from_token()
@@ -529,82 +896,66 @@ def criar_solicitacao():
     if not all(k in data for k in ('id_produto_desejado', 'tipo_solicitacao')):
         return jsonify({'msg': 'id_produto_desejado e tipo_solicitacao são obrigatórios'}), 400
 
-    try: 
-        id_produto_desejado_int = int(data['id_produto_desejado'])
-    except ValueError:
-        return jsonify({'msg': 'ID do produto desejado inválido.'}), 400
-    produto_desejado = Produto.query.get(id_produto_desejado_int)
-
-    if not produto_desejado:
-        return jsonify({'msg': 'Produto desejado não encontrado'}), 404
-    
-    if produto_desejado.id_usuario == current_user_id:
-        return jsonify({'msg': 'Você não pode solicitar seu próprio produto'}), 400
-
-    solicitacao_existente = Solicitacao.query.filter(
-        Solicitacao.id_usuario_solicitante == current_user_id,
-        Solicitacao.id_produto_desejado == id_produto_desejado_int,
-        Solicitacao.status.in_([StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA])
-    ).first()
-    if solicitacao_existente:
-        return jsonify({'msg': 'Você já possui uma solicitação ativa para este produto.'}), 409
-
-    # Descobre o tipo da solicitação pela categoria do produto desejado
-    tipo_solicitacao = produto_desejado.categoria.nome_categoria.upper()
-
-    produtos_ofertados_ids = data.get('id_produto_ofertado', [])
-
-    print(f"Tipo de solicitação: {tipo_solicitacao}")
-    print(f"Produtos ofertados: {produtos_ofertados_ids}")
-
-    if tipo_solicitacao == 'TROCA':
-        # Aceita tanto int quanto lista
-        if not produtos_ofertados_ids:
-            return jsonify({'msg': 'id_produto_ofertado é obrigatório para solicitações de TROCA'}), 400
-        if isinstance(produtos_ofertados_ids, int):
-            produtos_ofertados_ids = [produtos_ofertados_ids]
-        if not isinstance(produtos_ofertados_ids, list):
-            return jsonify({'msg': 'id_produto_ofertado deve ser uma lista de IDs'}), 400
-        # Validação dos produtos ofertados
-        for id_produto in produtos_ofertados_ids:
-            produto_ofertado = Produto.query.get(id_produto)
-            if not produto_ofertado:
-                return jsonify({'msg': f'Produto ofertado {id_produto} não encontrado'}), 404
-            if produto_ofertado.id_usuario != current_user_id:
-                return jsonify({'msg': 'Você só pode ofertar seus próprios produtos'}), 403
-            if produto_ofertado.id_produto == produto_desejado.id_produto: 
-                return jsonify({'msg': 'Produto ofertado não pode ser o mesmo que o produto desejado'}),400
-    elif produtos_ofertados_ids:
-        return jsonify({'msg': 'id_produto_ofertado não deve ser enviado para solicitações de DOAÇÃO'}), 400
-
-    nova_solicitacao = Solicitacao(
-        id_usuario_solicitante=current_user_id,
-        id_produto_desejado=id_produto_desejado_int,
-        status=StatusSolicitacao.PENDENTE
-    )
     try:
-        db.session.add(nova_solicitacao)
-        db.session.flush()  # Garante o ID da solicitação
-
-        # Se for troca, salva os produtos ofertados na tabela de relacionamento
-        if tipo_solicitacao == TipoDeInterese.TROCA:
-            for id_produto in produtos_ofertados_ids:
-                rel = SolicitacaoProdutoOfertado(
-                    id_solicitacao=nova_solicitacao.id_solicitacao,
-                    id_produto=id_produto
-                )
-                db.session.add(rel)
+        itens = preparar_solicitacoes([data], current_user_id)
+    except SolicitacaoInvalida as e:
+        return jsonify({'msg': str(e)}), e.status
 
+    try:
+        nova_solicitacao = criar_pendentes(itens, current_user_id)[0]
         db.session.commit()
+    except SolicitacaoInvalida as e:
+        db.session.rollback()
+        return jsonify({'msg': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao criar solicitação: {e}")
         return jsonify({'msg': 'Erro ao criar solicitação no banco de dados.'}), 500
         
+    nova_solicitacao, = solicitacoes_detalhadas([nova_solicitacao.id_solicitacao])
     return jsonify(nova_solicitacao.to_dict(include_produtos_details=True)), 201
 
+# POST - Criar várias solicitações de uma vez (trocas com vários itens)
+@app.route('/solicitacoes', methods=['POST'])
+@orcamento_consultas(21)
+@jwt_required()
+@idempotente
+def criar_solicitacoes_lote():
+    try:
+        current_user_id = get_current_user_id_from_token()
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+
+    data = request.get_json()
+    itens = data.get('solicitacoes') if isinstance(data, dict) else None
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'msg': 'solicitacoes deve ser uma lista não vazia'}), 400
+    if len(itens) > MAXIMO_SOLICITACOES_LOTE:
+        return jsonify({'msg': f'Máximo de {MAXIMO_SOLICITACOES_LOTE} solicitações por requisição'}), 400
+
+    # Tudo ou nada: se algum item for inválido, nenhuma solicitação é criada
+    try:
+        itens = preparar_solicitacoes(itens, current_user_id)
+    except SolicitacaoInvalida as e:
+        return jsonify({'msg': str(e), 'indice': e.indice}), e.status
+
+    try:
+        novas = criar_pendentes(itens, current_user_id)
+        db.session.commit()
+    except SolicitacaoInvalida as e:
+        db.session.rollback()
+        return jsonify({'msg': str(e), 'indice': e.indice}), e.status
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Erro ao criar solicitações em lote: {e}")
+        return jsonify({'msg': 'Erro ao criar solicitações no banco de dados.'}), 500
+
+    novas = solicitacoes_detalhadas([nova.id_solicitacao for nova in novas])
+    return jsonify({'solicitacoes': [s.to_dict(include_produtos_details=True) for s in novas]}), 201
+
 # PUT - Aceitar/Rejeitar solicitação (negociação)
 @app.route('/solicitacao/<int:id_solicitacao>/acao', methods=['PUT'])
+@orcamento_consultas(18)
 @jwt_required()
 def acao_solicitacao(id_solicitacao):
     try:
@@ -631,60 +982,34 @@ def acao_solicitacao(id_solicitacao):
     if not solicitacao:
         return jsonify({'msg': 'Solicitação não encontrada'}), 404
 
-    produto_desejado = Produto.query.get(solicitacao.id_produto_desejado)
-    if not produto_desejado or produto_desejado.id_usuario != current_user_id:
+    id_dono = db.session.execute(
+        db.select(Produto.id_usuario).where(Produto.id_produto == solicitacao.id_produto_desejado)
+    ).scalar()
+    if id_dono != current_user_id:
         return jsonify({'msg': 'Ação não permitida. Você não é o proprietário do produto desejado.'}), 403
 
-    if solicitacao.status != StatusSolicitacao.PENDENTE:
-        return jsonify({'msg': f'Ação não permitida. Solicitação não está PENDENTE (status atual: {solicitacao.status.value})'}), 409
-
-    solicitacao.status = novo_status
-    if novo_status == StatusSolicitacao.APROVADA:
-        nova_transacao = Transacao()
-        db.session.add(nova_transacao)
-        solicitacao.transacao_obj = nova_transacao
-
-        # Recusa outras solicitações pendentes para o mesmo produto desejado
-        outras_solicitacoes_produto_desejado = Solicitacao.query.filter(
-            Solicitacao.id_produto_desejado == solicitacao.id_produto_desejado,
-            Solicitacao.id_solicitacao != solicitacao.id_solicitacao, 
-            Solicitacao.status == StatusSolicitacao.PENDENTE
-        ).all()
-        for s_outra in outras_solicitacoes_produto_desejado:
-            s_outra.status = StatusSolicitacao.RECUSADA
-            
+    # Aprovação, recusa das concorrentes e disponibilidade em uma única transação (ver estados_solicitacao.py)
     try:
+        if novo_status == StatusSolicitacao.APROVADA:
+            # Só para troca: o proprietário pode escolher os produtos ofertados
+            aprovar_solicitacao(solicitacao, data.get('id_produto_ofertado'))
+        else:
+            recusar_solicitacao(solicitacao)
         db.session.commit()
+    except SolicitacaoInvalida as e:
+        db.session.rollback()
+        return jsonify({'msg': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao processar ação para solicitação {id_solicitacao}: {e}")
         return jsonify({'msg': 'Erro ao processar ação da solicitação no banco de dados.'}), 500
 
-    if novo_status == StatusSolicitacao.APROVADA and hasattr(solicitacao, "produtos_ofertados"):
-        # Só para troca: atualiza produtos ofertados se enviados
-        produtos_ofertados_ids = data.get('id_produto_ofertado', [])
-        if produtos_ofertados_ids:
-            # Remove antigos
-            SolicitacaoProdutoOfertado.query.filter_by(id_solicitacao=solicitacao.id_solicitacao).delete()
-            # Adiciona novos
-            for id_produto in produtos_ofertados_ids:
-                rel = SolicitacaoProdutoOfertado(
-                    id_solicitacao=solicitacao.id_solicitacao,
-                    id_produto=id_produto
-                )
-                db.session.add(rel)
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"Erro ao atualizar produtos ofertados para solicitação {id_solicitacao}: {e}")
-        return jsonify({'msg': 'Erro ao atualizar produtos ofertados no banco de dados.'}), 500
-        
+    solicitacao, = solicitacoes_detalhadas([id_solicitacao])
     return jsonify(solicitacao.to_dict(include_produtos_details=True)), 200
 
 # DELETE - Cancelar solicitação
 @app.route('/solicitacao/<int:id_solicitacao>', methods=['DELETE'])
+@orcamento_consultas(9)
 @jwt_required()
 def cancelar_solicitacao(id_solicitacao):
     try:
@@ -700,12 +1025,12 @@ def cancelar_solicitacao(id_solicitacao):
     if solicitacao.id_usuario_solicitante != current_user_id:
         return jsonify({'msg': 'Você não pode cancelar esta solicitação.'}), 403
 
-    if solicitacao.status != StatusSolicitacao.PENDENTE:
-        return jsonify({'msg': f'Solicitação não pode ser cancelada pois seu status é {solicitacao.status.value}.'}), 409
-    
-    solicitacao.status = StatusSolicitacao.CANCELADA
     try:
+        cancelar_solicitacao_pendente(solicitacao)
         db.session.commit()
+    except SolicitacaoInvalida as e:
+        db.session.rollback()
+        return jsonify({'msg': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao cancelar solicitação {id_solicitacao}: {e}")
@@ -715,6 +1040,7 @@ def cancelar_solicitacao(id_solicitacao):
 
 # PUT - Marcar solicitação como PENDENTE
 @app.route('/solicitacao/<int:id_solicitacao>/pendente', methods=['PUT'])
+@orcamento_consultas(18)
 @jwt_required()
 def marcar_solicitacao_pendente(id_solicitacao):
     try:
@@ -729,48 +1055,19 @@ def marcar_solicitacao_pendente(id_solicitacao):
     if solicitacao.id_usuario_solicitante != current_user_id:
         return jsonify({'msg': 'Você não pode alterar esta solicitação.'}), 403
 
-    if solicitacao.status != StatusSolicitacao.PROCESSANDO:
-        return jsonify({'msg': f'Só é possível ativar solicitações com status PROCESSANDO. Status atual: {solicitacao.status.value}'}), 409
-
     data = request.get_json() or {}
-    produtos_ofertados_ids = data.get('id_produto_ofertado', [])
-
-    # Só exige produtos ofertados se for troca
-    tipo_solicitacao = solicitacao.produto_desejado_obj.categoria.nome_categoria.upper()
-    if tipo_solicitacao == 'TROCA':
-        if not produtos_ofertados_ids:
-            return jsonify({'msg': 'id_produto_ofertado é obrigatório para solicitações de TROCA'}), 400
-        if isinstance(produtos_ofertados_ids, int):
-            produtos_ofertados_ids = [produtos_ofertados_ids]
-        if not isinstance(produtos_ofertados_ids, list):
-            return jsonify({'msg': 'id_produto_ofertado deve ser uma lista de IDs'}), 400
-
-        # Remove antigos
-        SolicitacaoProdutoOfertado.query.filter_by(id_solicitacao=solicitacao.id_solicitacao).delete()
-        # Adiciona novos
-        for id_produto in produtos_ofertados_ids:
-            produto_ofertado = Produto.query.get(id_produto)
-            if not produto_ofertado:
-                return jsonify({'msg': f'Produto ofertado {id_produto} não encontrado'}), 404
-            if produto_ofertado.id_usuario != current_user_id:
-                return jsonify({'msg': 'Você só pode ofertar seus próprios produtos'}), 403
-            if produto_ofertado.id_produto == solicitacao.id_produto_desejado:
-                return jsonify({'msg': 'Produto ofertado não pode ser o mesmo que o produto desejado'}), 400
-            rel = SolicitacaoProdutoOfertado(
-                id_solicitacao=solicitacao.id_solicitacao,
-                id_produto=id_produto
-            )
-            db.session.add(rel)
-
-    # Atualiza status
-    solicitacao.status = StatusSolicitacao.PENDENTE
     try:
+        ativar_solicitacao(solicitacao, data.get('id_produto_ofertado', []))
         db.session.commit()
+    except SolicitacaoInvalida as e:
+        db.session.rollback()
+        return jsonify({'msg': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao ativar solicitação {id_solicitacao}: {e}")
         return jsonify({'msg': 'Erro ao atualizar solicitação no banco de dados.'}), 500
 
+    solicitacao, = solicitacoes_detalhadas([id_solicitacao])
     return jsonify({'msg': 'Solicitação ativada com sucesso!', 'solicitacao': solicitacao.to_dict(include_produtos_details=True)}), 200
 
 @app.route('/')
@@ -782,14 +1079,103 @@ def create_tables():
         db.create_all()
         print("Tabelas criadas (se não existiam)!")
 
+# CLI - Remove do disco arquivos de upload que não são mais usados por nenhuma imagem
+# (e os publicados por transações que não fizeram commit); agendar no cron
+@app.cli.command('limpar-arquivos')
+def limpar_arquivos_cli():
+    limpar_arquivos_sem_referencia(app.logger)
+    print("Arquivos sem referência removidos!")
+
+# CLI - Apaga as respostas de Idempotency-Key expiradas (agendar no cron)
+@app.cli.command('limpar-idempotencia')
+def limpar_idempotencia_cli():
+    removidas = limpar_respostas_expiradas()
+    print(f"{removidas} respostas expiradas removidas!")
+
+# CLI - Apaga as solicitações PROCESSANDO antigas e sem mensagens (agendar no cron)
+@app.cli.command('limpar-rascunhos')
+@click.option('--horas', type=float, default=None, help='Idade mínima (padrão: RASCUNHOS_PROCESSANDO_HORAS)')
+def limpar_rascunhos_cli(horas):
+    removidas = limpar_solicitacoes_processando(horas if horas is not None else app.config['RASCUNHOS_PROCESSANDO_HORAS'])
+    print(f"{removidas} solicitações PROCESSANDO removidas!")
+
+# CLI - Move as negociações RECUSADAS/CANCELADAS antigas para as tabelas de arquivo (agendar no cron)
+@app.cli.command('arquivar-negociacoes')
+@click.option('--dias', type=int, default=None, help='Dias sem atividade (padrão: ARQUIVAMENTO_DIAS)')
+@click.option('--lote', default=500, show_default=True, help='Negociações por transação')
+def arquivar_negociacoes_cli(dias, lote):
+    arquivadas = arquivar_negociacoes(dias if dias is not None else app.config['ARQUIVAMENTO_DIAS'], lote, click.echo)
+    print(f"{arquivadas} negociações arquivadas!")
+
+# CLI - Reconstrói o índice de busca de produtos
+@app.cli.command('reindexar-busca')
+def reindexar_busca_cli():
+    reindexar_todos()
+    print("Índice de busca reconstruído!")
+
+# CLI - Reconstrói o índice de localidade da listagem "perto de mim"
+@app.cli.command('reindexar-localidades')
+def reindexar_localidades_cli():
+    reindexar_localidades()
+    print("Índice de localidade reconstruído!")
+
+# CLI - Importação em massa de usuários (com endereço) a partir de JSONL ou CSV
+@app.cli.command('importar-usuarios')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--lote', default=1000, show_default=True, help='Registros por transação')
+@click.option('--workers', type=int, default=None, help='Processos para o hash das senhas (padrão: nº de CPUs)')
+def importar_usuarios_cli(arquivo, lote, workers):
+    importados, ignorados = importar_usuarios(arquivo, hasher_senhas.metodo, lote, workers, click.echo)
+    print(f"{importados} usuários importados, {ignorados} ignorados.")
+
+# CLI - Importação em massa de produtos (com imagens) a partir de JSONL ou CSV
+@app.cli.command('importar-produtos')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--pasta-imagens', type=click.Path(exists=True, file_okay=False), default='.', show_default=True,
+              help='Pasta base dos caminhos informados em "imagens"')
+@click.option('--lote', default=500, show_default=True, help='Registros por transação')
+@click.option('--workers', type=int, default=None, help='Processos para gerar as miniaturas (padrão: nº de CPUs)')
+@click.option('--sem-miniaturas', is_flag=True, help='Não gera as variantes das imagens')
+def importar_produtos_cli(arquivo, pasta_imagens, lote, workers, sem_miniaturas):
+    importados, ignorados = importar_produtos(arquivo, pasta_imagens, lote, workers, not sem_miniaturas, click.echo)
+    print(f"{importados} produtos importados, {ignorados} ignorados.")
+
+# CLI - Recalcula Produto.disponivel para todos os produtos (ex.: após adicionar a coluna)
+@app.cli.command('recalcular-disponibilidade')
+def recalcular_disponibilidade_cli():
+    recalcular_toda_disponibilidade()
+    print("Disponibilidade dos produtos recalculada!")
+
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory('uploads', filename)
+    pasta = pasta_uploads()
+    caminho = safe_join(pasta, filename)
+    if caminho is None or filename.startswith('.tmp/') or not os.path.isfile(caminho):
+        abort(404)
+
+    if app.config['UPLOADS_MODO_ENVIO'] == 'x-accel':
+        # O nginx entrega o arquivo (com Range e condicionais); o worker só responde os cabeçalhos
+        resposta = make_response('')
+        resposta.headers['X-Accel-Redirect'] = app.config['UPLOADS_X_ACCEL_PREFIXO'].rstrip('/') + '/' + filename
+        resposta.headers['Content-Type'] = ''
+    else:
+        # send_from_directory já trata Range, If-Modified-Since e If-None-Match;
+        # com USE_X_SENDFILE ele apenas devolve o cabeçalho X-Sendfile
+        resposta = send_from_directory(pasta, filename, conditional=True)
+
+    if eh_imutavel(filename):
+        # Nome derivado do hash do conteúdo: pode ficar em cache para sempre
+        resposta.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        resposta.headers['Cache-Control'] = 'public, max-age=86400'
+    return resposta
 
 # GET - Obter dados da tela de negociação por produto
 @app.route('/negociacao/<int:id_produto>', methods=['GET'])
+@orcamento_consultas(13)
 @jwt_required()
+@ler_da_replica
 def obter_dados_negociacao_por_produto(id_produto):
     try:
         current_user_id = get_current_user_id_from_token()
@@ -809,29 +1195,27 @@ def obter_dados_negociacao_por_produto(id_produto):
         ])
     ).order_by(Solicitacao.id_solicitacao.desc()).first()
 
-    # Se não existe solicitação e o usuário logado NÃO for o dono do produto, cria uma solicitação PROCESSANDO
-    if not solicitacao and produto.id_usuario != current_user_id:
-        solicitacao = Solicitacao(
-            id_usuario_solicitante=current_user_id,
-            id_produto_desejado=id_produto,
-            status=StatusSolicitacao.PROCESSANDO
-        )
-        db.session.add(solicitacao)
-        db.session.commit()
-        solicitacao = Solicitacao.query.get(solicitacao.id_solicitacao)
-
+    # Se não existe solicitação e o usuário logado NÃO for o dono do produto, devolve um
+    # rascunho (nada é gravado; ver rascunhos.py)
+    rascunho = None
     if not solicitacao:
-        return jsonify({'msg': 'Negociação não encontrada'}), 404
-
-    # Só o solicitante ou o dono do produto pode acessar
-    if current_user_id != solicitacao.id_usuario_solicitante and current_user_id != produto.id_usuario:
-        return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
+        if produto.id_usuario == current_user_id:
+            return jsonify({'msg': 'Negociação não encontrada'}), 404
+        rascunho = rascunho_para_dict(current_user_id, produto, rascunhos.data_rascunho(current_user_id, id_produto))
+    else:
+        # Só o solicitante ou o dono do produto pode acessar
+        if current_user_id != solicitacao.id_usuario_solicitante and current_user_id != produto.id_usuario:
+            return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
 
-    # Só permite visualizar se a solicitação está PROCESSANDO, PENDENTE ou APROVADA
-    if solicitacao.status not in [StatusSolicitacao.PROCESSANDO, StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]:
-        return jsonify({'msg': 'Esta negociação foi encerrada e não pode mais ser visualizada.'}), 403
+        # Só permite visualizar se a solicitação está PROCESSANDO, PENDENTE ou APROVADA
+        if solicitacao.status not in [StatusSolicitacao.PROCESSANDO, StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]:
+            return jsonify({'msg': 'Esta negociação foi encerrada e não pode mais ser visualizada.'}), 403
 
-    mensagens = Mensagem.query.filter_by(id_solicitacao=solicitacao.id_solicitacao).order_by(Mensagem.data_envio.asc()).all()
+    # Só as últimas mensagens; as anteriores são buscadas em /solicitacao/<id>/mensagens
+    if rascunho:
+        mensagens, mensagens_anteriores = [], False
+    else:
+        mensagens, mensagens_anteriores = ultimas_mensagens(solicitacao.id_solicitacao)
 
     # Obtém o endereço do proprietário do produto, se disponível
     proprietario = produto.proprietario
@@ -855,8 +1239,9 @@ def obter_dados_negociacao_por_produto(id_produto):
     produto_dict['endereco'] = endereco
 
     resultado = {
-        'solicitacao': solicitacao.to_dict(include_produtos_details=True),
-        'mensagens': [msg.to_dict() for msg in mensagens],
+        'solicitacao': rascunho or solicitacao.to_dict(include_produtos_details=True),
+        'mensagens': mensagens,
+        'mensagens_anteriores': mensagens_anteriores,
         'produto_endereco': endereco  # opcional, se quiser fora do produto
     }
     resultado['solicitacao']['produto_desejado']['endereco'] = endereco
@@ -865,7 +1250,9 @@ def obter_dados_negociacao_por_produto(id_produto):
 
 # GET - Obter dados da tela de negociação por solicitação
 @app.route('/negociacao/solicitacao/<int:id_solicitacao>', methods=['GET'])
+@orcamento_consultas(12)
 @jwt_required()
+@ler_da_replica
 def obter_dados_negociacao_por_solicitacao(id_solicitacao):
     try:
         current_user_id = get_current_user_id_from_token()
@@ -875,7 +1262,18 @@ def obter_dados_negociacao_por_solicitacao(id_solicitacao):
     solicitacao = Solicitacao.query.get(id_solicitacao)
 
     if not solicitacao:
-        return jsonify({'msg': 'Negociação (Solicitação) não encontrada'}), 404
+        # Negociação encerrada que já foi para o arquivo (somente leitura)
+        arquivada, id_dono = negociacao_arquivada(id_solicitacao)
+        if not arquivada:
+            return jsonify({'msg': 'Negociação (Solicitação) não encontrada'}), 404
+        if current_user_id not in (arquivada['id_usuario_solicitante'], id_dono):
+            return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
+        mensagens, mensagens_anteriores = ultimas_mensagens(id_solicitacao, arquivada=True)
+        return jsonify({
+            'solicitacao': arquivada,
+            'mensagens': mensagens,
+            'mensagens_anteriores': mensagens_anteriores,
+        }), 200
 
     produto_desejado = Produto.query.get(solicitacao.id_produto_desejado)
     if not produto_desejado: 
@@ -884,11 +1282,12 @@ def obter_dados_negociacao_por_solicitacao(id_solicitacao):
     if current_user_id != solicitacao.id_usuario_solicitante and current_user_id != produto_desejado.id_usuario:
         return jsonify({'msg': 'Acesso não autorizado a esta negociação'}), 403
 
-    mensagens = Mensagem.query.filter_by(id_solicitacao=id_solicitacao).order_by(Mensagem.data_envio.asc()).all()
+    mensagens, mensagens_anteriores = ultimas_mensagens(id_solicitacao)
     
     resultado = {
         'solicitacao': solicitacao.to_dict(include_produtos_details=True),
-        'mensagens': [msg.to_dict() for msg in mensagens],
+        'mensagens': mensagens,
+        'mensagens_anteriores': mensagens_anteriores,
     }
     return jsonify(resultado), 200
 
@@ -0,0 +1,366 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from flask import g, request
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Arquivo
+from imagens import remover_arquivos_imagem, caminhos_variantes
+
+# Armazenamento de uploads endereçado pelo conteúdo: o arquivo é salvo em
+# uploads/<2 primeiros hex>/<2 seguintes>/<sha256><ext>, de modo que fotos
+# idênticas ocupam um único arquivo. A tabela ARQUIVO conta quantas imagens
+# usam cada arquivo; ele só é apagado quando a contagem chega a zero.
+#
+# Fluxo de uma gravação:
+#   1. receber_upload(): grava em arquivo temporário calculando o hash (sem banco)
+#   2. registrar_referencia(): incrementa a contagem na transação da rota
+#   3. publicar(): move o temporário para o caminho final (se ainda não existir)
+#   4. commit
+# Publicar antes do commit garante que nenhuma linha confirmada aponte para um
+# arquivo ausente; como o nome é o hash, publicar de novo não muda nada. Se o
+# commit falhar, o arquivo publicado sem linha em ARQUIVO é apagado pela
+# varredura (limpar_arquivos_sem_referencia), depois de IDADE_MINIMA_ORFAO.
+#
+# A remoção (remover_se_sem_referencia) também não mexe no disco com transação
+# aberta: o arquivo vai para a pasta .lixo, a linha é apagada em transação
+# curta e só depois do commit a cópia é apagada (ou devolvida, se alguém voltou
+# a usar o conteúdo).
+
+PASTA_UPLOADS = 'uploads'
+TAMANHO_BLOCO = 64 * 1024
+PADRAO_ENDERECADO = re.compile(r'^uploads/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[a-z0-9]{1,10})?$')
+# Originais e variantes (_thumb, _media) endereçados pelo hash nunca mudam de conteúdo
+PADRAO_IMUTAVEL = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(_[a-z]+)?(\.[a-z0-9]{1,10})?$')
+PADRAO_PASTA_HASH = re.compile(r'^[0-9a-f]{2}$')
+IDADE_MINIMA_ORFAO = 3600  # segundos; arquivos mais novos podem ser de uma transação em andamento
+
+
+class ArquivoRecebido:
+    __slots__ = ('caminho_temporario', 'hash', 'extensao', 'tamanho')
+
+    def __init__(self, caminho_temporario, hash, extensao, tamanho):
+        self.caminho_temporario = caminho_temporario
+        self.hash = hash
+        self.extensao = extensao
+        self.tamanho = tamanho
+
+    @property
+    def url(self):
+        return f"{PASTA_UPLOADS}/{self.hash[:2]}/{self.hash[2:4]}/{self.hash}{self.extensao}"
+
+
+def _pasta_base():
+    return os.getcwd()
+
+
+def pasta_uploads():
+    return os.path.join(_pasta_base(), PASTA_UPLOADS)
+
+
+def eh_imutavel(caminho_relativo):
+    # caminho relativo à pasta uploads/ (como recebido na rota /uploads/<path>)
+    return bool(PADRAO_IMUTAVEL.match(caminho_relativo))
+
+
+def _extensao_segura(nome_arquivo):
+    ext = os.path.splitext(nome_arquivo or '')[1].lower()
+    return ext if re.fullmatch(r'\.[a-z0-9]{1,10}', ext) else ''
+
+
+def receber_upload(arquivo):
+    # Copia o upload em blocos para um temporário na mesma partição de uploads/
+    # (para que a movimentação final seja atômica), calculando o SHA-256.
+    pasta_temporaria = os.path.join(_pasta_base(), PASTA_UPLOADS, '.tmp')
+    os.makedirs(pasta_temporaria, exist_ok=True)
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    with tempfile.NamedTemporaryFile(dir=pasta_temporaria, delete=False) as temporario:
+        while True:
+            bloco = arquivo.stream.read(TAMANHO_BLOCO)
+            if not bloco:
+                break
+            sha256.update(bloco)
+            temporario.write(bloco)
+            tamanho += len(bloco)
+    return ArquivoRecebido(temporario.name, sha256.hexdigest(), _extensao_segura(arquivo.filename), tamanho)
+
+
+def receber_uploads(arquivos):
+    return [receber_upload(arquivo) for arquivo in arquivos if arquivo and arquivo.filename]
+
+
+def receber_uploads_da_requisicao(nome):
+    # Recebe os arquivos do campo uma única vez por requisição: @idempotente os
+    # recebe antes de abrir a transação (o hash entra na impressão) e a rota
+    # reaproveita os mesmos temporários.
+    recebidos = g.setdefault('uploads_recebidos', {})
+    if nome not in recebidos:
+        recebidos[nome] = receber_uploads(request.files.getlist(nome))
+    return recebidos[nome]
+
+
+def descartar(recebidos):
+    # Remove os temporários (usado quando a requisição falha antes do commit)
+    for recebido in recebidos:
+        if os.path.exists(recebido.caminho_temporario):
+            os.remove(recebido.caminho_temporario)
+
+
+def descartar_uploads_da_requisicao():
+    # Remove os temporários da requisição que não foram publicados
+    for recebidos in g.pop('uploads_recebidos', {}).values():
+        descartar(recebidos)
+
+
+def publicar(recebidos):
+    # Chamado depois de registrar_referencia() e antes do commit: coloca cada
+    # arquivo no caminho final ou, se ele já existir (conteúdo repetido), apenas
+    # descarta o temporário.
+    for recebido in recebidos:
+        destino = os.path.join(_pasta_base(), recebido.url)
+        if os.path.exists(destino):
+            os.remove(recebido.caminho_temporario)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(recebido.caminho_temporario, destino)
+
+
+def registrar_referencia(recebido):
+    # Incrementa a contagem do arquivo. Não faz commit.
+    resultado = db.session.execute(
+        db.update(Arquivo)
+        .where(Arquivo.url_arquivo == recebido.url)
+        .values(referencias=Arquivo.referencias + 1)
+    )
+    if resultado.rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Arquivo(url_arquivo=recebido.url, referencias=1, tamanho=recebido.tamanho))
+    except IntegrityError:
+        # Outra requisição registrou o mesmo conteúdo ao mesmo tempo
+        db.session.execute(
+            db.update(Arquivo)
+            .where(Arquivo.url_arquivo == recebido.url)
+            .values(referencias=Arquivo.referencias + 1)
+        )
+
+
+def registrar_referencias(recebidos):
+    # Versão em lote de registrar_referencia() (usada na importação): um UPDATE
+    # executemany para os arquivos que já existem e um INSERT para os novos.
+    contagem = {}
+    tamanhos = {}
+    for recebido in recebidos:
+        contagem[recebido.url] = contagem.get(recebido.url, 0) + 1
+        tamanhos[recebido.url] = recebido.tamanho
+    if not contagem:
+        return
+    existentes = set(db.session.execute(
+        db.select(Arquivo.url_arquivo).where(Arquivo.url_arquivo.in_(list(contagem)))
+    ).scalars())
+    tabela = Arquivo.__table__
+    if existentes:
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.url_arquivo == db.bindparam('url'))
+            .values(referencias=tabela.c.referencias + db.bindparam('quantidade')),
+            [{'url': url, 'quantidade': contagem[url]} for url in existentes]
+        )
+    novos = [url for url in contagem if url not in existentes]
+    if novos:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(Arquivo), [
+                    {'url_arquivo': url, 'referencias': contagem[url], 'tamanho': tamanhos[url]}
+                    for url in novos
+                ])
+        except IntegrityError:
+            # Alguma requisição registrou o mesmo conteúdo ao mesmo tempo: um por um
+            for recebido in recebidos:
+                if recebido.url in novos:
+                    registrar_referencia(recebido)
+
+
+def liberar_referencia(url):
+    # Decrementa a contagem do arquivo. Não faz commit; depois do commit chame
+    # remover_se_sem_referencia() para apagar o que não é mais usado.
+    db.session.execute(
+        db.update(Arquivo)
+        .where(Arquivo.url_arquivo == url)
+        .values(referencias=Arquivo.referencias - 1)
+    )
+
+
+def _pasta_lixo():
+    return os.path.join(_pasta_base(), PASTA_UPLOADS, '.lixo')
+
+
+def _tirar_do_lugar(url):
+    # Move o original e as variantes para uma pasta própria em .lixo. Retorna os
+    # pares (caminho final, caminho no lixo) do que foi movido.
+    os.makedirs(_pasta_lixo(), exist_ok=True)
+    pasta = tempfile.mkdtemp(dir=_pasta_lixo())
+    movidos = []
+    for relativo in [url] + caminhos_variantes(url):
+        origem = os.path.join(_pasta_base(), relativo)
+        destino = os.path.join(pasta, os.path.basename(relativo))
+        try:
+            os.replace(origem, destino)
+        except FileNotFoundError:
+            continue
+        movidos.append((origem, destino))
+    return pasta, movidos
+
+
+def _devolver(pasta, movidos):
+    # Se o conteúdo foi publicado de novo nesse meio tempo, a cópia no lixo sobra
+    for origem, destino in movidos:
+        if os.path.exists(origem):
+            os.remove(destino)
+        else:
+            os.replace(destino, origem)
+    os.rmdir(pasta)
+
+
+def _apagar_do_lixo(pasta, movidos):
+    for _, destino in movidos:
+        os.remove(destino)
+    os.rmdir(pasta)
+
+
+def remover_se_sem_referencia(urls, logger=None):
+    # Para cada arquivo sem referências: tira do lugar (para a pasta .lixo),
+    # apaga a linha em transação própria, travando-a, e só depois do commit
+    # apaga a cópia. Uma gravação concorrente do mesmo conteúdo que publicar
+    # nesse meio tempo não encontra o arquivo e coloca a própria cópia; se ela
+    # voltou a usar a linha antes da trava, o arquivo é devolvido ao lugar.
+    # Sobras de um processo que morreu no meio ficam para limpar_arquivos_sem_referencia().
+    for url in urls:
+        if not PADRAO_ENDERECADO.match(url):
+            # Arquivo antigo (nome aleatório, nunca compartilhado)
+            remover_arquivos_imagem(_pasta_base(), url, logger)
+            continue
+        try:
+            referencias = db.session.execute(
+                db.select(Arquivo.referencias).where(Arquivo.url_arquivo == url)
+            ).scalar()
+            db.session.commit()
+            if referencias is None or referencias > 0:
+                continue
+            pasta, movidos = _tirar_do_lugar(url)
+            try:
+                arquivo = db.session.execute(
+                    db.select(Arquivo).where(Arquivo.url_arquivo == url).with_for_update()
+                ).scalar_one_or_none()
+                apagado = arquivo is not None and arquivo.referencias <= 0
+                if apagado:
+                    db.session.delete(arquivo)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                _devolver(pasta, movidos)
+                raise
+            if apagado:
+                _apagar_do_lixo(pasta, movidos)
+            else:
+                _devolver(pasta, movidos)
+        except Exception as e:
+            db.session.rollback()
+            if logger:
+                logger.error(f"Erro ao remover arquivo {url}: {e}")
+
+
+def _limpar_lixo(logger=None):
+    # Cópias deixadas em .lixo por uma remoção interrompida: volta para o lugar
+    # (se estiver vazio) e a varredura de órfãos decide se ainda é usada
+    if not os.path.isdir(_pasta_lixo()):
+        return
+    limite = time.time() - IDADE_MINIMA_ORFAO
+    for entrada in os.scandir(_pasta_lixo()):
+        if not entrada.is_dir() or entrada.stat().st_mtime > limite:
+            continue
+        movidos = []
+        for arquivo in os.scandir(entrada.path):
+            nome = arquivo.name
+            origem = os.path.join(_pasta_base(), PASTA_UPLOADS, nome[:2], nome[2:4], nome)
+            movidos.append((origem, arquivo.path))
+        try:
+            for origem, _ in movidos:
+                os.makedirs(os.path.dirname(origem), exist_ok=True)
+            _devolver(entrada.path, movidos)
+        except OSError as e:
+            if logger:
+                logger.error(f"Erro ao limpar {entrada.path}: {e}")
+
+
+def _limpar_temporarios(logger=None):
+    # Uploads recebidos por requisições que morreram antes de publicar
+    pasta = os.path.join(_pasta_base(), PASTA_UPLOADS, '.tmp')
+    if not os.path.isdir(pasta):
+        return
+    limite = time.time() - IDADE_MINIMA_ORFAO
+    for entrada in os.scandir(pasta):
+        if entrada.is_file() and entrada.stat().st_mtime <= limite:
+            try:
+                os.remove(entrada.path)
+            except OSError as e:
+                if logger:
+                    logger.error(f"Erro ao remover {entrada.path}: {e}")
+
+
+def _limpar_orfaos(logger=None):
+    # Arquivos endereçados (e variantes) cujo hash não tem linha em ARQUIVO:
+    # publicados por uma transação que não fez commit. Uma consulta por pasta
+    # de primeiro nível; só apaga o que tem mais de IDADE_MINIMA_ORFAO.
+    base = pasta_uploads()
+    if not os.path.isdir(base):
+        return
+    limite = time.time() - IDADE_MINIMA_ORFAO
+    for primeira in sorted(os.listdir(base)):
+        if not PADRAO_PASTA_HASH.match(primeira):
+            continue
+        hashes = {
+            url.rsplit('/', 1)[1][:64]
+            for url in db.session.execute(
+                db.select(Arquivo.url_arquivo).where(Arquivo.url_arquivo.like(f'{PASTA_UPLOADS}/{primeira}/%'))
+            ).scalars()
+        }
+        db.session.commit()
+        for raiz, _, nomes in os.walk(os.path.join(base, primeira)):
+            for nome in nomes:
+                relativo = os.path.relpath(os.path.join(raiz, nome), base).replace(os.sep, '/')
+                if not eh_imutavel(relativo) or nome[:64] in hashes:
+                    continue
+                caminho = os.path.join(raiz, nome)
+                try:
+                    if os.stat(caminho).st_mtime <= limite:
+                        os.remove(caminho)
+                except OSError as e:
+                    if logger:
+                        logger.error(f"Erro ao remover arquivo órfão {caminho}: {e}")
+
+
+def limpar_arquivos_sem_referencia(logger=None, tamanho_lote=500):
+    # Varredura de segurança: arquivos sem referência cuja remoção falhou,
+    # sobras em .lixo e .tmp, e arquivos publicados sem linha em ARQUIVO
+    ultima_url = ''
+    while True:
+        urls = db.session.execute(
+            db.select(Arquivo.url_arquivo)
+            .where(Arquivo.referencias <= 0, Arquivo.url_arquivo > ultima_url)
+            .order_by(Arquivo.url_arquivo)
+            .limit(tamanho_lote)
+        ).scalars().all()
+        db.session.commit()
+        if not urls:
+            break
+        remover_se_sem_referencia(urls, logger)
+        ultima_url = urls[-1]
+    _limpar_lixo(logger)
+    _limpar_temporarios(logger)
+    _limpar_orfaos(logger)
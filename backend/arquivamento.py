@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from models import (
+    db, Solicitacao, SolicitacaoProdutoOfertado, Mensagem, StatusSolicitacao,
+    SolicitacaoArquivada, SolicitacaoProdutoOfertadoArquivado, MensagemArquivada
+)
+
+# Arquivamento das negociações encerradas. Solicitações RECUSADAS e CANCELADAS
+# nunca mudam de status (ver TRANSICOES em estados_solicitacao.py), mas
+# continuavam em SOLICITACAO, MENSAGEM e SOLICITACAO_PRODUTO_OFERTADO, pesando em
+# todas as consultas por status. arquivar_negociacoes move, em lotes, as que
+# estão paradas há mais de `dias` (sem solicitação nem mensagem recentes) para as
+# tabelas *_ARQUIVO, com os mesmos IDs. Cada lote é uma transação: INSERT ...
+# SELECT nas tabelas de arquivo e DELETE nas principais.
+#
+# A leitura continua disponível: /negociacao/solicitacao/<id>,
+# /solicitacao/<id>/mensagens e /usuario/negociacoes consultam o arquivo
+# quando a solicitação não está nas tabelas principais.
+
+STATUS_ARQUIVAVEIS = [StatusSolicitacao.RECUSADA, StatusSolicitacao.CANCELADA]
+
+
+def _copiar(origem, destino, condicao, **extras):
+    # INSERT INTO destino SELECT colunas de origem WHERE condicao
+    colunas = [coluna.name for coluna in destino.__table__.columns if coluna.name not in extras]
+    selecao = db.select(
+        *[origem.__table__.c[nome] for nome in colunas],
+        *[db.literal(valor) for valor in extras.values()]
+    ).where(condicao)
+    db.session.execute(destino.__table__.insert().from_select(colunas + list(extras), selecao))
+
+
+def _arquivar_lote(ids):
+    _copiar(Solicitacao, SolicitacaoArquivada, Solicitacao.id_solicitacao.in_(ids), data_arquivamento=datetime.utcnow())
+    _copiar(SolicitacaoProdutoOfertado, SolicitacaoProdutoOfertadoArquivado, SolicitacaoProdutoOfertado.id_solicitacao.in_(ids))
+    _copiar(Mensagem, MensagemArquivada, Mensagem.id_solicitacao.in_(ids))
+    db.session.execute(db.delete(Mensagem).where(Mensagem.id_solicitacao.in_(ids)))
+    db.session.execute(db.delete(SolicitacaoProdutoOfertado).where(SolicitacaoProdutoOfertado.id_solicitacao.in_(ids)))
+    db.session.execute(
+        db.delete(Solicitacao).where(Solicitacao.id_solicitacao.in_(ids))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def arquivar_negociacoes(dias, tamanho_lote=500, log=None):
+    limite = datetime.utcnow() - timedelta(days=dias)
+    arquivadas = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Solicitacao.id_solicitacao)
+            .where(
+                Solicitacao.status.in_(STATUS_ARQUIVAVEIS),
+                Solicitacao.data_solicitacao < limite,
+                ~db.exists().where(Mensagem.id_solicitacao == Solicitacao.id_solicitacao, Mensagem.data_envio >= limite)
+            )
+            .order_by(Solicitacao.id_solicitacao)
+            .limit(tamanho_lote)
+        ).scalars().all()
+        if not ids:
+            return arquivadas
+        try:
+            _arquivar_lote(ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        arquivadas += len(ids)
+        if log:
+            log(f"{arquivadas} negociações arquivadas...")
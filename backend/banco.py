@@ -0,0 +1,92 @@
+import os
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select
+
+# Configuração do pool de conexões e das réplicas de leitura.
+#
+# Variáveis de ambiente:
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT  tamanho do pool (padrões do SQLAlchemy)
+#   DB_POOL_RECYCLE      segundos até reabrir uma conexão (padrão 1800, abaixo do wait_timeout do MySQL)
+#   DB_POOL_PRE_PING     testa a conexão antes de usar (padrão 1)
+#   DATABASE_REPLICA_URLS  URLs das réplicas separadas por vírgula
+#
+# As réplicas viram binds 'replica_0', 'replica_1'... do Flask-SQLAlchemy. Só
+# as rotas marcadas com @ler_da_replica (ver replicas.py) leem delas; o resto
+# continua no primário, assim como as de quem gravou algo há pouco.
+
+PREFIXO_REPLICA = 'replica_'
+CHAVE_REPLICA = 'replica'          # session.info: engine da réplica escolhida para a requisição
+CHAVE_NO_PRIMARIO = 'no_primario'  # session.info: a sessão já escreveu; não volta para a réplica
+CHAVE_COMMIT_ADIADO = 'commit_adiado'  # session.info: CommitAdiado da rota @idempotente em execução
+
+
+def _opcoes_engine():
+    opcoes = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1').lower() not in ('0', 'false', 'nao', 'não'),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+    for variavel, opcao, tipo in (
+        ('DB_POOL_SIZE', 'pool_size', int),
+        ('DB_MAX_OVERFLOW', 'max_overflow', int),
+        ('DB_POOL_TIMEOUT', 'pool_timeout', float),
+    ):
+        if os.environ.get(variavel):
+            opcoes[opcao] = tipo(os.environ[variavel])
+    return opcoes
+
+
+def configurar_banco(app):
+    # Chamado antes de db.init_app(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', _opcoes_engine())
+    urls = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for indice, url in enumerate(urls):
+        binds[f'{PREFIXO_REPLICA}{indice}'] = url
+    # Quanto tempo uma réplica que falhou fica fora de uso
+    app.config.setdefault('REPLICA_PAUSA_APOS_FALHA', float(os.environ.get('REPLICA_PAUSA_APOS_FALHA', 30)))
+    # Por quanto tempo depois de gravar algo o cliente lê só do primário (ver replicas.py)
+    app.config.setdefault('REPLICA_JANELA_APOS_ESCRITA', float(os.environ.get('REPLICA_JANELA_APOS_ESCRITA', 10)))
+
+
+def chaves_replicas(app):
+    return [chave for chave in app.config.get('SQLALCHEMY_BINDS', {}) if str(chave).startswith(PREFIXO_REPLICA)]
+
+
+class CommitAdiado:
+    # Transação de uma rota @idempotente: o commit da rota vira flush e o commit
+    # real é feito pelo decorator, junto com a resposta guardada (ver idempotencia.py)
+    def __init__(self):
+        self.pedido = False    # a rota chamou commit() desde o último rollback
+        self.apos_commit = []  # funções a chamar depois do commit real
+        self.apos_rollback = []  # limpezas para quando o commit real não acontece
+
+
+class SessaoRoteada(Session):
+    # Envia SELECTs para a réplica escolhida para a requisição. Qualquer escrita
+    # (flush, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE) vai para o primário e
+    # prende a sessão nele até o fim, para que ela leia o que acabou de gravar.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get(CHAVE_REPLICA)
+        if replica is not None and bind is None and not self.info.get(CHAVE_NO_PRIMARIO):
+            eh_leitura = isinstance(clause, Select) and clause._for_update_arg is None
+            if eh_leitura and not self._flushing:
+                return replica
+            self.info[CHAVE_NO_PRIMARIO] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        adiado = self.info.get(CHAVE_COMMIT_ADIADO)
+        if adiado is not None:
+            self.flush()
+            adiado.pedido = True
+            return
+        super().commit()
+
+    def rollback(self):
+        adiado = self.info.get(CHAVE_COMMIT_ADIADO)
+        if adiado is not None:
+            adiado.pedido = False
+        super().rollback()
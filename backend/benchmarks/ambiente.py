@@ -0,0 +1,27 @@
+# Ambiente isolado para os scripts de benchmarks/: importar este módulo antes
+# de app. Ele aponta DATABASE_URL para um SQLite temporário (ou para
+# BENCH_DATABASE_URL, se definida) e muda a pasta de trabalho para uma pasta
+# temporária (uploads e .env do projeto não são usados).
+import os
+import sys
+import tempfile
+
+PASTA_BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PASTA_BACKEND)
+# Pasta de onde o script foi chamado, para resolver caminhos passados na linha de comando
+PASTA_CHAMADA = os.getcwd()
+PASTA_TEMPORARIA = tempfile.mkdtemp(prefix='ecotroca_bench_')
+URL_BANCO = os.environ.get('BENCH_DATABASE_URL') or 'sqlite:///' + os.path.join(PASTA_TEMPORARIA, 'bench.sqlite')
+os.environ['DATABASE_URL'] = URL_BANCO
+os.environ.pop('DATABASE_REPLICA_URLS', None)
+os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-' + 'x' * 32)
+os.chdir(PASTA_TEMPORARIA)
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+
+def criar_tabelas():
+    # produto_categoria referencia tabelas em minúsculo que não existem; não é usada pela API
+    tabelas = [t for nome, t in db.metadata.tables.items() if nome != 'produto_categoria']
+    db.metadata.create_all(db.engine, tables=tabelas)
@@ -0,0 +1,102 @@
+# Compara a serialização das respostas de /produtos e /usuario/negociacoes:
+# provedor JSON padrão do Flask x ProvedorJSONRapido (json e orjson), e o
+# tamanho no fio sem compressão, com gzip e com br (ver compressao.py).
+#
+# Uso (a partir de backend/):
+#   python -m benchmarks.bench_json --negociacoes 500 --produtos 100 --imagens 2
+#
+# Roda em um SQLite temporário; não usa o banco configurado no .env.
+import argparse
+import time
+
+from benchmarks.ambiente import app, criar_tabelas
+from benchmarks.bench_negociacoes import popular
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy.orm import selectinload
+
+import serializacao
+from compressao import brotli
+from models import Produto
+from negociacoes_leitura import negociacoes_do_usuario
+from serializacao import ProvedorJSONRapido
+
+
+def provedores():
+    padrao = DefaultJSONProvider(app)
+    padrao.compact = True
+    lista = [('Flask padrão', padrao)]
+    for codificador in ('json', 'orjson'):
+        if codificador == 'orjson' and serializacao.orjson is None:
+            continue
+        app.config['JSON_CODIFICADOR'] = codificador
+        provedor = ProvedorJSONRapido(app)
+        provedor.compact = True
+        lista.append((f'Rápido ({codificador})', provedor))
+    return lista
+
+
+def medir(funcao, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+    tempos.sort()
+    return resultado, tempos[len(tempos) // 2]
+
+
+def comparar(nome, payload, repeticoes, compressao):
+    print(f'\n{nome}')
+    print(f'  {"provedor":<16} {"tempo":>12} {"bytes":>10}')
+    corpos = []
+    base = None
+    for nome_provedor, provedor in provedores():
+        corpo, tempo = medir(lambda: provedor.response(payload).get_data(), repeticoes)
+        base = base or tempo
+        corpos.append(corpo)
+        print(f'  {nome_provedor:<16} {tempo * 1000:9.2f} ms {len(corpo):10d}  ({base / tempo:.1f}x)')
+
+    corpo = corpos[-1]
+    print(f'  {"no fio":<16} {"tempo":>12} {"bytes":>10}')
+    print(f'  {"identity":<16} {0:9.2f} ms {len(corpo):10d}')
+    for codificacao in compressao.codificacoes[::-1]:
+        comprimido, tempo = medir(lambda: compressao.comprimir(corpo, codificacao), repeticoes)
+        print(f'  {codificacao:<16} {tempo * 1000:9.2f} ms {len(comprimido):10d}  ({len(corpo) / len(comprimido):.1f}x menor)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de serialização e compressão das respostas')
+    parser.add_argument('--negociacoes', type=int, default=500)
+    parser.add_argument('--ofertados', type=int, default=3)
+    parser.add_argument('--imagens', type=int, default=2)
+    parser.add_argument('--produtos', type=int, default=100, help='Produtos na página de /produtos')
+    parser.add_argument('--repeticoes', type=int, default=15)
+    args = parser.parse_args()
+
+    compressao = app.extensions['compressao']
+    with app.app_context():
+        criar_tabelas()
+        id_usuario = popular(args.negociacoes, args.ofertados, args.imagens)
+
+        produtos = Produto.query.options(
+            selectinload(Produto.imagens), selectinload(Produto.proprietario), selectinload(Produto.categoria)
+        ).order_by(Produto.data_cadastro.desc(), Produto.id_produto.desc()).limit(args.produtos).all()
+        pagina_produtos = {
+            'produtos': [produto.to_dict(include_owner=True) for produto in produtos],
+            'next_cursor': 'MjAyNC0wMS0wMVQwMDowMDowMHwx'
+        }
+        negociacoes = negociacoes_do_usuario(id_usuario)
+
+        print(f'{args.negociacoes} negociações, {args.ofertados} ofertados e {args.imagens} imagens por produto; '
+              f'mediana de {args.repeticoes} rodadas')
+        if serializacao.orjson is None:
+            print('orjson não instalado: só o codificador json é medido')
+        if brotli is None:
+            print('brotli não instalado: só gzip é medido')
+        comparar(f'GET /produtos ({len(produtos)} produtos)', pagina_produtos, args.repeticoes, compressao)
+        comparar(f'GET /usuario/negociacoes ({len(negociacoes)} negociações)', negociacoes, args.repeticoes, compressao)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Compara a leitura de /usuario/negociacoes pelo caminho ORM antigo (objetos +
+# to_dict aninhados) com a consulta projetada de negociacoes_leitura.
+#
+# Uso (a partir de backend/):
+#   python -m benchmarks.bench_negociacoes --negociacoes 500 --ofertados 3 --imagens 2
+#
+# Roda em um SQLite temporário; não usa o banco configurado no .env.
+import argparse
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks.ambiente import app, db, criar_tabelas
+
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+
+from models import (
+    Usuario, Produto, Imagem, Categoria, Solicitacao, SolicitacaoProdutoOfertado,
+    StatusSolicitacao
+)
+from negociacoes_leitura import negociacoes_do_usuario
+
+
+def negociacoes_orm(id_usuario):
+    # Implementação anterior da rota, mantida aqui como referência
+    negociacoes = Solicitacao.query.join(
+        Produto, Solicitacao.id_produto_desejado == Produto.id_produto
+    ).filter(
+        db.or_(
+            Solicitacao.id_usuario_solicitante == id_usuario,
+            Produto.id_usuario == id_usuario
+        )
+    ).options(
+        selectinload(Solicitacao.usuario_solicitante_obj),
+        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.proprietario),
+        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.imagens),
+        selectinload(Solicitacao.produto_desejado_obj).selectinload(Produto.categoria),
+        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.imagens),
+        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.proprietario),
+        selectinload(Solicitacao.produtos_ofertados).selectinload(Produto.categoria)
+    ).order_by(Solicitacao.data_solicitacao.desc()).all()
+    return [s.to_dict(include_produtos_details=True) for s in negociacoes]
+
+
+def popular(qtd_negociacoes, qtd_ofertados, qtd_imagens):
+    categoria = Categoria(nome_categoria='TROCA', descricao='Troca')
+    db.session.add(categoria)
+    usuarios = [
+        Usuario(nome_usuario=f'Usuário {i}', telefone='0', email=f'u{i}@bench',
+                password_hash='x', data_nascimento=date(2000, 1, 1))
+        for i in range(2)
+    ]
+    db.session.add_all(usuarios)
+    db.session.flush()
+    dono, solicitante = usuarios
+
+    def novo_produto(usuario, n):
+        produto = Produto(nome_produto=f'Produto {n}', descricao='Descrição do produto',
+                          id_usuario=usuario.id_usuario, id_categoria=categoria.id_categoria, valor=10)
+        produto.imagens = [Imagem(url_imagem=f'uploads/{n}_{i}.jpg') for i in range(qtd_imagens)]
+        return produto
+
+    inicio = datetime(2024, 1, 1)
+    for n in range(qtd_negociacoes):
+        desejado = novo_produto(dono, f'd{n}')
+        ofertados = [novo_produto(solicitante, f'o{n}_{i}') for i in range(qtd_ofertados)]
+        db.session.add(desejado)
+        db.session.add_all(ofertados)
+        db.session.flush()
+        solicitacao = Solicitacao(id_usuario_solicitante=solicitante.id_usuario,
+                                  id_produto_desejado=desejado.id_produto,
+                                  status=StatusSolicitacao.PENDENTE,
+                                  data_solicitacao=inicio + timedelta(minutes=n))
+        db.session.add(solicitacao)
+        db.session.flush()
+        db.session.add_all([
+            SolicitacaoProdutoOfertado(id_solicitacao=solicitacao.id_solicitacao, id_produto=p.id_produto)
+            for p in ofertados
+        ])
+    db.session.commit()
+    return dono.id_usuario
+
+
+def medir(funcao, id_usuario, repeticoes):
+    consultas = []
+
+    def contar(*args):
+        consultas.append(1)
+
+    event.listen(db.engine, 'before_cursor_execute', contar)
+    try:
+        tempos = []
+        for _ in range(repeticoes):
+            db.session.expunge_all()  # sem objetos em cache entre as rodadas
+            consultas.clear()
+            inicio = time.perf_counter()
+            resultado = funcao(id_usuario)
+            tempos.append(time.perf_counter() - inicio)
+            db.session.rollback()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', contar)
+    tempos.sort()
+    return resultado, tempos[len(tempos) // 2], len(consultas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de /usuario/negociacoes')
+    parser.add_argument('--negociacoes', type=int, default=500)
+    parser.add_argument('--ofertados', type=int, default=3)
+    parser.add_argument('--imagens', type=int, default=2)
+    parser.add_argument('--repeticoes', type=int, default=7)
+    args = parser.parse_args()
+
+    with app.app_context():
+        criar_tabelas()
+        id_usuario = popular(args.negociacoes, args.ofertados, args.imagens)
+
+        resultado_orm, tempo_orm, consultas_orm = medir(negociacoes_orm, id_usuario, args.repeticoes)
+        resultado_rapido, tempo_rapido, consultas_rapido = medir(negociacoes_do_usuario, id_usuario, args.repeticoes)
+
+    if resultado_orm != resultado_rapido:
+        print('ERRO: as duas implementações retornaram resultados diferentes')
+        sys.exit(1)
+
+    print(f'{args.negociacoes} negociações, {args.ofertados} ofertados e {args.imagens} imagens por produto')
+    print(f'ORM:        {tempo_orm * 1000:8.1f} ms  {consultas_orm:3d} consultas')
+    print(f'Projetado:  {tempo_rapido * 1000:8.1f} ms  {consultas_rapido:3d} consultas')
+    print(f'Ganho:      {tempo_orm / tempo_rapido:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
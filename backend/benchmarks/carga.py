@@ -0,0 +1,223 @@
+# Teste de carga das rotas de leitura sobre a base do benchmarks.gerador:
+# cada rota recebe --requisicoes chamadas, com --concorrencia threads e usuários
+# variados (JWT de cada um), e o relatório traz p50/p95/p99, média, vazão e erros.
+# O resultado é salvo em JSON (com o commit atual) para comparar entre versões.
+#
+# Uso (a partir de backend/):
+#   python -m benchmarks.gerador --usuarios 10000 --produtos 200000 --mensagens 2000000 --manifesto base.json
+#   python -m benchmarks.carga --manifesto base.json --saida antes.json
+#   ... altera o código ...
+#   python -m benchmarks.carga --manifesto base.json --saida depois.json --comparar antes.json
+#
+# Por padrão as requisições vão para o app no próprio processo (test client),
+# usando o banco registrado no manifesto. Com --url elas vão por HTTP para um
+# servidor já rodando (gunicorn, flask run); nesse caso JWT_SECRET_KEY precisa
+# ser a mesma do servidor para os tokens serem aceitos.
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote, urlsplit
+
+
+def rotas(manifesto):
+    # (nome, função que recebe (aleatorio, usuario) e devolve a URL)
+    usuarios_com_solicitacoes = [u for u in manifesto['usuarios'] if u['solicitacoes']]
+    usuarios_com_produtos = [u for u in manifesto['usuarios'] if u['produtos']]
+    lista = [
+        ('GET /produtos', None, lambda a, u: '/produtos'),
+        ('GET /produtos?categoria&cidade', None,
+         lambda a, u: f"/produtos?categoria=TROCA&cidade={quote(a.choice(manifesto['cidades']))}"),
+        ('GET /produtos?perto=todos', None, lambda a, u: '/produtos?perto=todos'),
+        ('GET /produtos/busca', None, lambda a, u: f"/produtos/busca?q={quote(a.choice(manifesto['termos_busca']))}"),
+        ('GET /produtos/usuario', usuarios_com_produtos, lambda a, u: '/produtos/usuario'),
+        ('GET /usuario/negociacoes', usuarios_com_solicitacoes, lambda a, u: '/usuario/negociacoes'),
+        ('GET /produto/<id>', None, lambda a, u: f"/produto/{a.choice(manifesto['produtos'])}"),
+        ('GET /solicitacao/<id>/mensagens', usuarios_com_solicitacoes,
+         lambda a, u: f"/solicitacao/{a.choice(u['solicitacoes'])}/mensagens"),
+        ('GET /negociacao/solicitacao/<id>', usuarios_com_solicitacoes,
+         lambda a, u: f"/negociacao/solicitacao/{a.choice(u['solicitacoes'])}"),
+    ]
+    return [(nome, usuarios or manifesto['usuarios'], url) for nome, usuarios, url in lista]
+
+
+class ClienteInterno:
+    def __init__(self, app):
+        self._local = threading.local()
+        self._app = app
+
+    def get(self, url, headers):
+        cliente = getattr(self._local, 'cliente', None)
+        if cliente is None:
+            cliente = self._local.cliente = self._app.test_client()
+        resposta = cliente.get(url, headers=headers)
+        resposta.get_data()
+        return resposta.status_code
+
+
+class ClienteHTTP:
+    # Uma conexão keep-alive por thread
+    def __init__(self, url_base):
+        partes = urlsplit(url_base)
+        self._classe = http.client.HTTPSConnection if partes.scheme == 'https' else http.client.HTTPConnection
+        self._endereco = partes.netloc
+        self._prefixo = partes.path.rstrip('/')
+        self._local = threading.local()
+
+    def get(self, url, headers):
+        for tentativa in range(2):
+            conexao = getattr(self._local, 'conexao', None)
+            if conexao is None:
+                conexao = self._local.conexao = self._classe(self._endereco, timeout=30)
+            try:
+                conexao.request('GET', self._prefixo + url, headers=headers)
+                resposta = conexao.getresponse()
+                resposta.read()
+                return resposta.status
+            except (http.client.HTTPException, ConnectionError):
+                conexao.close()
+                self._local.conexao = None
+                if tentativa:
+                    raise
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return 0.0
+    posicao = (len(valores_ordenados) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(valores_ordenados) - 1)
+    return valores_ordenados[inferior] + (valores_ordenados[superior] - valores_ordenados[inferior]) * (posicao - inferior)
+
+
+def medir_rota(cliente, tokens, usuarios, gerar_url, quantidade, concorrencia, semente):
+    def executar(indice):
+        aleatorio = random.Random(semente * 1_000_003 + indice)
+        usuario = aleatorio.choice(usuarios)
+        url = gerar_url(aleatorio, usuario)
+        headers = {'Authorization': f"Bearer {tokens[usuario['id_usuario']]}"}
+        inicio = time.perf_counter()
+        try:
+            status = cliente.get(url, headers)
+        except Exception:
+            status = None
+        return time.perf_counter() - inicio, status
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        resultados = list(executor.map(executar, range(quantidade)))
+    duracao_total = time.perf_counter() - inicio
+
+    latencias = sorted(d * 1000 for d, _ in resultados)
+    erros = sum(1 for _, status in resultados if status is None or status >= 400)
+    return {
+        'requisicoes': quantidade,
+        'erros': erros,
+        'p50_ms': round(percentil(latencias, 50), 3),
+        'p95_ms': round(percentil(latencias, 95), 3),
+        'p99_ms': round(percentil(latencias, 99), 3),
+        'media_ms': round(statistics.fmean(latencias), 3) if latencias else 0.0,
+        'maximo_ms': round(latencias[-1], 3) if latencias else 0.0,
+        'req_s': round(quantidade / duracao_total, 1) if duracao_total else 0.0,
+    }
+
+
+def _commit_atual():
+    try:
+        pasta = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pasta,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        sujo = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=pasta,
+                              capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-modificado' if sujo else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _variacao(atual, anterior):
+    if not anterior:
+        return ''
+    return f' ({(atual - anterior) / anterior * 100:+.0f}%)'
+
+
+def imprimir(resultado, anterior=None):
+    rotas_anteriores = (anterior or {}).get('rotas', {})
+    print(f"\n{'rota':<36} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9} {'erros':>6}")
+    for nome, dados in resultado['rotas'].items():
+        antes = rotas_anteriores.get(nome, {})
+        print(f"{nome:<36} {dados['p50_ms']:>9.2f} {dados['p95_ms']:>9.2f} {dados['p99_ms']:>9.2f} "
+              f"{dados['req_s']:>9.1f} {dados['erros']:>6}")
+        if antes:
+            print(f"{'  antes (' + str(anterior.get('commit')) + ')':<36} {antes['p50_ms']:>9.2f} {antes['p95_ms']:>9.2f} "
+                  f"{antes['p99_ms']:>9.2f} {antes['req_s']:>9.1f} {antes['erros']:>6}"
+                  f"   p95{_variacao(dados['p95_ms'], antes['p95_ms'])} req/s{_variacao(dados['req_s'], antes['req_s'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga das rotas de leitura')
+    parser.add_argument('--manifesto', required=True, help='JSON gerado pelo benchmarks.gerador')
+    parser.add_argument('--url', default=None, help='Servidor já rodando (ex.: http://127.0.0.1:5000)')
+    parser.add_argument('--requisicoes', type=int, default=500, help='Requisições por rota')
+    parser.add_argument('--concorrencia', type=int, default=8)
+    parser.add_argument('--aquecimento', type=int, default=20, help='Requisições descartadas por rota antes da medição')
+    parser.add_argument('--rotas', default=None, help='Filtra as rotas pelo nome (ex.: "negociac")')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', default=None, help='Arquivo JSON para salvar o resultado')
+    parser.add_argument('--comparar', default=None, help='Resultado anterior (JSON) para comparar')
+    args = parser.parse_args()
+
+    with open(args.manifesto, encoding='utf-8') as arquivo:
+        manifesto = json.load(arquivo)
+    anterior = None
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            anterior = json.load(arquivo)
+
+    # O ambiente é importado depois de ler o manifesto para usar o banco gerado
+    if not args.url:
+        os.environ['BENCH_DATABASE_URL'] = manifesto['banco']
+    from benchmarks.ambiente import app, PASTA_CHAMADA
+    from flask_jwt_extended import create_access_token
+
+    with app.app_context():
+        tokens = {u['id_usuario']: create_access_token(identity=str(u['id_usuario'])) for u in manifesto['usuarios']}
+    cliente = ClienteHTTP(args.url) if args.url else ClienteInterno(app)
+
+    resultado = {
+        'commit': _commit_atual(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'alvo': args.url or 'interno',
+        'parametros': {
+            'requisicoes': args.requisicoes, 'concorrencia': args.concorrencia,
+            'aquecimento': args.aquecimento, 'semente': args.semente,
+        },
+        'base': manifesto['tamanhos'],
+        'rotas': {},
+    }
+    for nome, usuarios, gerar_url in rotas(manifesto):
+        if args.rotas and args.rotas not in nome:
+            continue
+        if args.aquecimento:
+            medir_rota(cliente, tokens, usuarios, gerar_url, args.aquecimento, args.concorrencia, args.semente + 1)
+        resultado['rotas'][nome] = medir_rota(
+            cliente, tokens, usuarios, gerar_url, args.requisicoes, args.concorrencia, args.semente
+        )
+        print(f"{nome}: p95 {resultado['rotas'][nome]['p95_ms']:.2f} ms", flush=True)
+
+    imprimir(resultado, anterior)
+    if args.saida:
+        caminho = os.path.join(PASTA_CHAMADA, args.saida)
+        with open(caminho, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+        print(f'\nResultado salvo em {caminho}')
+
+
+if __name__ == '__main__':
+    main()
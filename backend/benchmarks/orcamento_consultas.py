@@ -0,0 +1,214 @@
+# Confere o orçamento de consultas (@orcamento_consultas) das rotas contra um
+# banco populado: cada rota é chamada com listas de vários itens, de modo que
+# um N+1 estoura o limite. Sai com código 1 se alguma rota passar do orçamento.
+# tests/test_orcamento_consultas.py roda a mesma conferência no pytest.
+#
+# Uso (a partir de backend/):
+#   python -m benchmarks.orcamento_consultas --itens 20
+import argparse
+import hashlib
+import json
+import sys
+from datetime import date, datetime, timedelta
+
+from benchmarks.ambiente import app, db, criar_tabelas
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from models import (
+    Usuario, EnderecoUsuario, Produto, Imagem, Categoria, Solicitacao,
+    SolicitacaoProdutoOfertado, Mensagem, StatusSolicitacao
+)
+from busca import reindexar_todos
+from localidade import reindexar_localidades
+from disponibilidade import recalcular_toda_disponibilidade
+from arquivamento import arquivar_negociacoes
+from metricas import OrcamentoConsultasExcedido
+
+
+def popular(qtd_itens):
+    troca = Categoria(nome_categoria='TROCA', descricao='Troca')
+    doacao = Categoria(nome_categoria='DOAÇÃO', descricao='Doação')
+    db.session.add_all([troca, doacao])
+    usuarios = []
+    for nome in ('dono', 'interessado'):
+        usuario = Usuario(nome_usuario=nome, telefone='0', email=f'{nome}@orcamento',
+                          password_hash=generate_password_hash('123', method='pbkdf2:sha256:1000'),
+                          data_nascimento=date(2000, 1, 1))
+        usuario.enderecos_usuario.append(EnderecoUsuario(cep='77000-000', bairro='Centro', rua='Rua', numero='1',
+                                                         cidade='Palmas', estado='TO'))
+        usuarios.append(usuario)
+    db.session.add_all(usuarios)
+    db.session.flush()
+    dono, interessado = usuarios
+
+    def produtos(usuario, categoria, quantidade, prefixo):
+        lista = []
+        for i in range(quantidade):
+            produto = Produto(nome_produto=f'{prefixo} bicicleta {i}', descricao='Produto para orçamento de consultas',
+                              id_usuario=usuario.id_usuario, id_categoria=categoria.id_categoria, valor=10)
+            produto.imagens = [Imagem(url_imagem=f'uploads/{prefixo}_{i}_{j}.jpg') for j in range(2)]
+            lista.append(produto)
+        db.session.add_all(lista)
+        return lista
+
+    do_dono = produtos(dono, troca, qtd_itens, 'dono')
+    produtos(dono, doacao, qtd_itens // 2, 'doacao')
+    do_interessado = produtos(interessado, troca, qtd_itens * 2, 'interessado')
+    db.session.flush()
+
+    solicitacoes = []
+    for i, desejado in enumerate(do_dono[:qtd_itens // 2]):
+        solicitacao = Solicitacao(id_usuario_solicitante=interessado.id_usuario, id_produto_desejado=desejado.id_produto,
+                                  status=StatusSolicitacao.PENDENTE)
+        db.session.add(solicitacao)
+        db.session.flush()
+        db.session.add_all([
+            SolicitacaoProdutoOfertado(id_solicitacao=solicitacao.id_solicitacao, id_produto=p.id_produto)
+            for p in do_interessado[2 * i:2 * i + 2]
+        ])
+        solicitacoes.append(solicitacao)
+    # Ainda em rascunho gravado (primeira mensagem enviada), para PUT /pendente
+    processando = Solicitacao(id_usuario_solicitante=interessado.id_usuario, id_produto_desejado=do_dono[-4].id_produto,
+                              status=StatusSolicitacao.PROCESSANDO)
+    db.session.add(processando)
+    for i in range(qtd_itens * 2):
+        autor = dono if i % 2 else interessado
+        db.session.add(Mensagem(conteudo_mensagem=f'Mensagem {i}', id_usuario=autor.id_usuario,
+                                id_solicitacao=solicitacoes[0].id_solicitacao))
+    # Negociação cancelada há tempo, que vai para o arquivo
+    antiga = datetime.utcnow() - timedelta(days=365)
+    arquivada = solicitacoes[1]
+    arquivada.status = StatusSolicitacao.CANCELADA
+    arquivada.data_solicitacao = antiga
+    for i in range(qtd_itens):
+        db.session.add(Mensagem(conteudo_mensagem=f'Mensagem antiga {i}', id_usuario=interessado.id_usuario,
+                                id_solicitacao=arquivada.id_solicitacao, data_envio=antiga))
+    db.session.commit()
+    reindexar_todos()
+    db.session.commit()
+    reindexar_localidades()
+    recalcular_toda_disponibilidade()
+    id_arquivada = arquivada.id_solicitacao
+    arquivar_negociacoes(dias=30)
+
+    return {
+        'dono': dono.id_usuario,
+        'interessado': interessado.id_usuario,
+        'produto': do_dono[0].id_produto,
+        # Produtos sem solicitação, para as rotas que criam solicitações
+        'produtos_livres': [p.id_produto for p in do_dono[-3:]],
+        'ofertados_livres': [p.id_produto for p in do_interessado[-3:]],
+        'solicitacao': solicitacoes[0].id_solicitacao,
+        'solicitacao_arquivada': id_arquivada,
+        # PENDENTES sem outro uso, para aprovar, recusar e cancelar
+        'pendentes': [s.id_solicitacao for s in solicitacoes[2:5]],
+        'processando': processando.id_solicitacao,
+        'ofertado_processando': do_interessado[-4].id_produto,
+    }
+
+
+def requisicoes(ids):
+    # (usuário, método, url, json)
+    return [
+        ('interessado', 'GET', '/produtos', None),
+        ('interessado', 'GET', '/produtos?categoria=TROCA&cidade=Palmas', None),
+        ('interessado', 'GET', '/produtos?categoria=TROCA&perto=todos', None),
+        ('interessado', 'GET', '/produtos?fields=nome_produto,valor&expand=', None),
+        ('interessado', 'GET', '/produtos/busca?q=bicicleta', None),
+        ('dono', 'GET', '/produtos/usuario', None),
+        ('dono', 'GET', '/produtos/usuario?expand=imagens', None),
+        ('interessado', 'GET', '/usuario/negociacoes', None),
+        ('interessado', 'GET', '/usuario/negociacoes?fields=status,produtos_ofertados&expand=usuario_solicitante', None),
+        ('interessado', 'GET', f"/produto/{ids['produto']}", None),
+        ('interessado', 'GET', f"/produto/{ids['produto']}?fields=nome_produto&expand=categoria", None),
+        ('interessado', 'GET', f"/solicitacao/{ids['solicitacao']}/mensagens", None),
+        ('interessado', 'GET', f"/solicitacao/{ids['solicitacao']}/eventos/token", None),
+        ('interessado', 'GET', f"/negociacao/{ids['produto']}", None),
+        ('interessado', 'GET', f"/negociacao/solicitacao/{ids['solicitacao']}", None),
+        ('interessado', 'GET', f"/negociacao/solicitacao/{ids['solicitacao_arquivada']}", None),
+        ('interessado', 'GET', f"/solicitacao/{ids['solicitacao_arquivada']}/mensagens", None),
+        # Produto sem negociação: rascunho, sem gravar nada
+        ('interessado', 'GET', f"/negociacao/{ids['produtos_livres'][0]}", None),
+        ('interessado', 'POST', '/mensagem', {'id_solicitacao': ids['solicitacao'], 'conteudo_mensagem': 'Olá'}),
+        # Repetição com a mesma Idempotency-Key: a resposta gravada é reenviada
+        ('interessado', 'POST', '/mensagem', {'id_solicitacao': ids['solicitacao'], 'conteudo_mensagem': 'Olá'}),
+        # Primeira mensagem do rascunho: grava a solicitação PROCESSANDO
+        ('interessado', 'POST', '/mensagem', {'id_produto_desejado': ids['produtos_livres'][0], 'conteudo_mensagem': 'Olá'}),
+        ('interessado', 'POST', '/solicitacao', {'id_produto_desejado': ids['produtos_livres'][0], 'tipo_solicitacao': 'TROCA',
+                                                 'id_produto_ofertado': [ids['ofertados_livres'][0]]}),
+        ('interessado', 'POST', '/solicitacoes', {'solicitacoes': [
+            {'id_produto_desejado': desejado, 'id_produto_ofertado': [ofertado]}
+            for desejado, ofertado in zip(ids['produtos_livres'][1:], ids['ofertados_livres'][1:])
+        ]}),
+        ('dono', 'PUT', f"/solicitacao/{ids['pendentes'][0]}/acao", {'status': 'APROVADA'}),
+        ('dono', 'PUT', f"/solicitacao/{ids['pendentes'][1]}/acao", {'status': 'RECUSADA'}),
+        ('interessado', 'DELETE', f"/solicitacao/{ids['pendentes'][2]}", None),
+        ('interessado', 'PUT', f"/solicitacao/{ids['processando']}/pendente", {'id_produto_ofertado': [ids['ofertado_processando']]}),
+    ]
+
+
+def preparar(qtd_itens):
+    # Cria e popula o banco temporário; devolve os ids e os tokens dos dois usuários
+    app.testing = True
+    with app.app_context():
+        criar_tabelas()
+        ids = popular(qtd_itens)
+        tokens = {nome: create_access_token(identity=str(ids[nome])) for nome in ('dono', 'interessado')}
+    return ids, tokens
+
+
+def conferir(ids, tokens):
+    # Executa requisicoes(ids) em ordem. Para cada uma produz
+    # (método, url, resposta, consultas, orçamento, erro); erro é a
+    # OrcamentoConsultasExcedido levantada pela rota, e então a resposta é None.
+    consultas = []
+    contar = lambda *a: consultas.append(1)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', contar)
+    cliente = app.test_client()
+    try:
+        for usuario, metodo, url, corpo in requisicoes(ids):
+            consultas.clear()
+            cabecalhos = {'Authorization': f'Bearer {tokens[usuario]}'}
+            if metodo == 'POST':
+                # Requisições iguais usam a mesma chave, como um cliente repetindo o envio
+                cabecalhos['Idempotency-Key'] = hashlib.sha256(f'{url}|{json.dumps(corpo, sort_keys=True)}'.encode()).hexdigest()
+            endpoint = app.url_map.bind('').match(url.split('?')[0], method=metodo)[0]
+            maximo = getattr(app.view_functions[endpoint], 'orcamento_consultas', None)
+            try:
+                resposta = cliente.open(url, method=metodo, json=corpo, headers=cabecalhos)
+            except OrcamentoConsultasExcedido as e:
+                yield metodo, url, None, len(consultas), maximo, e
+                continue
+            yield metodo, url, resposta, len(consultas), maximo, None
+    finally:
+        event.remove(engine, 'before_cursor_execute', contar)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Confere o orçamento de consultas das rotas')
+    parser.add_argument('--itens', type=int, default=20, help='Tamanho das listas do banco de teste')
+    args = parser.parse_args()
+    if args.itens < 10:
+        # popular() precisa de ao menos 5 solicitações pendentes do interessado
+        parser.error('--itens deve ser pelo menos 10')
+
+    falhas = 0
+    for metodo, url, resposta, consultas, maximo, erro in conferir(*preparar(args.itens)):
+        if erro is not None:
+            falhas += 1
+            print(f'FALHOU   {erro}\n')
+            continue
+        repetida = ' (repetida)' if resposta.headers.get('Idempotent-Replayed') else ''
+        print(f'{resposta.status_code}  {consultas:3d}/{maximo if maximo is not None else "-":>3}  {metodo} {url}{repetida}')
+        if resposta.status_code >= 400:
+            falhas += 1
+    sys.exit(1 if falhas else 0)
+
+
+if __name__ == '__main__':
+    main()
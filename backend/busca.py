@@ -0,0 +1,120 @@
+import re
+import unicodedata
+
+from sqlalchemy import case, func, or_, and_
+
+from models import db, Produto, ProdutoTermo
+
+# Índice invertido de busca: cada termo (minúsculo e sem acento) do nome e da
+# descrição de um produto vira uma linha em PRODUTO_TERMO. A busca consulta
+# apenas os termos pedidos pelo índice (termo, id_produto), sem LIKE '%x%'.
+
+PESO_NOME = 3
+PESO_DESCRICAO = 1
+TAMANHO_MINIMO_TERMO = 2
+TAMANHO_MAXIMO_TERMO = 50
+MAXIMO_TERMOS_BUSCA = 8
+
+STOPWORDS = {
+    'a', 'o', 'as', 'os', 'de', 'da', 'do', 'das', 'dos', 'e', 'em', 'na', 'no',
+    'nas', 'nos', 'um', 'uma', 'uns', 'umas', 'para', 'pra', 'por', 'com', 'sem',
+    'que', 'se', 'ao', 'aos'
+}
+
+
+def normalizar_texto(texto):
+    # Minúsculas e sem acentos, para comparar "Doação" com "doacao"
+    texto = unicodedata.normalize('NFD', texto or '')
+    return ''.join(c for c in texto if unicodedata.category(c) != 'Mn').lower().strip()
+
+
+def tokenizar(texto):
+    termos = re.findall(r'[a-z0-9]+', normalizar_texto(texto))
+    return [
+        termo[:TAMANHO_MAXIMO_TERMO] for termo in termos
+        if len(termo) >= TAMANHO_MINIMO_TERMO and termo not in STOPWORDS
+    ]
+
+
+def extrair_termos(nome, descricao):
+    # Retorna {termo: peso}; termos que aparecem no nome valem mais
+    pesos = {}
+    for termo in set(tokenizar(nome)):
+        pesos[termo] = pesos.get(termo, 0) + PESO_NOME
+    for termo in set(tokenizar(descricao)):
+        pesos[termo] = pesos.get(termo, 0) + PESO_DESCRICAO
+    return pesos
+
+
+def remover_do_indice(id_produto):
+    db.session.execute(db.delete(ProdutoTermo).where(ProdutoTermo.id_produto == id_produto))
+
+
+def indexar_produto(produto):
+    # Atualiza os termos de um único produto. Não faz commit, para que o índice
+    # acompanhe a mesma transação que grava o produto.
+    remover_do_indice(produto.id_produto)
+    linhas = [
+        {'termo': termo, 'id_produto': produto.id_produto, 'peso': peso}
+        for termo, peso in extrair_termos(produto.nome_produto, produto.descricao).items()
+    ]
+    if linhas:
+        db.session.execute(db.insert(ProdutoTermo), linhas)
+
+
+def reindexar_todos(tamanho_lote=500):
+    ultimo_id = 0
+    while True:
+        produtos = db.session.execute(
+            db.select(Produto.id_produto, Produto.nome_produto, Produto.descricao)
+            .where(Produto.id_produto > ultimo_id)
+            .order_by(Produto.id_produto)
+            .limit(tamanho_lote)
+        ).all()
+        if not produtos:
+            break
+        ids = [p.id_produto for p in produtos]
+        db.session.execute(db.delete(ProdutoTermo).where(ProdutoTermo.id_produto.in_(ids)))
+        linhas = [
+            {'termo': termo, 'id_produto': p.id_produto, 'peso': peso}
+            for p in produtos
+            for termo, peso in extrair_termos(p.nome_produto, p.descricao).items()
+        ]
+        if linhas:
+            db.session.execute(db.insert(ProdutoTermo), linhas)
+        db.session.commit()
+        ultimo_id = ids[-1]
+
+
+def consulta_busca(texto):
+    # Monta a subconsulta de ranking (id_produto, pontos) para o texto buscado.
+    # Todos os termos precisam aparecer no produto; o último é tratado como
+    # prefixo para permitir buscar enquanto o usuário digita.
+    termos = list(dict.fromkeys(tokenizar(texto)))[:MAXIMO_TERMOS_BUSCA]
+    if not termos:
+        return None
+
+    *completos, ultimo = termos
+    condicoes = [ProdutoTermo.termo == termo for termo in completos] + [ProdutoTermo.termo.like(f'{ultimo}%')]
+    # Peso de cada termo da busca no produto: o da melhor linha do índice que o
+    # satisfaz (0 se nenhuma). Uma mesma linha pode satisfazer um termo e o
+    # prefixo ("bola bo"), e várias linhas com o prefixo contam uma vez só.
+    pesos = [func.max(case((condicao, ProdutoTermo.peso), else_=0)) for condicao in condicoes]
+
+    ranking = db.select(
+        ProdutoTermo.id_produto.label('id_produto'),
+        sum(pesos[1:], pesos[0]).label('pontos')
+    ).where(or_(*condicoes)).group_by(ProdutoTermo.id_produto)
+    if completos:
+        ranking = ranking.having(and_(*[peso > 0 for peso in pesos]))
+    return ranking.subquery()
+
+
+def aplicar_cursor_ranking(query, coluna_pontos, posicao):
+    if posicao:
+        pontos, id_produto = posicao
+        query = query.filter(or_(
+            coluna_pontos < pontos,
+            and_(coluna_pontos == pontos, Produto.id_produto < id_produto)
+        ))
+    return query.order_by(coluna_pontos.desc(), Produto.id_produto.desc())
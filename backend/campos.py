@@ -0,0 +1,178 @@
+from flask import request
+from sqlalchemy.orm import joinedload, selectinload, lazyload
+
+from models import Produto
+from metricas import medir_serializacao
+
+# Seleção de campos (?fields=) e de expansões (?expand=) nas rotas de leitura de
+# produtos e negociações. Sem os parâmetros a resposta é a de sempre, com todos
+# os campos e relacionamentos.
+#
+#   expand  relacionamentos incluídos, com o nome da chave na resposta. Quando
+#           presente, só os listados entram; "a.b" expande b dentro de a (e
+#           implica a). expand= vazio não expande nada.
+#   fields  campos simples mantidos; "a.campo" restringe os campos do
+#           relacionamento a. A chave (id_produto, id_solicitacao) sempre vem.
+#
+# Ex.: /produtos?fields=nome_produto,valor&expand=imagens
+#      /usuario/negociacoes?expand=produto_desejado.imagens&fields=status,produto_desejado.nome_produto
+#
+# As rotas montam as loader options e as consultas a partir da seleção:
+# relacionamentos não pedidos não são consultados (opcoes_produto,
+# negociacoes_leitura). Nomes desconhecidos levantam CamposInvalidos (400).
+
+
+class CamposInvalidos(ValueError):
+    pass
+
+
+class Esquema:
+    def __init__(self, nome, chave, campos, expansoes=None):
+        self.nome = nome
+        self.chave = chave
+        self.campos = tuple(campos)
+        # nome na resposta -> Esquema do relacionamento (None: sem campos selecionáveis)
+        self.expansoes = dict(expansoes or {})
+
+    def com(self, campos=(), expansoes=None):
+        # Cópia com campos e expansões próprios de uma rota
+        return Esquema(self.nome, self.chave, self.campos + tuple(campos), {**self.expansoes, **(expansoes or {})})
+
+
+class Selecao:
+    def __init__(self, esquema, campos, expansoes):
+        self.esquema = esquema
+        self.campos = campos  # set, ou None para todos
+        self.expansoes = expansoes  # nome -> Selecao do relacionamento (ou None)
+
+    def inclui(self, campo):
+        return self.campos is None or campo in self.campos
+
+    def expande(self, relacao):
+        return relacao in self.expansoes
+
+    def de(self, relacao):
+        return self.expansoes.get(relacao)
+
+    def filtrar(self, dados):
+        # Remove os campos do esquema não pedidos; expansões e extras da rota ficam
+        if self.campos is None:
+            return dados
+        return {chave: valor for chave, valor in dados.items() if chave in self.campos or chave not in self.esquema.campos}
+
+    def _identidade(self):
+        return (
+            id(self.esquema),
+            None if self.campos is None else frozenset(self.campos),
+            tuple(sorted((nome, sub._identidade() if sub else None) for nome, sub in self.expansoes.items()))
+        )
+
+    def __eq__(self, outra):
+        return isinstance(outra, Selecao) and self._identidade() == outra._identidade()
+
+    def __hash__(self):
+        return hash(self._identidade())
+
+
+def _itens(valores):
+    # "a,b" e ?x=a&x=b são equivalentes; None quando o parâmetro não foi enviado
+    if not valores:
+        return None
+    return [item.strip() for valor in valores for item in valor.split(',') if item.strip()]
+
+
+def _esquema_do_caminho(esquema, caminho, parametro, item):
+    for nome in caminho:
+        if nome not in esquema.expansoes:
+            raise CamposInvalidos(
+                f"Expansão '{nome}' inválida em '{parametro}={item}'. "
+                f"Disponíveis em {esquema.nome}: {', '.join(esquema.expansoes) or 'nenhuma'}"
+            )
+        esquema = esquema.expansoes[nome]
+        if esquema is None and nome != caminho[-1]:
+            raise CamposInvalidos(f"'{nome}' não tem campos para expandir em '{parametro}={item}'")
+    return esquema
+
+
+def _montar(esquema, caminho, campos, arvore):
+    # arvore: expansões pedidas abaixo deste nível ({nome: subárvore}), ou None para todas
+    todas = arvore is None
+    if todas:
+        arvore = dict.fromkeys(esquema.expansoes)
+    selecionados = campos.get(caminho)
+    expansoes = {}
+    for nome, subarvore in arvore.items():
+        sub = esquema.expansoes[nome]
+        if sub is None:
+            expansoes[nome] = None
+        else:
+            expansoes[nome] = _montar(sub, caminho + (nome,), campos, None if todas else subarvore)
+    return Selecao(esquema, None if selecionados is None else selecionados | {esquema.chave}, expansoes)
+
+
+def montar_selecao(esquema, fields=None, expand=None):
+    # fields e expand: listas com os valores dos parâmetros (ou None se ausentes)
+    campos = {}
+    for item in _itens(fields) or []:
+        *caminho, campo = item.split('.')
+        sub = _esquema_do_caminho(esquema, caminho, 'fields', item)
+        if sub is None or campo not in sub.campos:
+            disponiveis = ', '.join(sub.campos) if sub else 'nenhum'
+            raise CamposInvalidos(f"Campo '{item}' inválido em 'fields'. Disponíveis: {disponiveis}")
+        campos.setdefault(tuple(caminho), set()).add(campo)
+
+    arvore = None
+    itens_expand = _itens(expand)
+    if itens_expand is not None:
+        arvore = {}
+        for item in itens_expand:
+            caminho = item.split('.')
+            _esquema_do_caminho(esquema, caminho, 'expand', item)
+            no = arvore
+            for nome in caminho:
+                no = no.setdefault(nome, {})
+    return _montar(esquema, (), campos, arvore)
+
+
+def selecao_da_requisicao(esquema):
+    return montar_selecao(esquema, request.args.getlist('fields') or None, request.args.getlist('expand') or None)
+
+
+ESQUEMA_PRODUTO = Esquema(
+    'produto', 'id_produto',
+    ('id_produto', 'nome_produto', 'descricao', 'id_usuario', 'data_cadastro', 'status', 'quantidade', 'valor'),
+    {'proprietario_details': None, 'categoria': None, 'imagens': None}
+)
+
+# /produto/<id>: situação da solicitação do usuário logado (uma consulta a mais)
+ESQUEMA_PRODUTO_DETALHE = ESQUEMA_PRODUTO.com(campos=('status_solicitacao',))
+
+# /produtos/usuario: solicitações PENDENTES recebidas por cada produto
+ESQUEMA_MEUS_PRODUTOS = ESQUEMA_PRODUTO.com(expansoes={'solicitacoes_pendentes_nele': None})
+
+ESQUEMA_NEGOCIACAO = Esquema(
+    'negociação', 'id_solicitacao',
+    ('id_solicitacao', 'status', 'data_solicitacao', 'id_usuario_solicitante', 'id_produto_desejado',
+     'id_transacao', 'produtos_ofertados', 'tipo_solicitacao'),
+    {'usuario_solicitante': None, 'produto_desejado': ESQUEMA_PRODUTO, 'produtos_ofertados_details': ESQUEMA_PRODUTO}
+)
+
+
+def opcoes_produto(selecao):
+    # Loader options de Produto para a seleção. Produto.imagens é lazy="selectin"
+    # no modelo, então precisa de lazyload explícito para não ser consultada.
+    opcoes = [selectinload(Produto.imagens) if selecao.expande('imagens') else lazyload(Produto.imagens)]
+    if selecao.expande('proprietario_details'):
+        opcoes.append(joinedload(Produto.proprietario))
+    if selecao.expande('categoria'):
+        opcoes.append(selectinload(Produto.categoria))
+    return opcoes
+
+
+@medir_serializacao
+def produto_para_dict(produto, selecao):
+    return selecao.filtrar(produto.to_dict(
+        include_owner=selecao.expande('proprietario_details'),
+        include_categoria=selecao.expande('categoria'),
+        include_imagens=selecao.expande('imagens')
+    ))
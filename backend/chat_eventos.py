@@ -0,0 +1,231 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from models import db, Mensagem, Usuario, VersaoTabela
+from mensagens import linha_para_dict
+
+# Distribuição das novas mensagens do chat para as conexões SSE abertas.
+#
+# Cada processo da API tem uma CentralMensagens com uma única thread que lê as
+# novas mensagens só das conversas com alguém conectado naquele processo
+# (id_solicitacao IN (...) pelo índice idx_mensagem_solicitacao_id), nunca a
+# tabela toda. Assim mensagens gravadas por qualquer worker chegam a todos, sem
+# um serviço externo e com uma consulta por intervalo por processo, não uma por
+# cliente. Entre as leituras a thread só confere a versão de MENSAGEM em
+# VERSAO_TABELA (uma linha, pela chave primária), incrementada depois de cada
+# commit (ver versoes.py): sem mensagem nova não há leitura de MENSAGEM. A
+# cada INTERVALO_CONSULTA_COMPLETA a leitura é feita mesmo assim, caso um
+# incremento tenha falhado. enviar_mensagem() chama notificar() após o commit
+# para acordar a thread na hora.
+#
+# Cada conversa tem seu cursor (piso): o maior id_mensagem no primeiro
+# assinar(), que avança conforme as mensagens são vistas. Mensagens vistas há
+# menos de TEMPO_LIMITE_LACUNA segundos ficam acima do piso e são relidas, para
+# pegar um ID menor que ainda não tinha feito commit. O histórico de cada
+# conexão (pendentes) é lido pela rota depois de assinar(); o que for gravado a
+# partir daí chega pela fila, e o stream descarta os repetidos.
+#
+# Cada conexão ocupa uma thread (ou greenlet) por até DURACAO_MAXIMA_STREAM
+# segundos, sem conexão do banco (a rota a devolve antes do stream).
+# CHAT_STREAMS_MAXIMO limita as conexões abertas por processo; acima disso a
+# rota responde 503 e o cliente busca por GET /solicitacao/<id>/mensagens. Com
+# gthread, cada processo precisa de CHAT_STREAMS_MAXIMO threads para os streams
+# mais as das demais requisições (ex.: CHAT_STREAMS_MAXIMO=100 com
+# gunicorn --worker-class gthread --threads 120 deixa 20 para o resto); com
+# gevent (--worker-class gevent --worker-connections 1000) cada stream custa
+# só um greenlet.
+#
+# O EventSource não envia cabeçalhos. Em vez do JWT, a URL leva um token
+# próprio do stream (criar_token_stream), que só abre os eventos daquela
+# conversa e expira em CHAT_TOKEN_SEGUNDOS; o cliente pede um novo a cada conexão.
+
+INTERVALO_CONSULTA = 1.0       # segundos entre consultas quando não há notificação
+INTERVALO_CONSULTA_COMPLETA = 15.0  # lê MENSAGEM mesmo sem mudança de versão
+TEMPO_LIMITE_LACUNA = 10.0     # por quanto tempo esperar IDs que ainda não foram commitados
+INTERVALO_KEEPALIVE = 15.0     # comentário enviado para manter a conexão aberta
+DURACAO_MAXIMA_STREAM = 300.0  # o cliente reconecta com um novo token e apos_id
+LOTE_CONSULTA = 500            # máximo de mensagens lidas por consulta
+
+
+def _serializador():
+    return URLSafeTimedSerializer(current_app.config['JWT_SECRET_KEY'], salt='chat-eventos')
+
+
+def criar_token_stream(id_usuario, id_solicitacao):
+    return _serializador().dumps({'u': id_usuario, 's': id_solicitacao})
+
+
+def ler_token_stream(token, id_solicitacao):
+    # Retorna o id do usuário, ou None se o token não é válido para esta conversa
+    try:
+        dados = _serializador().loads(token, max_age=current_app.config['CHAT_TOKEN_SEGUNDOS'])
+    except (BadSignature, SignatureExpired):
+        return None
+    if not isinstance(dados, dict) or dados.get('s') != id_solicitacao:
+        return None
+    return dados.get('u')
+
+
+def formatar_evento(mensagem):
+    dados = json.dumps(mensagem, ensure_ascii=False)
+    return f"id: {mensagem['id_mensagem']}\nevent: mensagem\ndata: {dados}\n\n"
+
+
+class _Conversa:
+    __slots__ = ('filas', 'piso', 'recentes')
+
+    def __init__(self, piso):
+        self.filas = set()
+        self.piso = piso    # todas as mensagens até aqui já foram entregues (ou desistimos delas)
+        self.recentes = {}  # id_mensagem acima do piso já entregue -> instante
+
+
+class CentralMensagens:
+    def __init__(self, app=None):
+        self.app = None
+        self._trava = threading.Lock()
+        self._conversas = {}  # id_solicitacao -> _Conversa
+        self._acordar = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('CHAT_STREAMS_MAXIMO', int(os.environ.get('CHAT_STREAMS_MAXIMO', 100)))
+        app.config.setdefault('CHAT_TOKEN_SEGUNDOS', int(os.environ.get('CHAT_TOKEN_SEGUNDOS', 60)))
+        app.extensions['central_mensagens'] = self
+
+    def assinar(self, id_solicitacao):
+        # Chamar antes de ler o histórico da conversa. Retorna None se o limite
+        # de conexões do processo foi atingido.
+        # O piso é lido sempre (uma consulta pelo índice): a conversa pode ser
+        # criada ou removida por outra conexão entre a leitura e a trava
+        piso = db.session.execute(
+            db.select(db.func.max(Mensagem.id_mensagem)).where(Mensagem.id_solicitacao == id_solicitacao)
+        ).scalar() or 0
+        fila = queue.Queue()
+        with self._trava:
+            if sum(len(c.filas) for c in self._conversas.values()) >= self.app.config['CHAT_STREAMS_MAXIMO']:
+                return None
+            conversa = self._conversas.get(id_solicitacao)
+            if conversa is None:
+                conversa = self._conversas[id_solicitacao] = _Conversa(piso)
+            conversa.filas.add(fila)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name='central-mensagens', daemon=True)
+                self._thread.start()
+        return fila
+
+    def cancelar(self, id_solicitacao, fila):
+        with self._trava:
+            conversa = self._conversas.get(id_solicitacao)
+            if conversa:
+                conversa.filas.discard(fila)
+                if not conversa.filas:
+                    del self._conversas[id_solicitacao]
+
+    def notificar(self):
+        self._acordar.set()
+
+    def _executar(self):
+        with self.app.app_context():
+            versao_lida = None
+            ultima_completa = 0.0
+            forcar = True
+            while True:
+                with self._trava:
+                    if not self._conversas:
+                        # Ninguém conectado: a thread termina e é recriada no próximo assinar()
+                        self._thread = None
+                        return
+                    solicitacoes = list(self._conversas)
+                try:
+                    versao = db.session.execute(
+                        db.select(VersaoTabela.versao).where(VersaoTabela.nome == Mensagem.__tablename__)
+                    ).scalar()
+                    agora = time.monotonic()
+                    if forcar or versao != versao_lida or agora - ultima_completa >= INTERVALO_CONSULTA_COMPLETA:
+                        self._consultar(solicitacoes)
+                        versao_lida = versao
+                        ultima_completa = agora
+                except Exception as e:
+                    self.app.logger.error(f"Erro ao consultar novas mensagens: {e}")
+                finally:
+                    db.session.remove()
+                # Com mensagens ainda dentro da janela de lacunas, a próxima volta relê
+                with self._trava:
+                    forcar = any(c.recentes for c in self._conversas.values())
+                forcar = self._acordar.wait(INTERVALO_CONSULTA) or forcar
+                self._acordar.clear()
+
+    def _consultar(self, solicitacoes):
+        with self._trava:
+            pisos = {s: self._conversas[s].piso for s in solicitacoes if s in self._conversas}
+        if not pisos:
+            return
+        agora = time.monotonic()
+        apos = min(pisos.values())
+        novas = []
+        while True:
+            linhas = db.session.execute(
+                db.select(
+                    Mensagem.id_mensagem, Mensagem.conteudo_mensagem, Mensagem.id_usuario,
+                    Mensagem.data_envio, Mensagem.id_solicitacao, Usuario.nome_usuario
+                )
+                .join(Usuario, Mensagem.id_usuario == Usuario.id_usuario)
+                .where(Mensagem.id_solicitacao.in_(list(pisos)), Mensagem.id_mensagem > apos)
+                .order_by(Mensagem.id_mensagem)
+                .limit(LOTE_CONSULTA)
+            ).all()
+            novas.extend(linhas)
+            if len(linhas) < LOTE_CONSULTA:
+                break
+            apos = linhas[-1].id_mensagem
+
+        with self._trava:
+            for linha in novas:
+                conversa = self._conversas.get(linha.id_solicitacao)
+                if conversa is None or linha.id_mensagem <= conversa.piso or linha.id_mensagem in conversa.recentes:
+                    continue
+                conversa.recentes[linha.id_mensagem] = agora
+                mensagem = linha_para_dict(linha)
+                for fila in conversa.filas:
+                    fila.put(mensagem)
+            # O piso sobe até a maior mensagem vista há mais de TEMPO_LIMITE_LACUNA:
+            # um ID menor que ainda não apareceu a essa altura não vai mais ser esperado
+            for conversa in self._conversas.values():
+                antigas = [i for i, t in conversa.recentes.items() if agora - t >= TEMPO_LIMITE_LACUNA]
+                if antigas:
+                    conversa.piso = max(conversa.piso, max(antigas))
+                    conversa.recentes = {i: t for i, t in conversa.recentes.items() if i > conversa.piso}
+
+    def stream(self, id_solicitacao, fila, pendentes, apos_id):
+        # Gerador da resposta SSE. Não usa o banco: as mensagens anteriores
+        # (pendentes) já foram lidas pela rota antes do início do stream.
+        # Mensagens da fila até apos_id o cliente já tem.
+        enviados = set()
+        inicio = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            for mensagem in pendentes:
+                enviados.add(mensagem['id_mensagem'])
+                yield formatar_evento(mensagem)
+            while time.monotonic() - inicio < DURACAO_MAXIMA_STREAM:
+                try:
+                    mensagem = fila.get(timeout=INTERVALO_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if mensagem['id_mensagem'] <= apos_id or mensagem['id_mensagem'] in enviados:
+                    continue
+                enviados.add(mensagem['id_mensagem'])
+                yield formatar_evento(mensagem)
+        finally:
+            self.cancelar(id_solicitacao, fila)
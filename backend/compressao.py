@@ -0,0 +1,88 @@
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # Opcional: sem ele só gzip é oferecido
+    brotli = None
+
+# Compressão das respostas, negociada pelo Accept-Encoding do cliente. As
+# listagens JSON repetem as mesmas chaves em cada item e encolhem mais de 10
+# vezes (python -m benchmarks.bench_json); para o app em rede móvel isso pesa
+# mais que o tempo de CPU gasto.
+#
+# Escolhe br (se o pacote brotli estiver instalado) ou gzip conforme a
+# preferência (q) do cliente; empate favorece br. Não comprime:
+#   - respostas menores que COMPRESSAO_MINIMO_BYTES;
+#   - tipos fora de COMPRESSAO_TIPOS (imagens já são comprimidas);
+#   - streams (SSE) e arquivos enviados direto do disco (send_from_directory);
+#   - respostas que já têm Content-Encoding ou Cache-Control: no-transform.
+# Vary: Accept-Encoding é sempre enviado nos tipos comprimíveis, para que
+# caches não entreguem a versão comprimida a quem não pediu.
+#
+# Os ETags de com_etag são fracos (versoes.py): identificam o conteúdo, não os
+# bytes, então valem para qualquer codificação.
+#
+# O after_request é registrado depois do de Metricas e por isso roda antes
+# dele: ecotroca_resposta_bytes_total conta os bytes já comprimidos.
+
+TIPOS_PADRAO = 'application/json,text/plain,text/html,text/css,text/javascript,application/javascript'
+
+
+class Compressao:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('COMPRESSAO_ATIVA', os.environ.get('COMPRESSAO_ATIVA', '1') not in ('0', 'false', 'False'))
+        app.config.setdefault('COMPRESSAO_MINIMO_BYTES', int(os.environ.get('COMPRESSAO_MINIMO_BYTES', 1024)))
+        # Níveis baixos: quase toda a redução pelo menor custo de CPU
+        app.config.setdefault('COMPRESSAO_NIVEL_GZIP', int(os.environ.get('COMPRESSAO_NIVEL_GZIP', 5)))
+        app.config.setdefault('COMPRESSAO_NIVEL_BROTLI', int(os.environ.get('COMPRESSAO_NIVEL_BROTLI', 4)))
+        app.config.setdefault('COMPRESSAO_TIPOS', os.environ.get('COMPRESSAO_TIPOS', TIPOS_PADRAO))
+        self._tipos = {tipo.strip() for tipo in app.config['COMPRESSAO_TIPOS'].split(',') if tipo.strip()}
+        self.codificacoes = ('br', 'gzip') if brotli is not None else ('gzip',)
+        app.after_request(self._comprimir)
+        app.extensions['compressao'] = self
+
+    def escolher_codificacao(self, aceitas):
+        # Melhor codificação suportada para um Accept-Encoding já interpretado
+        # (request.accept_encodings), ou None para enviar sem compressão
+        melhor, melhor_q = None, 0
+        for codificacao in self.codificacoes:
+            q = aceitas[codificacao]
+            if q > melhor_q:
+                melhor, melhor_q = codificacao, q
+        return melhor
+
+    def comprimir(self, dados, codificacao):
+        if codificacao == 'br':
+            return brotli.compress(dados, quality=self.app.config['COMPRESSAO_NIVEL_BROTLI'])
+        return gzip.compress(dados, compresslevel=self.app.config['COMPRESSAO_NIVEL_GZIP'], mtime=0)
+
+    def _comprimir(self, resposta):
+        if not self.app.config['COMPRESSAO_ATIVA'] or resposta.mimetype not in self._tipos:
+            return resposta
+        resposta.vary.add('Accept-Encoding')
+        if (resposta.direct_passthrough or resposta.is_streamed
+                or not 200 <= resposta.status_code < 300 or resposta.status_code == 204
+                or 'Content-Encoding' in resposta.headers
+                or 'no-transform' in resposta.headers.get('Cache-Control', '')):
+            return resposta
+        codificacao = self.escolher_codificacao(request.accept_encodings)
+        if codificacao is None:
+            return resposta
+        dados = resposta.get_data()
+        if len(dados) < self.app.config['COMPRESSAO_MINIMO_BYTES']:
+            return resposta
+        comprimido = self.comprimir(dados, codificacao)
+        if len(comprimido) >= len(dados):
+            return resposta
+        resposta.set_data(comprimido)
+        resposta.headers['Content-Encoding'] = codificacao
+        return resposta
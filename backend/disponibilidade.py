@@ -0,0 +1,62 @@
+from models import db, Produto, Solicitacao, SolicitacaoProdutoOfertado, StatusSolicitacao
+
+# Um produto deixa de aparecer no catálogo enquanto estiver (como desejado ou
+# ofertado) em alguma solicitação PENDENTE ou APROVADA. Em vez de recalcular isso
+# a cada listagem, o estado fica salvo em Produto.disponivel e é atualizado na
+# mesma transação que altera o status da solicitação.
+
+STATUS_QUE_RESERVAM = [StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]
+
+
+def produtos_da_solicitacao(solicitacao):
+    # IDs do produto desejado e dos ofertados, lidos direto da tabela de relacionamento
+    ids = {solicitacao.id_produto_desejado}
+    ids.update(db.session.execute(
+        db.select(SolicitacaoProdutoOfertado.id_produto)
+        .where(SolicitacaoProdutoOfertado.id_solicitacao == solicitacao.id_solicitacao)
+    ).scalars())
+    return ids
+
+
+def atualizar_disponibilidade(ids_produtos):
+    # Recalcula a disponibilidade apenas dos produtos informados. Não faz commit:
+    # quem chama decide quando a transação termina.
+    # Um único UPDATE com as subconsultas correlacionadas: o banco lê as
+    # solicitações no momento da escrita (leitura atual, não o snapshot da
+    # transação), então transições concorrentes não deixam o valor desatualizado.
+    ids_produtos = {id_produto for id_produto in ids_produtos if id_produto is not None}
+    if not ids_produtos:
+        return
+
+    como_desejado = db.exists().where(
+        Solicitacao.id_produto_desejado == Produto.id_produto,
+        Solicitacao.status.in_(STATUS_QUE_RESERVAM)
+    )
+    como_ofertado = db.exists().where(
+        SolicitacaoProdutoOfertado.id_produto == Produto.id_produto,
+        SolicitacaoProdutoOfertado.id_solicitacao == Solicitacao.id_solicitacao,
+        Solicitacao.status.in_(STATUS_QUE_RESERVAM)
+    )
+    db.session.execute(
+        db.update(Produto)
+        .where(Produto.id_produto.in_(ids_produtos))
+        .values(disponivel=db.not_(db.or_(como_desejado, como_ofertado)))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def recalcular_toda_disponibilidade(tamanho_lote=1000):
+    # Reconstrói o estado de todos os produtos (usado após migração ou correção manual)
+    ultimo_id = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Produto.id_produto)
+            .where(Produto.id_produto > ultimo_id)
+            .order_by(Produto.id_produto)
+            .limit(tamanho_lote)
+        ).scalars().all()
+        if not ids:
+            break
+        atualizar_disponibilidade(ids)
+        db.session.commit()
+        ultimo_id = ids[-1]
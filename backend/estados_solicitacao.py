@@ -0,0 +1,229 @@
+from models import db, Produto, Categoria, Solicitacao, SolicitacaoProdutoOfertado, Transacao, StatusSolicitacao
+from disponibilidade import atualizar_disponibilidade, produtos_da_solicitacao
+from solicitacoes import (
+    SolicitacaoInvalida, ItemSolicitacao, normalizar_ids_ofertados,
+    validar_produtos_ofertados, inserir_produtos_ofertados, criar_solicitacoes
+)
+
+# Máquina de estados das solicitações. Cada transição roda inteira na transação
+# de quem chama (nenhuma função aqui faz commit):
+#   1. trava a linha do produto desejado (SELECT ... FOR UPDATE), o que
+#      serializa as transições que disputam o mesmo produto;
+#   2. troca o status com compare-and-swap (UPDATE ... WHERE status = <esperado>);
+#      se outra requisição mudou o status antes, nenhuma linha é alterada e a
+#      transição falha com 409;
+#   3. aplica os efeitos (transação, produtos ofertados, recusa das concorrentes)
+#      com UPDATE/INSERT em lote e recalcula a disponibilidade dos produtos.
+
+TRANSICOES = {
+    StatusSolicitacao.PROCESSANDO: {StatusSolicitacao.PENDENTE},
+    StatusSolicitacao.PENDENTE: {StatusSolicitacao.APROVADA, StatusSolicitacao.RECUSADA, StatusSolicitacao.CANCELADA},
+}
+
+
+MENSAGEM_NAO_PENDENTE = 'Ação não permitida. Solicitação não está PENDENTE (status atual: {status})'
+MENSAGEM_CANCELAMENTO = 'Solicitação não pode ser cancelada pois seu status é {status}.'
+MENSAGEM_ATIVACAO = 'Só é possível ativar solicitações com status PROCESSANDO. Status atual: {status}'
+
+
+class TransicaoInvalida(SolicitacaoInvalida):
+    def __init__(self, msg):
+        super().__init__(msg, 409)
+
+
+def _travar_produto(id_produto):
+    # Devolve o id_categoria do produto travado (None se o produto não existe mais)
+    return db.session.execute(
+        db.select(Produto.id_categoria).where(Produto.id_produto == id_produto).with_for_update()
+    ).scalar()
+
+
+def _conferir_transicao(solicitacao, novo_status, mensagem):
+    # Conferência antecipada com o status já carregado; a garantia vem do compare-and-swap
+    # mensagem: texto do 409, com {status} para o status atual
+    if novo_status not in TRANSICOES.get(solicitacao.status, ()):
+        raise TransicaoInvalida(mensagem.format(status=solicitacao.status.value))
+
+
+def _mudar_status(solicitacao, novo_status, mensagem, **valores):
+    esperado = solicitacao.status
+    resultado = db.session.execute(
+        db.update(Solicitacao)
+        .where(Solicitacao.id_solicitacao == solicitacao.id_solicitacao, Solicitacao.status == esperado)
+        .values(status=novo_status, **valores)
+    )
+    if resultado.rowcount != 1:
+        # Outra requisição mudou o status depois que a solicitação foi lida
+        atual = db.session.execute(
+            db.select(Solicitacao.status).where(Solicitacao.id_solicitacao == solicitacao.id_solicitacao)
+        ).scalar()
+        raise TransicaoInvalida(mensagem.format(status=atual.value if atual else 'removida'))
+    db.session.expire(solicitacao)
+
+
+def _substituir_ofertados(id_solicitacao, id_desejado, ids_ofertados, id_solicitante):
+    item = ItemSolicitacao(id_desejado, normalizar_ids_ofertados(ids_ofertados))
+    validar_produtos_ofertados([item], id_solicitante)
+    db.session.execute(
+        db.delete(SolicitacaoProdutoOfertado)
+        .where(SolicitacaoProdutoOfertado.id_solicitacao == id_solicitacao)
+    )
+    inserir_produtos_ofertados(id_solicitacao, item.ids_ofertados)
+    return set(item.ids_ofertados)
+
+
+def aprovar_solicitacao(solicitacao, ids_ofertados=None):
+    # Aprova, registra a transação e recusa as outras solicitações PENDENTES do
+    # mesmo produto. ids_ofertados (opcional, trocas): produtos do solicitante
+    # escolhidos pelo dono, substituindo os ofertados. Devolve os IDs recusados.
+    id_solicitacao = solicitacao.id_solicitacao
+    id_desejado = solicitacao.id_produto_desejado
+    id_solicitante = solicitacao.id_usuario_solicitante
+    _conferir_transicao(solicitacao, StatusSolicitacao.APROVADA, MENSAGEM_NAO_PENDENTE)
+    _travar_produto(id_desejado)
+    afetados = produtos_da_solicitacao(solicitacao)
+
+    transacao = Transacao()
+    db.session.add(transacao)
+    db.session.flush()
+    _mudar_status(solicitacao, StatusSolicitacao.APROVADA, MENSAGEM_NAO_PENDENTE, id_transacao=transacao.id_transacao)
+    if ids_ofertados:
+        afetados |= _substituir_ofertados(id_solicitacao, id_desejado, ids_ofertados, id_solicitante)
+
+    # Concorrentes: com o produto travado, nenhuma nova solicitação ativa entra no meio
+    concorrentes = db.select(Solicitacao.id_solicitacao).where(
+        Solicitacao.id_produto_desejado == id_desejado,
+        Solicitacao.id_solicitacao != id_solicitacao,
+        Solicitacao.status == StatusSolicitacao.PENDENTE
+    )
+    ids_recusados = db.session.execute(concorrentes).scalars().all()
+    if ids_recusados:
+        afetados.update(db.session.execute(
+            db.select(SolicitacaoProdutoOfertado.id_produto)
+            .where(SolicitacaoProdutoOfertado.id_solicitacao.in_(ids_recusados))
+        ).scalars())
+        db.session.execute(
+            db.update(Solicitacao)
+            .where(Solicitacao.id_solicitacao.in_(ids_recusados), Solicitacao.status == StatusSolicitacao.PENDENTE)
+            .values(status=StatusSolicitacao.RECUSADA)
+        )
+
+    atualizar_disponibilidade(afetados)
+    return ids_recusados
+
+
+def recusar_solicitacao(solicitacao):
+    _conferir_transicao(solicitacao, StatusSolicitacao.RECUSADA, MENSAGEM_NAO_PENDENTE)
+    _travar_produto(solicitacao.id_produto_desejado)
+    afetados = produtos_da_solicitacao(solicitacao)
+    _mudar_status(solicitacao, StatusSolicitacao.RECUSADA, MENSAGEM_NAO_PENDENTE)
+    atualizar_disponibilidade(afetados)
+
+
+def cancelar_solicitacao_pendente(solicitacao):
+    _conferir_transicao(solicitacao, StatusSolicitacao.CANCELADA, MENSAGEM_CANCELAMENTO)
+    _travar_produto(solicitacao.id_produto_desejado)
+    afetados = produtos_da_solicitacao(solicitacao)
+    _mudar_status(solicitacao, StatusSolicitacao.CANCELADA, MENSAGEM_CANCELAMENTO)
+    atualizar_disponibilidade(afetados)
+
+
+def ativar_solicitacao(solicitacao, ids_ofertados):
+    # PROCESSANDO -> PENDENTE. Trocas exigem os produtos ofertados, que
+    # substituem os anteriores; nas doações eles são ignorados.
+    id_solicitacao = solicitacao.id_solicitacao
+    id_desejado = solicitacao.id_produto_desejado
+    id_solicitante = solicitacao.id_usuario_solicitante
+    _conferir_transicao(solicitacao, StatusSolicitacao.PENDENTE, MENSAGEM_ATIVACAO)
+    id_categoria = _travar_produto(id_desejado)
+    if id_categoria is None:
+        raise SolicitacaoInvalida('Produto desejado não encontrado', 404)
+    afetados = produtos_da_solicitacao(solicitacao)
+    troca = db.session.get(Categoria, id_categoria).nome_categoria.upper() == 'TROCA'
+    if troca and not ids_ofertados:
+        raise SolicitacaoInvalida('id_produto_ofertado é obrigatório para solicitações de TROCA')
+
+    _mudar_status(solicitacao, StatusSolicitacao.PENDENTE, MENSAGEM_ATIVACAO)
+    if troca:
+        afetados |= _substituir_ofertados(id_solicitacao, id_desejado, ids_ofertados, id_solicitante)
+    atualizar_disponibilidade(afetados)
+
+
+def criar_pendentes(itens, id_usuario):
+    # Nova solicitação -> PENDENTE, para os itens já validados por
+    # preparar_solicitacoes(). Trava os produtos desejados (em ordem de id, para
+    # dois lotes não se travarem mutuamente) e confere de novo o que pode ter
+    # mudado desde a validação: o produto ainda existe, não foi aprovado para
+    # ninguém e o usuário não abriu outra solicitação ativa para ele.
+    ids_desejados = sorted(item.id_produto_desejado for item in itens)
+    travados = set(db.session.execute(
+        db.select(Produto.id_produto)
+        .where(Produto.id_produto.in_(ids_desejados))
+        .order_by(Produto.id_produto)
+        .with_for_update()
+    ).scalars())
+    aprovados = set()
+    ja_solicitados = set()
+    for id_desejado, id_solicitante, status in db.session.execute(
+        db.select(Solicitacao.id_produto_desejado, Solicitacao.id_usuario_solicitante, Solicitacao.status)
+        .where(
+            Solicitacao.id_produto_desejado.in_(ids_desejados),
+            Solicitacao.status.in_([StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA])
+        )
+    ).all():
+        if status == StatusSolicitacao.APROVADA:
+            aprovados.add(id_desejado)
+        if id_solicitante == id_usuario:
+            ja_solicitados.add(id_desejado)
+
+    for indice, item in enumerate(itens):
+        if item.id_produto_desejado not in travados:
+            raise SolicitacaoInvalida('Produto desejado não encontrado', 404, indice)
+        if item.id_produto_desejado in ja_solicitados:
+            raise SolicitacaoInvalida('Você já possui uma solicitação ativa para este produto.', 409, indice)
+        if item.id_produto_desejado in aprovados:
+            raise SolicitacaoInvalida('Produto não está mais disponível.', 409, indice)
+    return criar_solicitacoes(itens, id_usuario)
+
+
+def abrir_negociacao(id_usuario, id_produto):
+    # Rascunho -> PROCESSANDO, na primeira mensagem do interessado (ver rascunhos.py).
+    # Devolve a solicitação ativa do usuário para o produto, criando-a se ainda não existe.
+    id_dono = db.session.execute(
+        db.select(Produto.id_usuario).where(Produto.id_produto == id_produto).with_for_update()
+    ).scalar()
+    if id_dono is None:
+        raise SolicitacaoInvalida('Produto desejado não encontrado', 404)
+    if id_dono == id_usuario:
+        raise SolicitacaoInvalida('Você não pode solicitar seu próprio produto')
+    # Com o produto travado, duas primeiras mensagens simultâneas não criam duas solicitações
+    ativas = [StatusSolicitacao.PROCESSANDO, StatusSolicitacao.PENDENTE, StatusSolicitacao.APROVADA]
+    solicitacao = db.session.execute(
+        db.select(Solicitacao)
+        .where(
+            Solicitacao.id_usuario_solicitante == id_usuario,
+            Solicitacao.id_produto_desejado == id_produto,
+            Solicitacao.status.in_(ativas)
+        )
+        .order_by(Solicitacao.id_solicitacao.desc())
+        .limit(1)
+    ).scalar()
+    if solicitacao is None:
+        # Mesma regra de GET /negociacao/<id_produto>: com uma negociação ativa
+        # de outro usuário, o produto não está disponível para uma nova
+        em_negociacao = db.session.execute(
+            db.select(db.exists().where(
+                Solicitacao.id_produto_desejado == id_produto,
+                Solicitacao.status.in_(ativas)
+            ))
+        ).scalar()
+        if em_negociacao:
+            raise SolicitacaoInvalida('Este produto já está em negociação com outro usuário.', 403)
+        solicitacao = Solicitacao(
+            id_usuario_solicitante=id_usuario,
+            id_produto_desejado=id_produto,
+            status=StatusSolicitacao.PROCESSANDO
+        )
+        db.session.add(solicitacao)
+        db.session.flush()
+    return solicitacao
@@ -0,0 +1,271 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import request, current_app, make_response, jsonify
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from models import db, RespostaIdempotente
+from banco import CHAVE_COMMIT_ADIADO, CommitAdiado
+from armazenamento import receber_uploads_da_requisicao, descartar_uploads_da_requisicao
+
+# Repetição segura das rotas de escrita (POST /produto, /mensagem, /solicitacao,
+# /solicitacoes).
+# O cliente envia "Idempotency-Key: <valor único>" e repete a requisição com a
+# mesma chave se a conexão cair. A primeira resposta de sucesso fica gravada em
+# IDEMPOTENCIA por IDEMPOTENCIA_TTL_HORAS; as repetições recebem essa resposta
+# (com "Idempotent-Replayed: true") após uma leitura por chave primária, sem
+# executar a rota de novo e sem criar linhas duplicadas.
+#
+# Fluxo de uma chave nova:
+#   0. em multipart, recebe os arquivos em disco (ver receber_uploads_da_requisicao)
+#      antes de qualquer acesso ao banco: a trava nunca espera upload;
+#   1. grava uma reserva (status_http NULL), faz commit e trava a linha dela
+#      (SELECT ... FOR UPDATE) até o fim da requisição. Uma repetição que chegue
+#      enquanto a original roda encontra a linha travada e recebe 409 com
+#      Retry-After, por mais que a original demore;
+#   2. executa a rota. Os commits da rota viram flush (ver CommitAdiado em
+#      banco.py): tudo o que ela grava fica na mesma transação da reserva;
+#   3. resposta 2xx: grava status, tipo e corpo na reserva e faz um único
+#      commit, com os dados da rota e a resposta. Erro (4xx, 5xx): apaga a
+#      reserva no mesmo commit do que a rota confirmou. Exceção: desfaz tudo e
+#      apaga a reserva.
+#
+# Se o worker morrer no meio, nada da rota foi gravado e a trava é solta com a
+# conexão; depois de IDEMPOTENCIA_RESERVA_SEGUNDOS a repetição assume a reserva
+# e executa a rota. Em bancos sem trava de linha (SQLite) vale só esse prazo.
+#
+# Efeitos fora do banco que dependem das linhas gravadas (processar imagens,
+# tarefas em outra conexão, notificações) vão em depois_do_commit(); limpezas
+# para quando o commit real falha (o except da rota já rodou) vão em
+# depois_do_rollback(). Os temporários de upload que a rota não publicou são
+# apagados no fim da requisição.
+#
+# A chave vale por usuário e por rota. Reenviar a mesma chave com outro corpo
+# responde 422. Sem o cabeçalho a rota funciona como antes.
+#
+# Linhas expiradas são apagadas quando a chave é consultada de novo e pelo
+# comando "flask limpar-idempotencia" (agendar no cron).
+
+CABECALHO_CHAVE = 'Idempotency-Key'
+CABECALHO_REPETIDA = 'Idempotent-Replayed'
+TAMANHO_MAXIMO_CHAVE = 255
+
+
+class Idempotencia:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # Por quanto tempo a resposta é reenviada
+        app.config.setdefault('IDEMPOTENCIA_TTL_HORAS', float(os.environ.get('IDEMPOTENCIA_TTL_HORAS', 24)))
+        # Reserva sem resposta e destravada (o worker morreu no meio) é assumida depois disso
+        app.config.setdefault('IDEMPOTENCIA_RESERVA_SEGUNDOS', float(os.environ.get('IDEMPOTENCIA_RESERVA_SEGUNDOS', 60)))
+        # Respostas maiores não são guardadas (a reserva é liberada)
+        app.config.setdefault('IDEMPOTENCIA_MAXIMO_BYTES', int(os.environ.get('IDEMPOTENCIA_MAXIMO_BYTES', 1024 * 1024)))
+        app.extensions['idempotencia'] = self
+
+
+def _impressao_requisicao():
+    # Hash do conteúdo da requisição. Em multipart usa os campos e o SHA-256 de
+    # cada arquivo, calculado ao recebê-lo em disco (o boundary muda a cada
+    # envio, então o corpo bruto não serve). A rota reaproveita o que foi recebido.
+    resumo = hashlib.sha256()
+    if request.mimetype == 'multipart/form-data':
+        for nome in sorted(request.form):
+            for valor in request.form.getlist(nome):
+                resumo.update(f'{nome}={valor}\n'.encode('utf-8'))
+        for nome in sorted(request.files):
+            for recebido in receber_uploads_da_requisicao(nome):
+                resumo.update(f'{nome}:{recebido.hash}{recebido.extensao}\n'.encode('utf-8'))
+    else:
+        resumo.update(request.get_data(cache=True))
+    return resumo.hexdigest()
+
+
+def _resposta_gravada(registro):
+    resposta = make_response(registro.corpo, registro.status_http)
+    if registro.tipo_conteudo:
+        resposta.headers['Content-Type'] = registro.tipo_conteudo
+    resposta.headers[CABECALHO_REPETIDA] = 'true'
+    return resposta
+
+
+def _em_andamento():
+    resposta = jsonify({'msg': 'Uma requisição com esta Idempotency-Key ainda está em andamento. Tente novamente em instantes.'})
+    resposta.status_code = 409
+    resposta.headers['Retry-After'] = '1'
+    return resposta
+
+
+def _liberar(chave):
+    db.session.rollback()
+    db.session.execute(
+        db.delete(RespostaIdempotente)
+        .where(RespostaIdempotente.chave == chave, RespostaIdempotente.status_http.is_(None))
+    )
+    db.session.commit()
+
+
+def _travar(chave, esperar=True):
+    # Trava a reserva até o fim da transação. Sem esperar, levanta
+    # OperationalError se a requisição original ainda está com ela.
+    return db.session.execute(
+        db.select(RespostaIdempotente)
+        .where(RespostaIdempotente.chave == chave)
+        .with_for_update(nowait=not esperar)
+        .execution_options(populate_existing=True)
+    ).scalar()
+
+
+def depois_do_commit(funcao):
+    # Executa agora, ou depois do commit real quando a rota é @idempotente
+    adiado = db.session.info.get(CHAVE_COMMIT_ADIADO)
+    if adiado is None:
+        funcao()
+    else:
+        adiado.apos_commit.append(funcao)
+
+
+def depois_do_rollback(funcao):
+    # Limpeza para quando o commit real da rota @idempotente falha ou a rota
+    # levanta exceção. Fora delas não faz nada: a rota trata o erro do próprio commit.
+    adiado = db.session.info.get(CHAVE_COMMIT_ADIADO)
+    if adiado is not None:
+        adiado.apos_rollback.append(funcao)
+
+
+def _desfazer(adiado):
+    for funcao in adiado.apos_rollback:
+        try:
+            funcao()
+        except Exception as e:
+            current_app.logger.error(f"Erro na limpeza da requisição idempotente: {e}")
+
+
+def idempotente(view):
+    # Decorator das rotas POST; usar abaixo de @jwt_required
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        valor = request.headers.get(CABECALHO_CHAVE)
+        if valor is None:
+            return view(*args, **kwargs)
+        if not valor.strip() or len(valor) > TAMANHO_MAXIMO_CHAVE:
+            return jsonify({'msg': f'{CABECALHO_CHAVE} deve ter entre 1 e {TAMANHO_MAXIMO_CHAVE} caracteres'}), 400
+
+        id_usuario = get_jwt_identity()
+        chave = hashlib.sha256(
+            f'{id_usuario}|{request.method}|{request.url_rule.rule}|{valor}'.encode('utf-8')
+        ).hexdigest()
+        try:
+            return _executar(view, args, kwargs, chave, int(id_usuario), _impressao_requisicao())
+        finally:
+            descartar_uploads_da_requisicao()
+    return wrapper
+
+
+def _executar(view, args, kwargs, chave, id_usuario, impressao):
+    agora = datetime.utcnow()
+    config = current_app.config
+
+    registro = db.session.get(RespostaIdempotente, chave)
+    if registro is not None and registro.status_http is not None and registro.data_expiracao <= agora:
+        db.session.delete(registro)
+        db.session.commit()
+        registro = None
+    if registro is not None:
+        if registro.impressao != impressao:
+            return jsonify({'msg': f'{CABECALHO_CHAVE} já utilizada com outro conteúdo de requisição'}), 422
+        if registro.status_http is not None:
+            return _resposta_gravada(registro)
+        # Reserva sem resposta: a original ainda roda (e está com a trava) ou morreu
+        try:
+            registro = _travar(chave, esperar=False)
+        except OperationalError:
+            db.session.rollback()
+            return _em_andamento()
+        if registro is not None and registro.status_http is not None:
+            resposta = _resposta_gravada(registro)
+            db.session.rollback()
+            return resposta
+        if registro is None or registro.data_expiracao > agora:
+            # Liberada agora há pouco, ou recém-criada (a original pode ainda não ter travado)
+            db.session.rollback()
+            return _em_andamento()
+        # A original morreu sem gravar nada: esta requisição assume a reserva, já travada
+    else:
+        try:
+            db.session.add(RespostaIdempotente(
+                chave=chave, id_usuario=id_usuario, impressao=impressao,
+                data_expiracao=agora + timedelta(seconds=config['IDEMPOTENCIA_RESERVA_SEGUNDOS'])
+            ))
+            db.session.commit()
+        except IntegrityError:
+            # Outra requisição com a mesma chave reservou primeiro
+            db.session.rollback()
+            return _em_andamento()
+        _travar(chave)
+
+    adiado = CommitAdiado()
+    db.session.info[CHAVE_COMMIT_ADIADO] = adiado
+    try:
+        resposta = make_response(view(*args, **kwargs))
+    except Exception:
+        db.session.info.pop(CHAVE_COMMIT_ADIADO, None)
+        _liberar(chave)
+        _desfazer(adiado)
+        raise
+    db.session.info.pop(CHAVE_COMMIT_ADIADO, None)
+
+    corpo = None if resposta.is_streamed else resposta.get_data()
+    guardar = 200 <= resposta.status_code < 300 and corpo is not None and len(corpo) <= config['IDEMPOTENCIA_MAXIMO_BYTES']
+    if not adiado.pedido:
+        # A rota não confirmou nada (ou desfez): descarta o que ficou pendente
+        db.session.rollback()
+    try:
+        if guardar:
+            db.session.execute(
+                db.update(RespostaIdempotente)
+                .where(RespostaIdempotente.chave == chave)
+                .values(
+                    status_http=resposta.status_code, tipo_conteudo=resposta.headers.get('Content-Type'), corpo=corpo,
+                    data_expiracao=datetime.utcnow() + timedelta(hours=config['IDEMPOTENCIA_TTL_HORAS'])
+                )
+            )
+        else:
+            # Nada a reenviar: a chave fica livre para uma nova tentativa
+            db.session.execute(
+                db.delete(RespostaIdempotente)
+                .where(RespostaIdempotente.chave == chave, RespostaIdempotente.status_http.is_(None))
+            )
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(f"Erro ao confirmar a requisição idempotente: {e}")
+        _liberar(chave)
+        _desfazer(adiado)
+        return jsonify({'msg': 'Erro ao salvar no banco de dados.'}), 500
+
+    for funcao in adiado.apos_commit:
+        funcao()
+    return resposta
+
+
+def limpar_respostas_expiradas(tamanho_lote=1000):
+    # Apaga em lotes, para não segurar travas na tabela por muito tempo
+    removidas = 0
+    while True:
+        chaves = db.session.execute(
+            db.select(RespostaIdempotente.chave)
+            .where(RespostaIdempotente.data_expiracao <= datetime.utcnow())
+            .limit(tamanho_lote)
+        ).scalars().all()
+        if not chaves:
+            return removidas
+        db.session.execute(db.delete(RespostaIdempotente).where(RespostaIdempotente.chave.in_(chaves)))
+        db.session.commit()
+        removidas += len(chaves)
@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from models import db, Imagem
+
+# Geração das variantes das imagens enviadas (miniatura e média, em JPEG e WebP).
+# O redimensionamento roda em um pool de processos separado para não ocupar os
+# workers da API; quando termina, as URLs são gravadas na linha da Imagem.
+
+# nome da variante -> maior lado em pixels
+TAMANHOS_VARIANTES = {
+    'thumb': 400,
+    'media': 1024,
+}
+QUALIDADE_JPEG = 82
+QUALIDADE_WEBP = 80
+
+
+def _caminho_variante(caminho_original, variante, extensao):
+    base, _ = os.path.splitext(caminho_original)
+    return f"{base}_{variante}.{extensao}"
+
+
+def caminhos_variantes(url_original):
+    # Todas as URLs relativas que podem ter sido geradas para a imagem original
+    return [
+        _caminho_variante(url_original, variante, extensao)
+        for variante in TAMANHOS_VARIANTES
+        for extensao in ('jpg', 'webp')
+    ]
+
+
+def gerar_variantes(pasta_base, url_original):
+    # Executa dentro do processo do pool: não pode depender do app nem do banco.
+    # Retorna {coluna da Imagem: url relativa}.
+    caminho_original = os.path.join(pasta_base, url_original)
+    # Conteúdo repetido (mesmo hash) já teve as variantes geradas antes
+    existentes = {
+        f'url_{variante}{sufixo}': _caminho_variante(url_original, variante, extensao)
+        for variante in TAMANHOS_VARIANTES
+        for sufixo, extensao in (('', 'jpg'), ('_webp', 'webp'))
+    }
+    if all(os.path.exists(os.path.join(pasta_base, url)) for url in existentes.values()):
+        return existentes
+
+    urls = {}
+    with Image.open(caminho_original) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'L'):
+            original = original.convert('RGB')
+        for variante, tamanho in TAMANHOS_VARIANTES.items():
+            copia = original.copy()
+            copia.thumbnail((tamanho, tamanho))
+
+            url_jpg = _caminho_variante(url_original, variante, 'jpg')
+            copia.save(os.path.join(pasta_base, url_jpg), 'JPEG', quality=QUALIDADE_JPEG, optimize=True, progressive=True)
+            urls[f'url_{variante}'] = url_jpg
+
+            url_webp = _caminho_variante(url_original, variante, 'webp')
+            copia.save(os.path.join(pasta_base, url_webp), 'WEBP', quality=QUALIDADE_WEBP, method=4)
+            urls[f'url_{variante}_webp'] = url_webp
+    return urls
+
+
+def remover_arquivos_imagem(pasta_base, url_original, logger=None):
+    # Remove o original e as variantes do disco (as que existirem)
+    for url in [url_original] + caminhos_variantes(url_original):
+        caminho = os.path.join(pasta_base, url)
+        if os.path.exists(caminho):
+            try:
+                os.remove(caminho)
+            except Exception as e:
+                if logger:
+                    logger.error(f"Erro ao remover arquivo {caminho}: {e}")
+
+
+class ProcessadorImagens:
+    def __init__(self, app=None):
+        self.app = None
+        self._pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('IMAGENS_WORKERS', int(os.environ.get('IMAGENS_WORKERS', 2)))
+        app.extensions['processador_imagens'] = self
+
+    def _obter_pool(self):
+        # O pool é criado no primeiro uso, já dentro do processo do worker
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.app.config['IMAGENS_WORKERS'])
+        return self._pool
+
+    def agendar(self, imagens):
+        # Deve ser chamado depois do commit, para que as linhas já existam
+        pasta_base = os.getcwd()
+        for imagem in imagens:
+            futuro = self._obter_pool().submit(gerar_variantes, pasta_base, imagem.url_imagem)
+            futuro.add_done_callback(
+                lambda f, id_imagem=imagem.id_imagem, url=imagem.url_imagem: self._salvar(id_imagem, url, pasta_base, f)
+            )
+
+    def _salvar(self, id_imagem, url_original, pasta_base, futuro):
+        try:
+            urls = futuro.result()
+        except Exception as e:
+            # Imagem inválida ou formato não suportado: o original continua sendo usado
+            self.app.logger.warning(f"Não foi possível gerar variantes da imagem {id_imagem}: {e}")
+            return
+
+        with self.app.app_context():
+            try:
+                resultado = db.session.execute(
+                    db.update(Imagem).where(Imagem.id_imagem == id_imagem).values(**urls)
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Erro ao salvar variantes da imagem {id_imagem}: {e}")
+                return
+            if resultado.rowcount == 0:
+                # A imagem foi removida enquanto era processada: apaga as variantes
+                # recém-criadas se o arquivo não for usado por outra imagem
+                from armazenamento import remover_se_sem_referencia
+                remover_se_sem_referencia([url_original], self.app.logger)
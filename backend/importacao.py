@@ -0,0 +1,295 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from itertools import islice
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.security import generate_password_hash
+
+from models import db, Usuario, EnderecoUsuario, Produto, Imagem, Categoria, ProdutoTermo, StatusProduto
+from busca import normalizar_texto, extrair_termos
+from localidade import indexar_localidade_produtos
+from armazenamento import receber_upload, registrar_referencias, publicar, descartar
+from imagens import gerar_variantes
+
+# Importação em massa de usuários (com endereço) e produtos (com imagens) a
+# partir de arquivos JSONL ou CSV, para cadastrar uma cidade inteira de uma vez.
+# Os registros são processados em lotes: a unicidade de email/CPF é conferida
+# com uma consulta IN por lote, as senhas são calculadas em paralelo em um pool
+# de processos e as linhas entram com INSERTs executemany, um commit por lote.
+# Registros inválidos são ignorados e informados; um erro de banco interrompe a
+# importação (os lotes anteriores já ficam gravados).
+
+CAMPOS_USUARIO = ('nome_usuario', 'email', 'senha', 'telefone', 'data_nascimento', 'cep', 'bairro', 'rua', 'numero', 'cidade', 'estado')
+CAMPOS_PRODUTO = ('nome_produto', 'descricao', 'categoria')
+
+
+def ler_registros(caminho):
+    # Gera (número da linha, dict). CSV usa a primeira linha como cabeçalho.
+    if caminho.lower().endswith('.csv'):
+        with open(caminho, newline='', encoding='utf-8-sig') as arquivo:
+            for numero, registro in enumerate(csv.DictReader(arquivo), start=2):
+                yield numero, {chave: (valor.strip() if isinstance(valor, str) else valor) for chave, valor in registro.items()}
+    else:
+        with open(caminho, encoding='utf-8') as arquivo:
+            for numero, linha in enumerate(arquivo, start=1):
+                if linha.strip():
+                    yield numero, json.loads(linha)
+
+
+def _em_lotes(registros, tamanho_lote):
+    registros = iter(registros)
+    while True:
+        lote = list(islice(registros, tamanho_lote))
+        if not lote:
+            return
+        yield lote
+
+
+def _texto(valor):
+    return str(valor).strip() if valor not in (None, '') else None
+
+
+def importar_usuarios(caminho, metodo_senha, tamanho_lote=1000, workers=None, avisar=print):
+    importados = ignorados = 0
+    emails_vistos = set()
+    cpfs_vistos = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for lote in _em_lotes(ler_registros(caminho), tamanho_lote):
+            validos = []
+            for numero, registro in lote:
+                faltando = [campo for campo in CAMPOS_USUARIO if not _texto(registro.get(campo))]
+                if faltando:
+                    avisar(f"Linha {numero}: campos obrigatórios faltando: {', '.join(faltando)}")
+                    continue
+                try:
+                    data_nascimento = datetime.strptime(_texto(registro['data_nascimento']), '%Y-%m-%d').date()
+                except ValueError:
+                    avisar(f"Linha {numero}: data_nascimento inválida (use YYYY-MM-DD)")
+                    continue
+                email = _texto(registro['email'])
+                cpf = _texto(registro.get('cpf'))
+                if email in emails_vistos or (cpf and cpf in cpfs_vistos):
+                    avisar(f"Linha {numero}: email ou CPF repetido no arquivo")
+                    continue
+                emails_vistos.add(email)
+                if cpf:
+                    cpfs_vistos.add(cpf)
+                validos.append((numero, registro, email, cpf, data_nascimento))
+
+            # Unicidade contra o banco: uma consulta por campo para o lote inteiro
+            emails = [v[2] for v in validos]
+            cpfs = [v[3] for v in validos if v[3]]
+            emails_existentes = set(db.session.execute(
+                db.select(Usuario.email).where(Usuario.email.in_(emails))
+            ).scalars()) if emails else set()
+            cpfs_existentes = set(db.session.execute(
+                db.select(Usuario.cpf).where(Usuario.cpf.in_(cpfs))
+            ).scalars()) if cpfs else set()
+            novos = []
+            for item in validos:
+                numero, _, email, cpf, _ = item
+                if email in emails_existentes:
+                    avisar(f"Linha {numero}: email já cadastrado")
+                elif cpf and cpf in cpfs_existentes:
+                    avisar(f"Linha {numero}: CPF já cadastrado")
+                else:
+                    novos.append(item)
+            ignorados += len(lote) - len(novos)
+            if not novos:
+                continue
+
+            hashes = list(pool.map(
+                partial(generate_password_hash, method=metodo_senha),
+                [str(registro['senha']) for _, registro, _, _, _ in novos],
+                chunksize=max(1, len(novos) // (4 * (workers or os.cpu_count() or 1)))
+            ))
+
+            try:
+                db.session.execute(db.insert(Usuario), [
+                    {
+                        'nome_usuario': _texto(registro['nome_usuario']),
+                        'email': email,
+                        'password_hash': hash_senha,
+                        'telefone': _texto(registro['telefone']),
+                        'cpf': cpf,
+                        'data_nascimento': data_nascimento,
+                        'data_cadastro': datetime.utcnow()
+                    }
+                    for (_, registro, email, cpf, data_nascimento), hash_senha in zip(novos, hashes)
+                ])
+                # Sem RETURNING no MySQL: os IDs gerados são lidos pelo email (único)
+                ids = dict(db.session.execute(
+                    db.select(Usuario.email, Usuario.id_usuario)
+                    .where(Usuario.email.in_([item[2] for item in novos]))
+                ).all())
+                db.session.execute(db.insert(EnderecoUsuario), [
+                    {
+                        'cep': _texto(registro['cep']),
+                        'bairro': _texto(registro['bairro']),
+                        'rua': _texto(registro['rua']),
+                        'numero': _texto(registro['numero']),
+                        'complemento': _texto(registro.get('complemento')),
+                        'cidade': _texto(registro['cidade']),
+                        'estado': _texto(registro['estado']),
+                        'id_usuario': ids[email]
+                    }
+                    for _, registro, email, _, _ in novos
+                ])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                avisar(f"Erro ao gravar o lote iniciado na linha {novos[0][0]}; importação interrompida")
+                raise
+            importados += len(novos)
+            avisar(f"{importados} usuários importados até a linha {lote[-1][0]}")
+    return importados, ignorados
+
+
+def _abrir_imagem(pasta_imagens, caminho):
+    caminho_completo = os.path.join(pasta_imagens, caminho)
+    with open(caminho_completo, 'rb') as arquivo:
+        return receber_upload(FileStorage(stream=arquivo, filename=os.path.basename(caminho)))
+
+
+def _lista_imagens(valor):
+    # JSONL: lista; CSV: caminhos separados por ';'
+    if not valor:
+        return []
+    if isinstance(valor, list):
+        return [str(v) for v in valor if v]
+    return [v.strip() for v in str(valor).split(';') if v.strip()]
+
+
+def importar_produtos(caminho, pasta_imagens='.', tamanho_lote=500, workers=None, gerar_miniaturas=True, avisar=print):
+    importados = ignorados = 0
+    categorias = {}
+    for categoria in db.session.execute(db.select(Categoria.id_categoria, Categoria.nome_categoria)).all():
+        categorias[str(categoria.id_categoria)] = categoria.id_categoria
+        categorias[normalizar_texto(categoria.nome_categoria)] = categoria.id_categoria
+    pasta_base = os.getcwd()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for lote in _em_lotes(ler_registros(caminho), tamanho_lote):
+            # Donos por email ou id, com uma consulta por lote
+            emails = {_texto(r.get('email_usuario')) for _, r in lote if _texto(r.get('email_usuario'))}
+            ids_informados = {int(r['id_usuario']) for _, r in lote if str(r.get('id_usuario') or '').isdigit()}
+            donos = {}
+            if emails:
+                donos.update(db.session.execute(
+                    db.select(Usuario.email, Usuario.id_usuario).where(Usuario.email.in_(emails))
+                ).all())
+            if ids_informados:
+                donos.update({
+                    str(i): i for i in db.session.execute(
+                        db.select(Usuario.id_usuario).where(Usuario.id_usuario.in_(ids_informados))
+                    ).scalars()
+                })
+
+            produtos = []
+            recebidos = []
+            try:
+                for numero, registro in lote:
+                    faltando = [campo for campo in CAMPOS_PRODUTO if not _texto(registro.get(campo))]
+                    if faltando:
+                        avisar(f"Linha {numero}: campos obrigatórios faltando: {', '.join(faltando)}")
+                        continue
+                    id_usuario = donos.get(_texto(registro.get('email_usuario'))) or donos.get(str(registro.get('id_usuario') or ''))
+                    if not id_usuario:
+                        avisar(f"Linha {numero}: usuário dono não encontrado (email_usuario ou id_usuario)")
+                        continue
+                    id_categoria = categorias.get(normalizar_texto(str(registro['categoria'])))
+                    if not id_categoria:
+                        avisar(f"Linha {numero}: categoria não encontrada")
+                        continue
+                    try:
+                        status = StatusProduto[(_texto(registro.get('status')) or 'NOVO').upper()]
+                        quantidade = int(registro.get('quantidade') or 1)
+                        valor = Decimal(str(registro['valor'])) if _texto(registro.get('valor')) else None
+                    except (KeyError, ValueError, InvalidOperation):
+                        avisar(f"Linha {numero}: status, quantidade ou valor inválido")
+                        continue
+                    try:
+                        imagens_produto = [_abrir_imagem(pasta_imagens, c) for c in _lista_imagens(registro.get('imagens'))]
+                    except OSError as e:
+                        avisar(f"Linha {numero}: não foi possível ler a imagem: {e}")
+                        continue
+                    recebidos.extend(imagens_produto)
+                    produto = Produto(
+                        nome_produto=_texto(registro['nome_produto']),
+                        descricao=_texto(registro['descricao']),
+                        id_usuario=id_usuario,
+                        id_categoria=id_categoria,
+                        quantidade=quantidade,
+                        status=status,
+                        valor=valor
+                    )
+                    produtos.append((produto, imagens_produto))
+                ignorados += len(lote) - len(produtos)
+                if not produtos:
+                    continue
+
+                # Os produtos precisam do ID gerado; o flush agrupa os INSERTs
+                # (em uma única instrução onde o banco suporta RETURNING)
+                db.session.add_all([produto for produto, _ in produtos])
+                db.session.flush()
+                ids_imagens = {}  # url -> id_imagem das imagens do lote com esse arquivo
+                if recebidos:
+                    db.session.execute(db.insert(Imagem), [
+                        {'url_imagem': recebido.url, 'id_produto': produto.id_produto}
+                        for produto, imagens_produto in produtos
+                        for recebido in imagens_produto
+                    ])
+                    if gerar_miniaturas:
+                        for id_imagem, url in db.session.execute(
+                            db.select(Imagem.id_imagem, Imagem.url_imagem)
+                            .where(Imagem.id_produto.in_([produto.id_produto for produto, _ in produtos]))
+                        ).all():
+                            ids_imagens.setdefault(url, []).append(id_imagem)
+                registrar_referencias(recebidos)
+                linhas_indice = [
+                    {'termo': termo, 'id_produto': produto.id_produto, 'peso': peso}
+                    for produto, _ in produtos
+                    for termo, peso in extrair_termos(produto.nome_produto, produto.descricao).items()
+                ]
+                if linhas_indice:
+                    db.session.execute(db.insert(ProdutoTermo), linhas_indice)
+                indexar_localidade_produtos([produto.id_produto for produto, _ in produtos])
+                publicar(recebidos)  # antes do commit, ver armazenamento.py
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                descartar(recebidos)
+                avisar(f"Erro ao gravar o lote iniciado na linha {lote[0][0]}; importação interrompida")
+                raise
+            db.session.expunge_all()
+
+            if gerar_miniaturas and recebidos:
+                # Variantes em paralelo, uma vez por arquivo (o nome é o hash);
+                # o UPDATE é pela chave primária de cada imagem do lote
+                urls = list(dict.fromkeys(recebido.url for recebido in recebidos))
+                variantes = []
+                for url, futuro in [(url, pool.submit(gerar_variantes, pasta_base, url)) for url in urls]:
+                    try:
+                        colunas = {f'nova_{coluna}': v for coluna, v in futuro.result().items()}
+                    except Exception as e:
+                        avisar(f"Não foi possível gerar variantes de {url}: {e}")
+                        continue
+                    variantes.extend({'id': id_imagem, **colunas} for id_imagem in ids_imagens.get(url, []))
+                if variantes:
+                    tabela = Imagem.__table__
+                    db.session.execute(
+                        tabela.update()
+                        .where(tabela.c.id_imagem == db.bindparam('id'))
+                        .values({coluna[len('nova_'):]: db.bindparam(coluna) for coluna in variantes[0] if coluna != 'id'}),
+                        variantes
+                    )
+                    db.session.commit()
+
+            importados += len(produtos)
+            avisar(f"{importados} produtos importados até a linha {lote[-1][0]}")
+    return importados, ignorados
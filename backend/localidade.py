@@ -0,0 +1,179 @@
+import re
+from itertools import chain
+
+from sqlalchemy import event, false, func, or_, and_
+from sqlalchemy.orm import Session
+
+from models import db, Produto, ProdutoLocalidade, EnderecoUsuario, Usuario
+from busca import normalizar_texto
+from paginacao import codificar_cursor_proximidade, decodificar_cursor_proximidade
+
+# Índice de localidade para a listagem "perto de mim": cada produto tem uma linha
+# em PRODUTO_LOCALIDADE com a cidade, o estado e o prefixo do CEP do endereço
+# principal do proprietário (o primeiro cadastrado) e a data do produto. A
+# listagem consulta só esse índice, sem juntar produtos aos endereços.
+#
+# A linha do produto é gravada junto com ele (indexar_localidade_produtos) e
+# atualizada automaticamente quando um endereço do proprietário muda (evento
+# da sessão abaixo).
+
+TAMANHO_PREFIXO_CEP = 5
+TAMANHO_LOTE_IN = 1000
+CHAVE_USUARIOS_ALTERADOS = 'localidade_usuarios_alterados'
+
+# Níveis de proximidade, do mais perto para o mais longe
+NIVEIS = ('cep', 'cidade', 'estado', 'outros')
+# Valor de ?perto= -> último nível incluído na listagem
+NIVEL_MAXIMO_POR_PARAMETRO = {'cep': 0, 'cidade': 1, 'estado': 2, 'todos': 3, '1': 3}
+
+
+def normalizar_localidade(cidade, estado, cep):
+    prefixo = re.sub(r'\D', '', cep or '')[:TAMANHO_PREFIXO_CEP]
+    return normalizar_texto(cidade), normalizar_texto(estado), prefixo
+
+
+def _em_lotes(ids):
+    ids = list(ids)
+    for inicio in range(0, len(ids), TAMANHO_LOTE_IN):
+        yield ids[inicio:inicio + TAMANHO_LOTE_IN]
+
+
+def _enderecos_principais(ids_usuarios):
+    # {id_usuario: (cidade, estado, cep_prefixo)} do primeiro endereço de cada usuário
+    resultado = {}
+    for lote in _em_lotes(ids_usuarios):
+        primeiros = db.select(func.min(EnderecoUsuario.id_endereco))\
+            .where(EnderecoUsuario.id_usuario.in_(lote))\
+            .group_by(EnderecoUsuario.id_usuario)
+        for endereco in db.session.execute(
+            db.select(EnderecoUsuario.id_usuario, EnderecoUsuario.cidade, EnderecoUsuario.estado, EnderecoUsuario.cep)
+            .where(EnderecoUsuario.id_endereco.in_(primeiros))
+        ):
+            resultado[endereco.id_usuario] = normalizar_localidade(endereco.cidade, endereco.estado, endereco.cep)
+    return resultado
+
+
+def localidade_do_usuario(id_usuario):
+    return _enderecos_principais([id_usuario]).get(id_usuario)
+
+
+def indexar_localidade_produtos(ids_produtos):
+    # Grava (ou regrava) a linha de cada produto. Não faz commit, para que o
+    # índice acompanhe a mesma transação que grava os produtos.
+    for lote in _em_lotes(ids_produtos):
+        produtos = db.session.execute(
+            db.select(Produto.id_produto, Produto.id_usuario, Produto.data_cadastro)
+            .where(Produto.id_produto.in_(lote))
+        ).all()
+        db.session.execute(db.delete(ProdutoLocalidade).where(ProdutoLocalidade.id_produto.in_(lote)))
+        if not produtos:
+            continue
+        enderecos = _enderecos_principais({p.id_usuario for p in produtos})
+        linhas = []
+        for produto in produtos:
+            # Proprietário sem endereço: fica no índice, mas só aparece no nível "outros"
+            cidade, estado, prefixo = enderecos.get(produto.id_usuario, ('', '', ''))
+            linhas.append({
+                'id_produto': produto.id_produto, 'id_usuario': produto.id_usuario,
+                'cidade': cidade, 'estado': estado, 'cep_prefixo': prefixo,
+                'data_cadastro': produto.data_cadastro,
+            })
+        db.session.execute(db.insert(ProdutoLocalidade), linhas)
+
+
+def remover_localidade(id_produto):
+    db.session.execute(db.delete(ProdutoLocalidade).where(ProdutoLocalidade.id_produto == id_produto))
+
+
+def atualizar_localidade_usuarios(ids_usuarios):
+    # Copia o endereço principal atual para as linhas de todos os produtos dos usuários
+    enderecos = _enderecos_principais(ids_usuarios)
+    for id_usuario in ids_usuarios:
+        cidade, estado, prefixo = enderecos.get(id_usuario, ('', '', ''))
+        db.session.execute(
+            db.update(ProdutoLocalidade)
+            .where(ProdutoLocalidade.id_usuario == id_usuario)
+            .values(cidade=cidade, estado=estado, cep_prefixo=prefixo)
+        )
+
+
+def reindexar_localidades(tamanho_lote=TAMANHO_LOTE_IN):
+    ultimo_id = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Produto.id_produto)
+            .where(Produto.id_produto > ultimo_id)
+            .order_by(Produto.id_produto)
+            .limit(tamanho_lote)
+        ).scalars().all()
+        if not ids:
+            break
+        indexar_localidade_produtos(ids)
+        db.session.commit()
+        ultimo_id = ids[-1]
+    # Linhas de produtos que não existem mais (removidos sem passar pela API)
+    db.session.execute(
+        db.delete(ProdutoLocalidade)
+        .where(~db.exists().where(Produto.id_produto == ProdutoLocalidade.id_produto))
+    )
+    db.session.commit()
+
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_enderecos_alterados(session, flush_context):
+    novos_usuarios = {obj.id_usuario for obj in session.new if isinstance(obj, Usuario)}
+    for obj in chain(session.new, session.dirty, session.deleted):
+        # Usuário recém-criado ainda não tem produtos no índice
+        if isinstance(obj, EnderecoUsuario) and obj.id_usuario not in novos_usuarios:
+            session.info.setdefault(CHAVE_USUARIOS_ALTERADOS, set()).add(obj.id_usuario)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _atualizar_enderecos_alterados(session, flush_context):
+    ids_usuarios = session.info.pop(CHAVE_USUARIOS_ALTERADOS, None)
+    if ids_usuarios:
+        atualizar_localidade_usuarios(sorted(ids_usuarios))
+
+
+def _condicoes_por_nivel(localidade):
+    cidade, estado, prefixo = localidade
+    mesmo_cep = ProdutoLocalidade.cep_prefixo == prefixo if prefixo else false()
+    outro_cep = ProdutoLocalidade.cep_prefixo != prefixo if prefixo else ProdutoLocalidade.cep_prefixo.isnot(None)
+    return (
+        mesmo_cep,
+        and_(ProdutoLocalidade.estado == estado, ProdutoLocalidade.cidade == cidade, outro_cep),
+        and_(ProdutoLocalidade.estado == estado, ProdutoLocalidade.cidade != cidade, outro_cep),
+        and_(ProdutoLocalidade.estado != estado, outro_cep),
+    )
+
+
+def paginar_por_proximidade(query, localidade, nivel_maximo, limite, cursor):
+    # query: consulta de Produto já unida a ProdutoLocalidade e com os filtros da rota.
+    # Cada nível é uma consulta própria pelo índice (nível, data, id); os níveis
+    # seguintes só são consultados se o anterior não completar a página.
+    # Retorna ([(nível, id_produto)], próximo cursor).
+    posicao = decodificar_cursor_proximidade(cursor)
+    nivel_inicial = posicao[0] if posicao else 0
+    condicoes = _condicoes_por_nivel(localidade)
+    base = query.with_entities(ProdutoLocalidade.id_produto, ProdutoLocalidade.data_cadastro)
+
+    itens = []
+    for nivel in range(nivel_inicial, nivel_maximo + 1):
+        consulta = base.filter(condicoes[nivel])
+        if posicao and nivel == nivel_inicial:
+            _, data, id_registro = posicao
+            consulta = consulta.filter(or_(
+                ProdutoLocalidade.data_cadastro < data,
+                and_(ProdutoLocalidade.data_cadastro == data, ProdutoLocalidade.id_produto < id_registro)
+            ))
+        linhas = consulta.order_by(ProdutoLocalidade.data_cadastro.desc(), ProdutoLocalidade.id_produto.desc())\
+            .limit(limite + 1 - len(itens)).all()
+        itens.extend((nivel, linha.data_cadastro, linha.id_produto) for linha in linhas)
+        if len(itens) > limite:
+            break
+
+    proximo_cursor = None
+    if len(itens) > limite:
+        itens = itens[:limite]
+        proximo_cursor = codificar_cursor_proximidade(*itens[-1])
+    return [(nivel, id_produto) for nivel, _, id_produto in itens], proximo_cursor
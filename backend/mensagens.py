@@ -0,0 +1,72 @@
+from models import db, Mensagem, MensagemArquivada, Usuario
+from metricas import medir_serializacao
+
+# Leitura do histórico do chat pelo índice (id_solicitacao, id_mensagem),
+# selecionando só as colunas usadas na resposta. O custo depende do tamanho
+# da página pedida, não do total de mensagens da negociação.
+# Com arquivada=True as mesmas consultas leem MENSAGEM_ARQUIVO (ver arquivamento.py).
+
+LIMITE_PADRAO_MENSAGENS = 50
+LIMITE_MAXIMO_MENSAGENS = 200
+
+
+def _colunas(modelo=Mensagem):
+    # Junção externa: no arquivo o remetente pode já ter sido removido
+    return db.select(
+        modelo.id_mensagem, modelo.conteudo_mensagem, modelo.id_usuario,
+        modelo.data_envio, modelo.id_solicitacao, Usuario.nome_usuario
+    ).join(Usuario, modelo.id_usuario == Usuario.id_usuario, isouter=modelo is MensagemArquivada)
+
+
+@medir_serializacao
+def linha_para_dict(linha):
+    # Mesmo formato de Mensagem.to_dict
+    return {
+        'id_mensagem': linha.id_mensagem,
+        'conteudo_mensagem': linha.conteudo_mensagem,
+        'id_usuario': linha.id_usuario,
+        'nome_remetente': linha.nome_usuario,
+        'data_envio': linha.data_envio.isoformat() if linha.data_envio else None
+    }
+
+
+def mensagens_por_ids(ids_mensagens):
+    # Várias mensagens (com o nome do remetente) em uma única consulta
+    if not ids_mensagens:
+        return []
+    linhas = db.session.execute(
+        _colunas()
+        .where(Mensagem.id_mensagem.in_(ids_mensagens))
+        .order_by(Mensagem.id_mensagem)
+    ).all()
+    return [linha_para_dict(linha) for linha in linhas]
+
+
+def mensagens_apos(id_solicitacao, apos_id, limite=LIMITE_MAXIMO_MENSAGENS, arquivada=False):
+    # Mensagens mais novas que apos_id, em ordem cronológica
+    modelo = MensagemArquivada if arquivada else Mensagem
+    linhas = db.session.execute(
+        _colunas(modelo)
+        .where(modelo.id_solicitacao == id_solicitacao, modelo.id_mensagem > apos_id)
+        .order_by(modelo.id_mensagem)
+        .limit(limite)
+    ).all()
+    return [linha_para_dict(linha) for linha in linhas]
+
+
+def mensagens_antes(id_solicitacao, antes_id=None, limite=LIMITE_PADRAO_MENSAGENS, arquivada=False):
+    # As `limite` mensagens anteriores a antes_id (ou as últimas, se None), em
+    # ordem cronológica, e se ainda existem mensagens mais antigas que elas.
+    modelo = MensagemArquivada if arquivada else Mensagem
+    query = _colunas(modelo).where(modelo.id_solicitacao == id_solicitacao)
+    if antes_id is not None:
+        query = query.where(modelo.id_mensagem < antes_id)
+    linhas = db.session.execute(
+        query.order_by(modelo.id_mensagem.desc()).limit(limite + 1)
+    ).all()
+    tem_anteriores = len(linhas) > limite
+    return [linha_para_dict(linha) for linha in reversed(linhas[:limite])], tem_anteriores
+
+
+def ultimas_mensagens(id_solicitacao, limite=LIMITE_PADRAO_MENSAGENS, arquivada=False):
+    return mensagens_antes(id_solicitacao, None, limite, arquivada)
@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request, has_app_context, Response, abort
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Métricas por rota no formato texto do Prometheus, em GET /metrics:
+#   ecotroca_requisicao_segundos      histograma da duração das requisições
+#   ecotroca_sql_consultas_total      consultas SQL executadas
+#   ecotroca_sql_segundos_total       tempo gasto no banco
+#   ecotroca_serializacao_segundos_total  tempo montando os dicionários (to_dict)
+#   ecotroca_json_segundos_total      tempo gerando o JSON das respostas
+#   ecotroca_resposta_bytes_total     bytes enviados no corpo
+# A serialização é medida pelos métodos marcados com @medir_serializacao (os
+# to_dict dos modelos e os montadores de campos.py, mensagens.py e
+# negociacoes_leitura.py), sem o SQL que eles disparam (lazy loads contam como
+# SQL). O tempo restante (duração - SQL - serialização - JSON) é o código da rota.
+#
+# Os contadores são de cada processo. Com vários workers, cada um responde
+# pelos seus números; some por instância no Prometheus.
+#
+# Requisições mais lentas que METRICAS_LIMITE_LENTO_MS são registradas no log
+# com as consultas SQL mais demoradas.
+#
+# Orçamento de consultas: @orcamento_consultas(n) declara quantas consultas a
+# rota pode fazer. Com ORCAMENTO_CONSULTAS_ATIVO (ligado por padrão quando
+# app.testing), uma requisição que passa do limite levanta
+# OrcamentoConsultasExcedido com as consultas executadas, o que faz o teste
+# falhar; fora dos testes o excesso só é registrado no log. Serve para pegar
+# N+1 introduzidos por mudanças nos to_dict e nos relacionamentos.
+# Nas leituras os limites ficam cerca de 25% (no mínimo 2) acima do que a rota
+# faz hoje: uma consulta a mais não quebra nada, um N+1 passa do limite assim
+# que a lista cresce. Nas escritas a folga é de 2 (a conta de POST /solicitacao
+# está na rota).
+# tests/test_orcamento_consultas.py confere todas as rotas a cada execução do
+# pytest (python -m benchmarks.orcamento_consultas mostra os números).
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAXIMO_CONSULTAS_CAPTURADAS = 200
+CONSULTAS_NO_LOG = 10
+
+
+class OrcamentoConsultasExcedido(AssertionError):
+    pass
+
+
+def orcamento_consultas(maximo):
+    # Decorator das rotas; o valor é lido em app.view_functions no fim da requisição
+    def decorator(view):
+        view.orcamento_consultas = maximo
+        return view
+    return decorator
+
+
+def medir_serializacao(funcao):
+    # Soma em g o tempo da chamada mais externa: to_dict aninhados (o produto e
+    # suas imagens) não contam duas vezes
+    @wraps(funcao)
+    def wrapper(*args, **kwargs):
+        if not has_app_context() or 'metricas_inicio' not in g or g.metricas_serializando:
+            return funcao(*args, **kwargs)
+        g.metricas_serializando = True
+        sql_antes = g.metricas_sql
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            g.metricas_serializando = False
+            g.metricas_serializacao += time.perf_counter() - inicio - (g.metricas_sql - sql_antes)
+    return wrapper
+
+
+class ProvedorJSONMedido(DefaultJSONProvider):
+    # Soma em g o tempo gasto serializando respostas (jsonify). Provedores
+    # derivados (serializacao.py) envolvem a codificação em self._medindo().
+    def dumps(self, obj, **kwargs):
+        with self._medindo():
+            return super().dumps(obj, **kwargs)
+
+    @contextmanager
+    def _medindo(self):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            if has_app_context() and 'metricas_inicio' in g:
+                g.metricas_json += time.perf_counter() - inicio
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _antes_da_consulta(conn, cursor, statement, parameters, context, executemany):
+    context._metricas_inicio_consulta = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _depois_da_consulta(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - context._metricas_inicio_consulta
+    if not has_app_context() or 'metricas_inicio' not in g:
+        return  # Fora de uma requisição (CLI, threads de fundo)
+    g.metricas_consultas += 1
+    g.metricas_sql += duracao
+    if g.metricas_capturar and len(g.metricas_sql_capturado) < MAXIMO_CONSULTAS_CAPTURADAS:
+        g.metricas_sql_capturado.append((duracao, statement))
+
+
+class _Histograma:
+    __slots__ = ('buckets', 'soma', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS_SEGUNDOS)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for indice, limite in enumerate(BUCKETS_SEGUNDOS):
+            if valor <= limite:
+                self.buckets[indice] += 1
+        self.soma += valor
+        self.total += 1
+
+
+class _Rota:
+    __slots__ = ('duracao', 'consultas', 'sql', 'serializacao', 'json', 'bytes')
+
+    def __init__(self):
+        self.duracao = _Histograma()
+        self.consultas = 0
+        self.sql = 0.0
+        self.serializacao = 0.0
+        self.json = 0.0
+        self.bytes = 0
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metricas:
+    def __init__(self, app=None):
+        self.app = None
+        self._trava = threading.Lock()
+        self._rotas = {}  # (método, rota, status) -> _Rota
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('METRICAS_LIMITE_LENTO_MS', float(os.environ.get('METRICAS_LIMITE_LENTO_MS', 0)))
+        # Se definido, /metrics exige "Authorization: Bearer <token>"
+        app.config.setdefault('METRICAS_TOKEN', os.environ.get('METRICAS_TOKEN'))
+        # None: ativo apenas quando app.testing
+        app.config.setdefault('ORCAMENTO_CONSULTAS_ATIVO', None)
+        if not isinstance(app.json, ProvedorJSONMedido):
+            app.json_provider_class = ProvedorJSONMedido
+            app.json = ProvedorJSONMedido(app)
+        app.before_request(self._iniciar)
+        app.after_request(self._registrar)
+        app.add_url_rule('/metrics', 'metricas', self.exportar)
+        app.extensions['metricas'] = self
+
+    def _iniciar(self):
+        g.metricas_inicio = time.perf_counter()
+        g.metricas_consultas = 0
+        g.metricas_sql = 0.0
+        g.metricas_serializacao = 0.0
+        g.metricas_serializando = False
+        g.metricas_json = 0.0
+        g.metricas_capturar = self.app.config['METRICAS_LIMITE_LENTO_MS'] > 0 or self._orcamento_ativo()
+        g.metricas_sql_capturado = []
+
+    def _orcamento_ativo(self):
+        ativo = self.app.config['ORCAMENTO_CONSULTAS_ATIVO']
+        return self.app.testing if ativo is None else bool(ativo)
+
+    def _verificar_orcamento(self):
+        view = self.app.view_functions.get(request.endpoint)
+        maximo = getattr(view, 'orcamento_consultas', None)
+        if maximo is None or g.metricas_consultas <= maximo or not self._orcamento_ativo():
+            return
+        consultas = '\n'.join(f'  {i}. {" ".join(sql.split())}' for i, (_, sql) in enumerate(g.metricas_sql_capturado, 1))
+        mensagem = (
+            f"{request.method} {request.full_path} fez {g.metricas_consultas} consultas "
+            f"(orçamento: {maximo}):\n{consultas}"
+        )
+        if self.app.testing:
+            raise OrcamentoConsultasExcedido(mensagem)
+        self.app.logger.warning(f"Orçamento de consultas excedido: {mensagem}")
+
+    def _registrar(self, resposta):
+        if 'metricas_inicio' not in g or request.endpoint == 'metricas':
+            return resposta
+        duracao = time.perf_counter() - g.metricas_inicio
+        rota = request.url_rule.rule if request.url_rule else 'sem_rota'
+        tamanho = resposta.content_length if resposta.is_streamed else resposta.calculate_content_length()
+
+        with self._trava:
+            chave = (request.method, rota, resposta.status_code)
+            dados = self._rotas.get(chave)
+            if dados is None:
+                dados = self._rotas[chave] = _Rota()
+            dados.duracao.observar(duracao)
+            dados.consultas += g.metricas_consultas
+            dados.sql += g.metricas_sql
+            dados.serializacao += g.metricas_serializacao
+            dados.json += g.metricas_json
+            dados.bytes += tamanho or 0
+
+        self._verificar_orcamento()
+
+        limite = self.app.config['METRICAS_LIMITE_LENTO_MS']
+        if limite and duracao * 1000 >= limite:
+            mais_lentas = sorted(g.metricas_sql_capturado, key=lambda c: c[0], reverse=True)[:CONSULTAS_NO_LOG]
+            consultas = '\n'.join(f'  {d * 1000:.1f} ms: {" ".join(sql.split())}' for d, sql in mais_lentas)
+            self.app.logger.warning(
+                f"Requisição lenta: {request.method} {request.full_path} -> {resposta.status_code} "
+                f"em {duracao * 1000:.1f} ms ({g.metricas_consultas} consultas, SQL {g.metricas_sql * 1000:.1f} ms, "
+                f"to_dict {g.metricas_serializacao * 1000:.1f} ms, JSON {g.metricas_json * 1000:.1f} ms)\n{consultas}"
+            )
+        return resposta
+
+    def exportar(self):
+        token = self.app.config.get('METRICAS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+
+        with self._trava:
+            itens = sorted(
+                ((chave, dados.duracao.buckets[:], dados.duracao.soma, dados.duracao.total,
+                  dados.consultas, dados.sql, dados.serializacao, dados.json, dados.bytes)
+                 for chave, dados in self._rotas.items()),
+                key=lambda item: item[0]
+            )
+
+        linhas = [
+            '# HELP ecotroca_requisicao_segundos Duração das requisições por rota.',
+            '# TYPE ecotroca_requisicao_segundos histogram',
+        ]
+        for (metodo, rota, status), buckets, soma, total, *_ in itens:
+            rotulos = f'metodo="{metodo}",rota="{_escapar(rota)}",status="{status}"'
+            for limite, quantidade in zip(BUCKETS_SEGUNDOS, buckets):
+                linhas.append(f'ecotroca_requisicao_segundos_bucket{{{rotulos},le="{limite}"}} {quantidade}')
+            linhas.append(f'ecotroca_requisicao_segundos_bucket{{{rotulos},le="+Inf"}} {total}')
+            linhas.append(f'ecotroca_requisicao_segundos_sum{{{rotulos}}} {soma}')
+            linhas.append(f'ecotroca_requisicao_segundos_count{{{rotulos}}} {total}')
+
+        contadores = (
+            ('ecotroca_sql_consultas_total', 'Consultas SQL executadas pelas requisições.', 4),
+            ('ecotroca_sql_segundos_total', 'Tempo gasto em consultas SQL.', 5),
+            ('ecotroca_serializacao_segundos_total', 'Tempo gasto montando os dicionários das respostas (to_dict), sem SQL.', 6),
+            ('ecotroca_json_segundos_total', 'Tempo gasto serializando respostas JSON.', 7),
+            ('ecotroca_resposta_bytes_total', 'Bytes enviados no corpo das respostas.', 8),
+        )
+        for nome, ajuda, posicao in contadores:
+            linhas.append(f'# HELP {nome} {ajuda}')
+            linhas.append(f'# TYPE {nome} counter')
+            for item in itens:
+                metodo, rota, status = item[0]
+                linhas.append(f'{nome}{{metodo="{metodo}",rota="{_escapar(rota)}",status="{status}"}} {item[posicao]}')
+
+        return Response('\n'.join(linhas) + '\n', mimetype='text/plain; version=0.0.4; charset=utf-8')
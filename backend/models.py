@@ -4,8 +4,12 @@ from flask_login import UserMixin
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from banco import SessaoRoteada
+from metricas import medir_serializacao
+
 # Inicializa o objeto SQLAlchemy.
-db = SQLAlchemy()
+# A sessão escolhe entre o primário e as réplicas de leitura (ver banco.py)
+db = SQLAlchemy(session_options={'class_': SessaoRoteada})
 
 # --- Enums ---
 class StatusProduto(enum.Enum):
@@ -32,23 +36,42 @@ class Imagem(db.Model):
     descricao_imagem = db.Column(db.String(100), nullable=True)
     # Chave estrangeira corrigida para referenciar 'PRODUTO.id_produto'
     id_produto = db.Column(db.Integer, db.ForeignKey('PRODUTO.id_produto'), nullable=False)
+    # Variantes redimensionadas, preenchidas em segundo plano após o upload (None até lá)
+    url_thumb = db.Column(db.String(200), nullable=True)
+    url_thumb_webp = db.Column(db.String(200), nullable=True)
+    url_media = db.Column(db.String(200), nullable=True)
+    url_media_webp = db.Column(db.String(200), nullable=True)
 
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_imagem': self.id_imagem,
             'url_imagem': self.url_imagem,
-            'descricao_imagem': self.descricao_imagem
+            'descricao_imagem': self.descricao_imagem,
+            'url_thumb': self.url_thumb,
+            'url_thumb_webp': self.url_thumb_webp,
+            'url_media': self.url_media,
+            'url_media_webp': self.url_media_webp
         }
 
     def __repr__(self) -> str:
         return f"<Imagem(id={self.id_imagem}, url='{self.url_imagem[:30]}...')>"
 
+# Arquivo de upload endereçado pelo conteúdo e quantas imagens o utilizam (mantido por armazenamento.py)
+class Arquivo(db.Model):
+    __tablename__ = 'ARQUIVO' # Nome da tabela em maiúsculas
+    url_arquivo = db.Column(db.String(200), primary_key=True)
+    referencias = db.Column(db.Integer, nullable=False, default=0, index=True)
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    data_cadastro = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 class Categoria(db.Model):
     __tablename__ = 'CATEGORIA' # Nome da tabela em maiúsculas
     id_categoria = db.Column(db.Integer, primary_key=True, autoincrement=True)
     nome_categoria = db.Column(db.String(50), nullable=False) # Ajustado o tamanho de 20 para 50 para comportar melhor 'TROCA', 'DOAÇÃO'
     descricao = db.Column(db.String(100), nullable=False) # Ajustado o tamanho de 80 para 100
 
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_categoria': self.id_categoria,
@@ -67,6 +90,10 @@ tabela_produto_categoria = db.Table(
 
 class Produto(db.Model):
     __tablename__ = 'PRODUTO' # Nome da tabela em maiúsculas
+    __table_args__ = (
+        # Índice usado pela listagem de produtos disponíveis com paginação por cursor
+        db.Index('idx_produto_disponivel_data', 'disponivel', 'data_cadastro', 'id_produto'),
+    )
     id_produto = db.Column(db.Integer, primary_key=True, autoincrement=True)
     nome_produto = db.Column(db.String(80), nullable=False)
     descricao = db.Column(db.String(200), nullable=False)
@@ -76,12 +103,15 @@ class Produto(db.Model):
     status = db.Column(db.Enum(StatusProduto), nullable=False, default=StatusProduto.NOVO)
     quantidade = db.Column(db.Integer, nullable=False, default=1)
     valor = db.Column(db.Numeric(10, 2), nullable=True) # Campo valor adicionado conforme SQL
+    # Falso enquanto o produto estiver em solicitação PENDENTE ou APROVADA (mantido por disponibilidade.py)
+    disponivel = db.Column(db.Boolean, nullable=False, default=True)
 
     # Relacionamentos
     imagens = db.relationship("Imagem", backref="produto", lazy="selectin", cascade="all, delete-orphan")
     categoria = db.relationship("Categoria", foreign_keys=[id_categoria])
     proprietario = db.relationship("Usuario", back_populates="produtos")
 
+    @medir_serializacao
     def to_dict(self, include_owner=False, include_categoria=True, include_imagens=True):
         data = {
             'id_produto': self.id_produto,
@@ -104,6 +134,29 @@ class Produto(db.Model):
     def __repr__(self) -> str:
         return f"<Produto(id={self.id_produto}, nome='{self.nome_produto}')>"
 
+# Índice invertido da busca de produtos (mantido por busca.py)
+class ProdutoTermo(db.Model):
+    __tablename__ = 'PRODUTO_TERMO' # Nome da tabela em maiúsculas
+    termo = db.Column(db.String(50), primary_key=True) # Termo normalizado (minúsculo e sem acento)
+    id_produto = db.Column(db.Integer, db.ForeignKey('PRODUTO.id_produto', ondelete='CASCADE'), primary_key=True, index=True)
+    peso = db.Column(db.SmallInteger, nullable=False, default=1)
+
+# Índice de localidade dos produtos: cidade, estado e prefixo do CEP do endereço
+# principal do proprietário, copiados para a listagem "perto de mim" (mantido por localidade.py)
+class ProdutoLocalidade(db.Model):
+    __tablename__ = 'PRODUTO_LOCALIDADE' # Nome da tabela em maiúsculas
+    __table_args__ = (
+        db.Index('idx_produto_localidade_cep', 'cep_prefixo', 'data_cadastro', 'id_produto'),
+        db.Index('idx_produto_localidade_cidade', 'estado', 'cidade', 'data_cadastro', 'id_produto'),
+        db.Index('idx_produto_localidade_data', 'data_cadastro', 'id_produto'),
+    )
+    id_produto = db.Column(db.Integer, db.ForeignKey('PRODUTO.id_produto', ondelete='CASCADE'), primary_key=True)
+    id_usuario = db.Column(db.Integer, db.ForeignKey('USUARIO.id_usuario'), nullable=False, index=True)
+    cidade = db.Column(db.String(80), nullable=False) # Minúscula e sem acento
+    estado = db.Column(db.String(50), nullable=False) # Minúsculo e sem acento
+    cep_prefixo = db.Column(db.String(5), nullable=False) # 5 primeiros dígitos (setor do CEP)
+    data_cadastro = db.Column(db.DateTime, nullable=False) # Cópia de PRODUTO.data_cadastro para ordenar pelo índice
+
 class Usuario(UserMixin, db.Model):
     __tablename__ = 'USUARIO' # Nome da tabela em maiúsculas
     id_usuario = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -119,7 +172,8 @@ class Usuario(UserMixin, db.Model):
     enderecos_usuario = db.relationship("EnderecoUsuario", backref="usuario", lazy="dynamic", cascade="all, delete-orphan")
     produtos = db.relationship("Produto", back_populates="proprietario", lazy="dynamic")
     solicitacoes_feitas = db.relationship("Solicitacao", foreign_keys="Solicitacao.id_usuario_solicitante", backref="usuario_solicitante_obj", lazy="dynamic")
-    mensagens_enviadas = db.relationship("Mensagem", foreign_keys="Mensagem.id_usuario", backref="usuario_obj", lazy="dynamic")
+    # usuario_obj é carregado com JOIN junto da mensagem, para que Mensagem.to_dict não faça uma consulta por linha
+    mensagens_enviadas = db.relationship("Mensagem", foreign_keys="Mensagem.id_usuario", backref=db.backref("usuario_obj", lazy="joined"), lazy="dynamic")
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
@@ -127,6 +181,7 @@ class Usuario(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_usuario': self.id_usuario,
@@ -138,6 +193,7 @@ class Usuario(UserMixin, db.Model):
             'data_cadastro': self.data_cadastro.isoformat() if self.data_cadastro else None
         }
 
+    @medir_serializacao
     def to_dict_simple(self):
         return {
             'id_usuario': self.id_usuario,
@@ -159,6 +215,7 @@ class EnderecoUsuario(db.Model):
     estado = db.Column(db.String(50), nullable=False)
     id_usuario = db.Column(db.Integer, db.ForeignKey('USUARIO.id_usuario'), nullable=False) # Referencia 'USUARIO'
 
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_endereco': self.id_endereco,
@@ -177,12 +234,18 @@ class EnderecoUsuario(db.Model):
 
 class Mensagem(db.Model):
     __tablename__ = 'MENSAGEM' # Nome da tabela em maiúsculas
+    __table_args__ = (
+        # Leitura do histórico por negociação em ordem (paginação por id_mensagem)
+        db.Index('idx_mensagem_solicitacao_id', 'id_solicitacao', 'id_mensagem'),
+    )
     id_mensagem = db.Column(db.Integer, primary_key=True, autoincrement=True)
     conteudo_mensagem = db.Column(db.String(500), nullable=False) # SQL original era VARCHAR(100)
     data_envio = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # SQL original era DATE
     id_usuario = db.Column(db.Integer, db.ForeignKey('USUARIO.id_usuario'), nullable=False) # Referencia 'USUARIO'
     id_solicitacao = db.Column(db.Integer, db.ForeignKey('SOLICITACAO.id_solicitacao'), nullable=False) # Referencia 'SOLICITACAO'
 
+    # Para listas de mensagens prefira mensagens.py, que não cria objetos ORM por linha
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_mensagem': self.id_mensagem,
@@ -200,6 +263,7 @@ class Transacao(db.Model):
     id_transacao = db.Column(db.Integer, primary_key=True, autoincrement=True)
     data_transacao = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # SQL original era DATE
 
+    @medir_serializacao
     def to_dict(self):
         return {
             'id_transacao': self.id_transacao,
@@ -209,6 +273,23 @@ class Transacao(db.Model):
     def __repr__(self) -> str:
         return f"<Transacao(id={self.id_transacao}, data='{self.data_transacao}')>"
 
+# Contador de alterações por tabela, usado para gerar ETags (mantido por versoes.py)
+class VersaoTabela(db.Model):
+    __tablename__ = 'VERSAO_TABELA' # Nome da tabela em maiúsculas
+    nome = db.Column(db.String(64), primary_key=True)
+    versao = db.Column(db.BigInteger, nullable=False, default=0)
+
+# Primeira resposta de cada Idempotency-Key, reenviada nas repetições (mantido por idempotencia.py)
+class RespostaIdempotente(db.Model):
+    __tablename__ = 'IDEMPOTENCIA' # Nome da tabela em maiúsculas
+    chave = db.Column(db.String(64), primary_key=True) # sha256 de usuário, método, rota e chave enviada
+    id_usuario = db.Column(db.Integer, nullable=False)
+    impressao = db.Column(db.String(64), nullable=False) # sha256 do corpo da requisição
+    status_http = db.Column(db.SmallInteger, nullable=True) # NULL enquanto a requisição original está em andamento
+    tipo_conteudo = db.Column(db.String(100), nullable=True)
+    corpo = db.Column(db.LargeBinary(length=16777215), nullable=True)
+    data_expiracao = db.Column(db.DateTime, nullable=False, index=True)
+
 # Tabela de associação para produtos ofertados em uma solicitação de troca
 # O nome da tabela no __tablename__ deve corresponder ao usado no 'secondary'
 # do relacionamento em Solicitacao.produtos_ofertados
@@ -238,6 +319,7 @@ class Solicitacao(db.Model):
         backref="solicitacoes_onde_foi_ofertado" # Nome do backref ajustado para clareza
     )
 
+    @medir_serializacao
     def to_dict(self, include_produtos_details=False):
         data = {
             'id_solicitacao': self.id_solicitacao,
@@ -262,4 +344,35 @@ class Solicitacao(db.Model):
         return data
 
     def __repr__(self) -> str:
-        return f"<Solicitacao(id={self.id_solicitacao}, status='{self.status.value}')>"
\ No newline at end of file
+        return f"<Solicitacao(id={self.id_solicitacao}, status='{self.status.value}')>"
+
+# --- Arquivo das negociações encerradas (mantido por arquivamento.py) ---
+# Solicitações RECUSADAS e CANCELADAS antigas saem das tabelas principais com
+# as mensagens e os produtos ofertados. Mesmas colunas e IDs das originais, sem
+# chaves estrangeiras: o produto ou o usuário podem ser removidos depois.
+
+class SolicitacaoArquivada(db.Model):
+    __tablename__ = 'SOLICITACAO_ARQUIVO' # Nome da tabela em maiúsculas
+    id_solicitacao = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    status = db.Column(db.Enum(StatusSolicitacao), nullable=False)
+    data_solicitacao = db.Column(db.DateTime, nullable=False)
+    id_usuario_solicitante = db.Column(db.Integer, nullable=False, index=True)
+    id_produto_desejado = db.Column(db.Integer, nullable=True, index=True)
+    id_transacao = db.Column(db.Integer, nullable=True)
+    data_arquivamento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SolicitacaoProdutoOfertadoArquivado(db.Model):
+    __tablename__ = 'SOLICITACAO_PRODUTO_OFERTADO_ARQUIVO' # Nome da tabela em maiúsculas
+    id_solicitacao = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    id_produto = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+class MensagemArquivada(db.Model):
+    __tablename__ = 'MENSAGEM_ARQUIVO' # Nome da tabela em maiúsculas
+    __table_args__ = (
+        db.Index('idx_mensagem_arquivo_solicitacao_id', 'id_solicitacao', 'id_mensagem'),
+    )
+    id_mensagem = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    conteudo_mensagem = db.Column(db.String(500), nullable=False)
+    data_envio = db.Column(db.DateTime, nullable=False)
+    id_usuario = db.Column(db.Integer, nullable=False)
+    id_solicitacao = db.Column(db.Integer, nullable=False)
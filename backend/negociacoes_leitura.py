@@ -0,0 +1,239 @@
+from campos import ESQUEMA_NEGOCIACAO, montar_selecao
+from metricas import medir_serializacao
+from models import (
+    db, Solicitacao, SolicitacaoProdutoOfertado, Produto, Usuario, Categoria, Imagem,
+    SolicitacaoArquivada, SolicitacaoProdutoOfertadoArquivado
+)
+
+# Leitura rápida de /usuario/negociacoes. Em vez de carregar Solicitacao, Produto,
+# Usuario, Categoria e Imagem como objetos ORM e chamar os to_dict aninhados,
+# seleciona só as colunas usadas em quatro consultas fixas e monta o JSON em uma
+# passada. Cada produto é serializado uma única vez, mesmo que apareça em várias
+# negociações. O formato da resposta é o mesmo de Solicitacao.to_dict(include_produtos_details=True).
+# As negociações arquivadas (ver arquivamento.py) também são lidas daqui.
+#
+# A seleção de ?fields= e ?expand= (campos.py) decide o que é consultado: sem
+# produtos expandidos nem tipo_solicitacao não há consulta de produtos, sem
+# imagens expandidas não há consulta de imagens, e os ofertados só são lidos se
+# produtos_ofertados ou produtos_ofertados_details forem pedidos.
+
+TAMANHO_LOTE_IN = 1000
+SELECAO_COMPLETA = montar_selecao(ESQUEMA_NEGOCIACAO)
+
+
+def _em_lotes(ids):
+    ids = list(ids)
+    for inicio in range(0, len(ids), TAMANHO_LOTE_IN):
+        yield ids[inicio:inicio + TAMANHO_LOTE_IN]
+
+
+def _iso(valor):
+    return valor.isoformat() if valor else None
+
+
+def _imagens_por_produto(ids_produtos):
+    imagens = {}
+    for lote in _em_lotes(ids_produtos):
+        linhas = db.session.execute(
+            db.select(
+                Imagem.id_imagem, Imagem.id_produto, Imagem.url_imagem, Imagem.descricao_imagem,
+                Imagem.url_thumb, Imagem.url_thumb_webp, Imagem.url_media, Imagem.url_media_webp
+            )
+            .where(Imagem.id_produto.in_(lote))
+            .order_by(Imagem.id_imagem)
+        ).all()
+        for linha in linhas:
+            imagens.setdefault(linha.id_produto, []).append({
+                'id_imagem': linha.id_imagem,
+                'url_imagem': linha.url_imagem,
+                'descricao_imagem': linha.descricao_imagem,
+                'url_thumb': linha.url_thumb,
+                'url_thumb_webp': linha.url_thumb_webp,
+                'url_media': linha.url_media,
+                'url_media_webp': linha.url_media_webp
+            })
+    return imagens
+
+
+@medir_serializacao
+def _produto(linha, imagens, selecao):
+    # Mesmo formato de Produto.to_dict(include_owner=True, include_categoria=True, include_imagens=True)
+    produto = selecao.filtrar({
+        'id_produto': linha.id_produto,
+        'nome_produto': linha.nome_produto,
+        'descricao': linha.descricao,
+        'id_usuario': linha.id_usuario,
+        'data_cadastro': _iso(linha.data_cadastro),
+        'status': linha.status.value if linha.status else None,
+        'quantidade': linha.quantidade,
+        'valor': float(linha.valor) if linha.valor is not None else None
+    })
+    if selecao.expande('proprietario_details') and linha.nome_usuario is not None:
+        produto['proprietario_details'] = {
+            'id_usuario': linha.id_usuario,
+            'nome_usuario': linha.nome_usuario
+        }
+    if selecao.expande('categoria') and linha.id_categoria is not None:
+        produto['categoria'] = {
+            'id_categoria': linha.id_categoria,
+            'nome_categoria': linha.nome_categoria,
+            'descricao': linha.descricao_categoria
+        }
+    if selecao.expande('imagens'):
+        produto['imagens'] = imagens.get(linha.id_produto, [])
+    return produto
+
+
+def _produtos_por_id(ids_produtos, selecoes):
+    # Para cada seleção de produto (as de produto_desejado e de
+    # produtos_ofertados_details podem diferir), {id_produto: dict}; seleções
+    # iguais compartilham os dicts. Também devolve {id_produto: nome_categoria}
+    # para o tipo_solicitacao.
+    selecoes = [selecao for selecao in selecoes if selecao is not None]
+    imagens = {}
+    if any(selecao.expande('imagens') for selecao in selecoes):
+        imagens = _imagens_por_produto(ids_produtos)
+    produtos = {selecao: {} for selecao in selecoes}
+    categorias = {}
+    for lote in _em_lotes(ids_produtos):
+        linhas = db.session.execute(
+            db.select(
+                Produto.id_produto, Produto.nome_produto, Produto.descricao, Produto.id_usuario,
+                Produto.data_cadastro, Produto.status, Produto.quantidade, Produto.valor,
+                Usuario.nome_usuario,
+                Categoria.id_categoria, Categoria.nome_categoria, Categoria.descricao.label('descricao_categoria')
+            )
+            .outerjoin(Usuario, Produto.id_usuario == Usuario.id_usuario)
+            .outerjoin(Categoria, Produto.id_categoria == Categoria.id_categoria)
+            .where(Produto.id_produto.in_(lote))
+        ).all()
+        for linha in linhas:
+            categorias[linha.id_produto] = linha.nome_categoria
+            for selecao, por_id in produtos.items():
+                por_id[linha.id_produto] = _produto(linha, imagens, selecao)
+    return produtos, categorias
+
+
+@medir_serializacao
+def _montar_negociacao(s, ids_ofertados, produtos, categorias, selecao):
+    item = selecao.filtrar({
+        'id_solicitacao': s.id_solicitacao,
+        'status': s.status.value if s.status else None,
+        'data_solicitacao': _iso(s.data_solicitacao),
+        'id_usuario_solicitante': s.id_usuario_solicitante,
+        'id_produto_desejado': s.id_produto_desejado,
+        'id_transacao': s.id_transacao,
+        'produtos_ofertados': ids_ofertados
+    })
+    if selecao.expande('usuario_solicitante') and s.nome_solicitante is not None:
+        item['usuario_solicitante'] = {
+            'id_usuario': s.id_usuario_solicitante,
+            'nome_usuario': s.nome_solicitante
+        }
+    if selecao.expande('produto_desejado'):
+        produto_desejado = produtos[selecao.de('produto_desejado')].get(s.id_produto_desejado)
+        if produto_desejado:
+            item['produto_desejado'] = produto_desejado
+    if selecao.expande('produtos_ofertados_details'):
+        detalhes = produtos[selecao.de('produtos_ofertados_details')]
+        item['produtos_ofertados_details'] = [detalhes[i] for i in ids_ofertados if i in detalhes]
+    if selecao.inclui('tipo_solicitacao') and categorias.get(s.id_produto_desejado) is not None:
+        item['tipo_solicitacao'] = categorias[s.id_produto_desejado]
+    return item
+
+
+def _precisa_de_produtos(selecao):
+    return (selecao.expande('produto_desejado') or selecao.expande('produtos_ofertados_details')
+            or selecao.inclui('tipo_solicitacao'))
+
+
+def _precisa_de_ofertados(selecao):
+    return selecao.inclui('produtos_ofertados') or selecao.expande('produtos_ofertados_details')
+
+
+def _solicitacoes_do_usuario(modelo, id_usuario):
+    return db.select(
+        modelo.id_solicitacao, modelo.status, modelo.data_solicitacao,
+        modelo.id_usuario_solicitante, modelo.id_produto_desejado,
+        modelo.id_transacao, Usuario.nome_usuario.label('nome_solicitante')
+    )\
+        .join(Produto, modelo.id_produto_desejado == Produto.id_produto)\
+        .outerjoin(Usuario, modelo.id_usuario_solicitante == Usuario.id_usuario)\
+        .where(db.or_(
+            modelo.id_usuario_solicitante == id_usuario,
+            Produto.id_usuario == id_usuario
+        ))
+
+
+def negociacoes_do_usuario(id_usuario, selecao=SELECAO_COMPLETA):
+    # Negociações em que o usuário é o solicitante ou o dono do produto desejado,
+    # da mais recente para a mais antiga, incluindo as arquivadas (UNION ALL:
+    # o arquivo não acrescenta consultas).
+    todas = db.union_all(
+        _solicitacoes_do_usuario(Solicitacao, id_usuario),
+        _solicitacoes_do_usuario(SolicitacaoArquivada, id_usuario)
+    ).subquery()
+    solicitacoes = db.session.execute(
+        db.select(todas).order_by(todas.c.data_solicitacao.desc())
+    ).all()
+    if not solicitacoes:
+        return []
+
+    ofertados = {}
+    for lote in _em_lotes(s.id_solicitacao for s in solicitacoes if _precisa_de_ofertados(selecao)):
+        linhas = db.session.execute(
+            db.union_all(
+                # O join deixa de fora produtos apagados, como o relacionamento do to_dict
+                db.select(SolicitacaoProdutoOfertado.id_solicitacao.label('id_solicitacao'), Produto.id_produto.label('id_produto'))
+                .join(Produto, SolicitacaoProdutoOfertado.id_produto == Produto.id_produto)
+                .where(SolicitacaoProdutoOfertado.id_solicitacao.in_(lote)),
+                db.select(SolicitacaoProdutoOfertadoArquivado.id_solicitacao.label('id_solicitacao'), Produto.id_produto.label('id_produto'))
+                .join(Produto, SolicitacaoProdutoOfertadoArquivado.id_produto == Produto.id_produto)
+                .where(SolicitacaoProdutoOfertadoArquivado.id_solicitacao.in_(lote))
+            ).order_by('id_solicitacao', 'id_produto')
+        ).all()
+        for linha in linhas:
+            ofertados.setdefault(linha.id_solicitacao, []).append(linha.id_produto)
+
+    produtos, categorias = {}, {}
+    if _precisa_de_produtos(selecao):
+        ids_produtos = {s.id_produto_desejado for s in solicitacoes}
+        for ids in ofertados.values():
+            ids_produtos.update(ids)
+        produtos, categorias = _produtos_por_id(
+            ids_produtos, [selecao.de('produto_desejado'), selecao.de('produtos_ofertados_details')]
+        )
+
+    return [
+        _montar_negociacao(s, ofertados.get(s.id_solicitacao, []), produtos, categorias, selecao)
+        for s in solicitacoes
+    ]
+
+
+def negociacao_arquivada(id_solicitacao):
+    # Negociação do arquivo no formato de Solicitacao.to_dict(include_produtos_details=True).
+    # Retorna (dict, id do dono do produto desejado), ou (None, None) se não estiver arquivada.
+    s = db.session.execute(
+        db.select(
+            SolicitacaoArquivada.id_solicitacao, SolicitacaoArquivada.status, SolicitacaoArquivada.data_solicitacao,
+            SolicitacaoArquivada.id_usuario_solicitante, SolicitacaoArquivada.id_produto_desejado,
+            SolicitacaoArquivada.id_transacao, Usuario.nome_usuario.label('nome_solicitante'),
+            Produto.id_usuario.label('id_dono')
+        )
+        .outerjoin(Usuario, SolicitacaoArquivada.id_usuario_solicitante == Usuario.id_usuario)
+        .outerjoin(Produto, SolicitacaoArquivada.id_produto_desejado == Produto.id_produto)
+        .where(SolicitacaoArquivada.id_solicitacao == id_solicitacao)
+    ).first()
+    if s is None:
+        return None, None
+    ids_ofertados = db.session.execute(
+        db.select(SolicitacaoProdutoOfertadoArquivado.id_produto)
+        .join(Produto, SolicitacaoProdutoOfertadoArquivado.id_produto == Produto.id_produto)
+        .where(SolicitacaoProdutoOfertadoArquivado.id_solicitacao == id_solicitacao)
+        .order_by(SolicitacaoProdutoOfertadoArquivado.id_produto)
+    ).scalars().all()
+    produtos, categorias = _produtos_por_id(
+        {s.id_produto_desejado, *ids_ofertados} - {None},
+        [SELECAO_COMPLETA.de('produto_desejado'), SELECAO_COMPLETA.de('produtos_ofertados_details')]
+    )
+    return _montar_negociacao(s, ids_ofertados, produtos, categorias, SELECAO_COMPLETA), s.id_dono
@@ -0,0 +1,118 @@
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import or_, and_
+
+# Paginação por cursor (keyset): em vez de OFFSET, o cliente devolve a posição
+# do último item recebido e a consulta continua a partir dela usando o índice.
+
+LIMITE_PADRAO = 24
+LIMITE_MAXIMO = 100
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def obter_limite(valor, padrao=LIMITE_PADRAO, maximo=LIMITE_MAXIMO, nome='limite'):
+    # Converte o parâmetro de limite (?limite=, ou ?<nome>=) respeitando o mínimo de 1 e o máximo permitido
+    if valor in (None, ''):
+        return padrao
+    try:
+        limite = int(valor)
+    except (TypeError, ValueError):
+        raise CursorInvalido(f"Parâmetro '{nome}' deve ser um número inteiro")
+    return max(1, min(limite, maximo))
+
+
+def obter_id(valor, nome):
+    # Cursores por ID (?after_id=, ?before_id=): None se ausente, CursorInvalido se malformado
+    if valor in (None, ''):
+        return None
+    try:
+        id_registro = int(valor)
+    except (TypeError, ValueError):
+        raise CursorInvalido(f"Parâmetro '{nome}' deve ser um número inteiro")
+    if id_registro < 0:
+        raise CursorInvalido(f"Parâmetro '{nome}' não pode ser negativo")
+    return id_registro
+
+
+def codificar_cursor(data, id_registro):
+    # Cursor opaco no formato "<data iso>|<id>" em base64 url-safe
+    bruto = f"{data.isoformat() if data else ''}|{id_registro}"
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        preenchido = cursor + '=' * (-len(cursor) % 4)
+        bruto = base64.urlsafe_b64decode(preenchido.encode('ascii')).decode('utf-8')
+        data_str, id_str = bruto.rsplit('|', 1)
+        data = datetime.fromisoformat(data_str) if data_str else None
+        return data, int(id_str)
+    except (ValueError, binascii.Error, UnicodeError):
+        raise CursorInvalido('Cursor de paginação inválido')
+
+
+def codificar_cursor_ranking(pontos, id_registro):
+    # Cursor para listas ordenadas por relevância: "<pontos>|<id>"
+    bruto = f"{pontos}|{id_registro}"
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor_ranking(cursor):
+    if not cursor:
+        return None
+    try:
+        preenchido = cursor + '=' * (-len(cursor) % 4)
+        bruto = base64.urlsafe_b64decode(preenchido.encode('ascii')).decode('utf-8')
+        pontos_str, id_str = bruto.rsplit('|', 1)
+        return int(pontos_str), int(id_str)
+    except (ValueError, binascii.Error, UnicodeError):
+        raise CursorInvalido('Cursor de paginação inválido')
+
+
+def codificar_cursor_proximidade(nivel, data, id_registro):
+    # Cursor para listas agrupadas por proximidade: "<nível>|<data iso>|<id>"
+    bruto = f"{nivel}|{data.isoformat() if data else ''}|{id_registro}"
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor_proximidade(cursor):
+    if not cursor:
+        return None
+    try:
+        preenchido = cursor + '=' * (-len(cursor) % 4)
+        bruto = base64.urlsafe_b64decode(preenchido.encode('ascii')).decode('utf-8')
+        nivel_str, data_str, id_str = bruto.split('|')
+        data = datetime.fromisoformat(data_str) if data_str else None
+        return int(nivel_str), data, int(id_str)
+    except (ValueError, binascii.Error, UnicodeError):
+        raise CursorInvalido('Cursor de paginação inválido')
+
+
+def aplicar_keyset_desc(query, coluna_data, coluna_id, cursor):
+    # Ordena do mais recente para o mais antigo, desempatando pelo ID,
+    # e posiciona a consulta logo após o item indicado pelo cursor.
+    posicao = decodificar_cursor(cursor)
+    if posicao:
+        data, id_registro = posicao
+        query = query.filter(or_(
+            coluna_data < data,
+            and_(coluna_data == data, coluna_id < id_registro)
+        ))
+    return query.order_by(coluna_data.desc(), coluna_id.desc())
+
+
+def paginar(query, limite, chave_cursor, codificar=codificar_cursor):
+    # Busca um item a mais para saber se existe próxima página sem precisar de COUNT
+    itens = query.limit(limite + 1).all()
+    proximo_cursor = None
+    if len(itens) > limite:
+        itens = itens[:limite]
+        proximo_cursor = codificar(*chave_cursor(itens[-1]))
+    return itens, proximo_cursor
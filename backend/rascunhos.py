@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from models import db, Solicitacao, SolicitacaoProdutoOfertado, Mensagem, StatusSolicitacao
+
+# Rascunhos de negociação. Abrir a tela de negociação de um produto (GET
+# /negociacao/<id_produto>) não grava mais uma solicitação PROCESSANDO: enquanto
+# o interessado só olha, a negociação é um rascunho montado na resposta, com
+# id_solicitacao nulo. A solicitação só é gravada na primeira mensagem (POST
+# /mensagem com id_produto_desejado) ou quando o pedido é enviado (POST
+# /solicitacao).
+#
+# O rascunho fica em memória, por processo, só para manter a mesma
+# data_solicitacao entre visitas; expira em RASCUNHOS_TTL_MINUTOS e o total é
+# limitado por RASCUNHOS_MAXIMO (os mais antigos saem primeiro). Perder um
+# rascunho (outro worker, reinício) não tem efeito além da data.
+#
+# O comando "flask limpar-rascunhos" (agendado no cron, uma única vez para
+# todos os processos) apaga em lotes as solicitações PROCESSANDO antigas e sem
+# mensagens, deixadas pela versão anterior ou abandonadas depois de abertas.
+
+
+class RascunhosNegociacao:
+    def __init__(self, app=None):
+        self.app = None
+        self._trava = threading.Lock()
+        self._rascunhos = OrderedDict()  # (id_usuario, id_produto) -> (data_solicitacao, expira_em)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('RASCUNHOS_TTL_MINUTOS', float(os.environ.get('RASCUNHOS_TTL_MINUTOS', 60)))
+        app.config.setdefault('RASCUNHOS_MAXIMO', int(os.environ.get('RASCUNHOS_MAXIMO', 10000)))
+        # Idade a partir da qual uma solicitação PROCESSANDO sem mensagens é apagada
+        app.config.setdefault('RASCUNHOS_PROCESSANDO_HORAS', float(os.environ.get('RASCUNHOS_PROCESSANDO_HORAS', 24)))
+        app.extensions['rascunhos_negociacao'] = self
+
+    def data_rascunho(self, id_usuario, id_produto):
+        # Data de criação do rascunho do usuário para o produto (criado agora se não existe)
+        agora = time.monotonic()
+        ttl = self.app.config['RASCUNHOS_TTL_MINUTOS'] * 60
+        chave = (id_usuario, id_produto)
+        with self._trava:
+            rascunho = self._rascunhos.pop(chave, None)
+            data = rascunho[0] if rascunho and rascunho[1] > agora else datetime.utcnow()
+            self._rascunhos[chave] = (data, agora + ttl)
+            self._remover_excedentes(agora)
+        return data
+
+    def descartar(self, id_usuario, id_produto):
+        with self._trava:
+            self._rascunhos.pop((id_usuario, id_produto), None)
+
+    def _remover_excedentes(self, agora):
+        # Chamado com a trava. A ordem do OrderedDict é a do último acesso.
+        maximo = self.app.config['RASCUNHOS_MAXIMO']
+        while self._rascunhos:
+            chave, (_, expira_em) = next(iter(self._rascunhos.items()))
+            if expira_em > agora and len(self._rascunhos) <= maximo:
+                break
+            del self._rascunhos[chave]
+
+
+def rascunho_para_dict(id_usuario, produto, data_solicitacao):
+    # Mesmo formato de Solicitacao.to_dict(include_produtos_details=True)
+    data = {
+        'id_solicitacao': None,
+        'status': StatusSolicitacao.PROCESSANDO.value,
+        'data_solicitacao': data_solicitacao.isoformat(),
+        'id_usuario_solicitante': id_usuario,
+        'id_produto_desejado': produto.id_produto,
+        'id_transacao': None,
+        'produtos_ofertados': [],
+        'produto_desejado': produto.to_dict(include_owner=True, include_imagens=True, include_categoria=True),
+        'produtos_ofertados_details': [],
+        'rascunho': True
+    }
+    if produto.categoria:
+        data['tipo_solicitacao'] = produto.categoria.nome_categoria
+    return data
+
+
+def limpar_solicitacoes_processando(horas, tamanho_lote=500):
+    # Apaga, em lotes, as solicitações PROCESSANDO criadas há mais de `horas` e
+    # sem nenhuma mensagem. As que têm conversa continuam como estão.
+    limite = datetime.utcnow() - timedelta(hours=horas)
+    abandonada = (
+        Solicitacao.status == StatusSolicitacao.PROCESSANDO,
+        ~db.exists().where(Mensagem.id_solicitacao == Solicitacao.id_solicitacao)
+    )
+    removidas = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Solicitacao.id_solicitacao)
+            .where(Solicitacao.data_solicitacao < limite, *abandonada)
+            .order_by(Solicitacao.id_solicitacao)
+            .limit(tamanho_lote)
+        ).scalars().all()
+        if not ids:
+            return removidas
+        # As condições são conferidas de novo em cada DELETE: uma mensagem ou
+        # ativação no meio tempo mantém a solicitação
+        ainda_abandonadas = db.select(Solicitacao.id_solicitacao).where(Solicitacao.id_solicitacao.in_(ids), *abandonada)
+        db.session.execute(
+            db.delete(SolicitacaoProdutoOfertado)
+            .where(SolicitacaoProdutoOfertado.id_solicitacao.in_(ainda_abandonadas))
+        )
+        resultado = db.session.execute(
+            db.delete(Solicitacao)
+            .where(Solicitacao.id_solicitacao.in_(ids), *abandonada)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        removidas += resultado.rowcount
@@ -0,0 +1,97 @@
+import random
+import time
+from functools import wraps
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from models import db
+from banco import CHAVE_REPLICA, CHAVE_NO_PRIMARIO, chaves_replicas
+
+# Leitura nas réplicas sem que o usuário deixe de ver o que acabou de gravar.
+#
+# Toda resposta de sucesso a um POST/PUT/PATCH/DELETE leva o cabeçalho
+# X-Ultima-Escrita com o instante da escrita; o cliente o reenvia nas
+# requisições seguintes (o frontend faz isso em js/config.js). Enquanto a
+# escrita tiver menos de REPLICA_JANELA_APOS_ESCRITA segundos, as leituras
+# daquele cliente ficam no primário; as dos demais vão para uma réplica
+# sorteada, sem nenhuma consulta extra para escolher. O atraso normal da
+# replicação afeta só quem gravou, e só durante a janela.
+#
+# Uma réplica que falha fica fora de uso por REPLICA_PAUSA_APOS_FALHA segundos.
+
+CABECALHO_ULTIMA_ESCRITA = 'X-Ultima-Escrita'
+METODOS_DE_ESCRITA = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+_indisponiveis = {}  # chave do bind -> instante até quando não deve ser usada
+
+
+def registrar_escritas(app):
+    app.after_request(_marcar_escrita)
+
+
+def _marcar_escrita(resposta):
+    if request.method in METODOS_DE_ESCRITA and resposta.status_code < 400:
+        resposta.headers[CABECALHO_ULTIMA_ESCRITA] = f'{time.time():.3f}'
+    return resposta
+
+
+def escreveu_recentemente():
+    try:
+        instante = float(request.headers.get(CABECALHO_ULTIMA_ESCRITA, ''))
+    except ValueError:
+        return False
+    return time.time() - instante < current_app.config['REPLICA_JANELA_APOS_ESCRITA']
+
+
+def _marcar_indisponivel(chave):
+    _indisponiveis[chave] = time.monotonic() + current_app.config['REPLICA_PAUSA_APOS_FALHA']
+
+
+@event.listens_for(Engine, 'handle_error')
+def _registrar_falha_da_replica(contexto):
+    if not contexto.is_disconnect or contexto.engine is None or not has_app_context():
+        return
+    for chave in chaves_replicas(current_app):
+        if db.engines[chave] is contexto.engine:
+            current_app.logger.warning(f"Réplica {chave} indisponível: {contexto.original_exception}")
+            _marcar_indisponivel(chave)
+
+
+def escolher_replica():
+    # Retorna (chave, engine) de uma réplica em uso, ou None para ler do primário
+    if escreveu_recentemente():
+        return None
+    agora = time.monotonic()
+    chaves = [chave for chave in chaves_replicas(current_app) if _indisponiveis.get(chave, 0) <= agora]
+    if not chaves:
+        return None
+    chave = random.choice(chaves)
+    return chave, db.engines[chave]
+
+
+def ler_da_replica(view):
+    # Decorator para rotas GET: as consultas da requisição vão para uma réplica,
+    # se houver. Usar acima de @com_etag, para que as versões do ETag venham do
+    # mesmo banco que os dados. Se a réplica cair no meio, a rota roda de novo
+    # no primário.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        escolhida = escolher_replica()
+        if escolhida is None:
+            return view(*args, **kwargs)
+        chave, engine = escolhida
+        db.session.info[CHAVE_REPLICA] = engine
+        try:
+            return view(*args, **kwargs)
+        except OperationalError as e:
+            if db.session.info.get(CHAVE_NO_PRIMARIO):
+                raise
+            current_app.logger.warning(f"Réplica {chave} indisponível: {e}")
+            _marcar_indisponivel(chave)
+            db.session.rollback()
+            db.session.info.pop(CHAVE_REPLICA, None)
+            return view(*args, **kwargs)
+    return wrapper
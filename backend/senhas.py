@@ -0,0 +1,97 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TempoEsgotado
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Hash de senhas fora das threads da API. PBKDF2 ocupa a CPU por dezenas de
+# milissegundos; em picos de cadastro/login isso travava os workers e as
+# listagens do catálogo ficavam na fila atrás. Aqui o cálculo roda em um pool
+# de processos de tamanho fixo, e o número de pedidos em andamento por processo
+# é limitado: quando o limite é atingido a rota responde 503 em vez de acumular.
+#
+# O custo é configurável (SENHAS_METODO, no formato do werkzeug, ex.
+# 'pbkdf2:sha256:600000' ou 'scrypt'). Senhas gravadas com outro custo são
+# recalculadas no próximo login bem-sucedido.
+
+
+class SenhasSobrecarregadas(Exception):
+    pass
+
+
+def _normalizar_metodo(metodo):
+    # Deixa o método no mesmo formato que o werkzeug grava no início do hash
+    partes = metodo.split(':')
+    if partes[0] == 'pbkdf2':
+        algoritmo = partes[1] if len(partes) > 1 else 'sha256'
+        iteracoes = partes[2] if len(partes) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{algoritmo}:{iteracoes}'
+    if partes[0] == 'scrypt' and len(partes) == 1:
+        return 'scrypt:32768:8:1'
+    return metodo
+
+
+def _gerar(senha, metodo):
+    return generate_password_hash(senha, method=metodo)
+
+
+def _verificar(hash_senha, senha, metodo):
+    # Executa no pool: confere a senha e, se o custo mudou, já devolve o novo hash
+    if not check_password_hash(hash_senha, senha):
+        return False, None
+    if hash_senha.split('$', 1)[0] != metodo:
+        return True, generate_password_hash(senha, method=metodo)
+    return True, None
+
+
+class HasherSenhas:
+    def __init__(self, app=None):
+        self.app = None
+        self._pool = None
+        self._trava_pool = threading.Lock()
+        self._vagas = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('SENHAS_METODO', os.environ.get('SENHAS_METODO', 'pbkdf2:sha256'))
+        app.config.setdefault('SENHAS_WORKERS', int(os.environ.get('SENHAS_WORKERS', 2)))
+        # Pedidos em andamento (na fila ou calculando) permitidos por processo da API
+        app.config.setdefault('SENHAS_FILA_MAXIMA', int(os.environ.get('SENHAS_FILA_MAXIMA', 16)))
+        # Quanto tempo esperar por uma vaga antes de responder 503
+        app.config.setdefault('SENHAS_ESPERA_MAXIMA', float(os.environ.get('SENHAS_ESPERA_MAXIMA', 2)))
+        self._vagas = threading.BoundedSemaphore(app.config['SENHAS_FILA_MAXIMA'])
+        app.extensions['hasher_senhas'] = self
+
+    @property
+    def metodo(self):
+        return _normalizar_metodo(self.app.config['SENHAS_METODO'])
+
+    def _obter_pool(self):
+        # O pool é criado no primeiro uso, já dentro do processo do worker
+        with self._trava_pool:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.app.config['SENHAS_WORKERS'])
+            return self._pool
+
+    def _executar(self, funcao, *args):
+        espera = self.app.config['SENHAS_ESPERA_MAXIMA']
+        if not self._vagas.acquire(timeout=espera):
+            raise SenhasSobrecarregadas()
+        try:
+            futuro = self._obter_pool().submit(funcao, *args)
+            # Limite generoso: a vaga já garante que a fila não cresce sem controle
+            return futuro.result(timeout=espera + 30)
+        except TempoEsgotado:
+            raise SenhasSobrecarregadas()
+        finally:
+            self._vagas.release()
+
+    def gerar_hash(self, senha):
+        return self._executar(_gerar, senha, self.metodo)
+
+    def verificar(self, hash_senha, senha):
+        # Retorna (senha_correta, novo_hash). novo_hash vem preenchido quando o
+        # hash gravado usa um custo diferente do configurado.
+        return self._executar(_verificar, hash_senha, senha, self.metodo)
@@ -0,0 +1,96 @@
+import decimal
+import enum
+import json
+import os
+import uuid
+from datetime import date, datetime, time
+
+from metricas import ProvedorJSONMedido
+
+try:
+    import orjson
+except ImportError:  # Opcional: sem ele o provedor usa o json da biblioteca padrão
+    orjson = None
+
+# Provedor JSON das respostas (jsonify). As listas de /produtos e
+# /usuario/negociacoes chegam a milhares de dicionários aninhados e o encoder
+# da biblioteca padrão era a maior parte do tempo fora do banco. Com o orjson
+# instalado a codificação é feita em C e a resposta é montada direto em bytes,
+# sem passar por str.
+#
+# JSON_CODIFICADOR escolhe o codificador:
+#   auto   orjson se estiver instalado, senão json (padrão)
+#   orjson exige o orjson
+#   json   biblioteca padrão
+#
+# Os dois codificadores tratam da mesma forma os tipos que aparecem nos modelos:
+#   datetime, date, time  ISO 8601 (igual ao isoformat() dos to_dict)
+#   Decimal               número (igual ao float() de Produto.to_dict)
+#   Enum                  o valor (StatusSolicitacao, StatusProduto)
+#   UUID                  texto
+# O JSON sai em UTF-8 sem escapes \uXXXX; as chaves continuam ordenadas
+# (app.json.sort_keys) e com indentação quando app.debug, como no provedor padrão.
+
+CODIFICADORES = ('auto', 'orjson', 'json')
+
+
+def _padrao(obj):
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f"Objeto do tipo {type(obj).__name__} não é serializável em JSON")
+
+
+class ProvedorJSONRapido(ProvedorJSONMedido):
+    ensure_ascii = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        app.config.setdefault('JSON_CODIFICADOR', os.environ.get('JSON_CODIFICADOR', 'auto'))
+        codificador = app.config['JSON_CODIFICADOR']
+        if codificador not in CODIFICADORES:
+            raise ValueError(f"JSON_CODIFICADOR inválido: {codificador!r}. Use {', '.join(CODIFICADORES)}.")
+        if codificador == 'orjson' and orjson is None:
+            raise RuntimeError("JSON_CODIFICADOR=orjson, mas o pacote orjson não está instalado")
+        self.usar_orjson = orjson is not None and codificador != 'json'
+
+    def _indentar(self):
+        return self.compact is False or (self.compact is None and self._app.debug)
+
+    def _codificar(self, obj, indentar):
+        # Bytes UTF-8 do JSON de obj
+        if self.usar_orjson:
+            opcoes = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                opcoes |= orjson.OPT_SORT_KEYS
+            if indentar:
+                opcoes |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=_padrao, option=opcoes)
+        return json.dumps(
+            obj, default=_padrao, ensure_ascii=False, sort_keys=self.sort_keys,
+            **({'indent': 2} if indentar else {'separators': (',', ':')})
+        ).encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        # Argumentos extras (cls, indent...) só existem no json da biblioteca padrão
+        if kwargs:
+            kwargs.setdefault('default', _padrao)
+            kwargs.setdefault('ensure_ascii', False)
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            with self._medindo():
+                return json.dumps(obj, **kwargs)
+        with self._medindo():
+            return self._codificar(obj, False).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        with self._medindo():
+            corpo = self._codificar(obj, self._indentar()) + b'\n'
+        return self._app.response_class(corpo, mimetype=self.mimetype)
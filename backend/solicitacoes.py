@@ -0,0 +1,179 @@
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Produto, Categoria, Solicitacao, SolicitacaoProdutoOfertado, StatusSolicitacao
+from disponibilidade import atualizar_disponibilidade
+
+# Validação e criação de solicitações em lote. Os produtos desejados e os
+# produtos ofertados são conferidos com uma consulta IN cada, independente de
+# quantos itens vierem; as linhas de SOLICITACAO_PRODUTO_OFERTADO entram com um
+# único INSERT em lote.
+#
+# As rotas criam as solicitações por estados_solicitacao.criar_pendentes(), que
+# trava os produtos desejados e confere, sob a trava, se o produto ainda existe,
+# se já foi aprovado para alguém e se o usuário já tem solicitação ativa para
+# ele, antes de chamar criar_solicitacoes().
+
+MAXIMO_SOLICITACOES_LOTE = 50
+
+
+class SolicitacaoInvalida(ValueError):
+    def __init__(self, msg, status=400, indice=None):
+        super().__init__(msg)
+        self.status = status
+        self.indice = indice  # posição do item com problema, nas requisições em lote
+
+
+class ItemSolicitacao:
+    __slots__ = ('id_produto_desejado', 'ids_ofertados')
+
+    def __init__(self, id_produto_desejado, ids_ofertados):
+        self.id_produto_desejado = id_produto_desejado
+        self.ids_ofertados = ids_ofertados
+
+
+def normalizar_ids_ofertados(valor):
+    # Aceita tanto int quanto lista; remove repetidos mantendo a ordem
+    if isinstance(valor, int):
+        valor = [valor]
+    if not isinstance(valor, list):
+        raise SolicitacaoInvalida('id_produto_ofertado deve ser uma lista de IDs')
+    ids = []
+    for id_produto in valor:
+        try:
+            id_produto = int(id_produto)
+        except (TypeError, ValueError):
+            raise SolicitacaoInvalida('ID do produto ofertado inválido.')
+        if id_produto not in ids:
+            ids.append(id_produto)
+    return ids
+
+
+def validar_produtos_ofertados(itens, id_usuario):
+    # Uma consulta para os produtos ofertados de todos os itens: existência, dono
+    # e se não é o próprio produto desejado.
+    todos = {id_produto for item in itens for id_produto in item.ids_ofertados}
+    if not todos:
+        return
+    donos = dict(db.session.execute(
+        db.select(Produto.id_produto, Produto.id_usuario).where(Produto.id_produto.in_(todos))
+    ).all())
+    for indice, item in enumerate(itens):
+        for id_produto in item.ids_ofertados:
+            if id_produto not in donos:
+                erro = SolicitacaoInvalida(f'Produto ofertado {id_produto} não encontrado', 404)
+            elif donos[id_produto] != id_usuario:
+                erro = SolicitacaoInvalida('Você só pode ofertar seus próprios produtos', 403)
+            elif id_produto == item.id_produto_desejado:
+                erro = SolicitacaoInvalida('Produto ofertado não pode ser o mesmo que o produto desejado')
+            else:
+                continue
+            erro.indice = indice
+            raise erro
+
+
+def preparar_solicitacoes(dados_itens, id_usuario):
+    # Valida os itens recebidos ({id_produto_desejado, id_produto_ofertado}) e
+    # devolve a lista de ItemSolicitacao, ou levanta SolicitacaoInvalida.
+    itens = []
+    for indice, dados in enumerate(dados_itens):
+        try:
+            if not isinstance(dados, dict) or 'id_produto_desejado' not in dados:
+                raise SolicitacaoInvalida('id_produto_desejado é obrigatório')
+            try:
+                id_desejado = int(dados['id_produto_desejado'])
+            except (TypeError, ValueError):
+                raise SolicitacaoInvalida('ID do produto desejado inválido.')
+            if any(item.id_produto_desejado == id_desejado for item in itens):
+                raise SolicitacaoInvalida('Produto desejado repetido na mesma requisição.', 409)
+            itens.append(ItemSolicitacao(id_desejado, dados.get('id_produto_ofertado') or []))
+        except SolicitacaoInvalida as e:
+            e.indice = indice
+            raise
+
+    ids_desejados = [item.id_produto_desejado for item in itens]
+    desejados = {
+        linha.id_produto: linha
+        for linha in db.session.execute(
+            db.select(Produto.id_produto, Produto.id_usuario, Categoria.nome_categoria)
+            .join(Categoria, Produto.id_categoria == Categoria.id_categoria)
+            .where(Produto.id_produto.in_(ids_desejados))
+        ).all()
+    }
+
+    for indice, item in enumerate(itens):
+        try:
+            desejado = desejados.get(item.id_produto_desejado)
+            if not desejado:
+                raise SolicitacaoInvalida('Produto desejado não encontrado', 404)
+            if desejado.id_usuario == id_usuario:
+                raise SolicitacaoInvalida('Você não pode solicitar seu próprio produto')
+            # O tipo da solicitação vem da categoria do produto desejado
+            if desejado.nome_categoria.upper() == 'TROCA':
+                if not item.ids_ofertados:
+                    raise SolicitacaoInvalida('id_produto_ofertado é obrigatório para solicitações de TROCA')
+                item.ids_ofertados = normalizar_ids_ofertados(item.ids_ofertados)
+            elif item.ids_ofertados:
+                raise SolicitacaoInvalida('id_produto_ofertado não deve ser enviado para solicitações de DOAÇÃO')
+        except SolicitacaoInvalida as e:
+            e.indice = indice
+            raise
+
+    validar_produtos_ofertados(itens, id_usuario)
+    return itens
+
+
+def inserir_produtos_ofertados(id_solicitacao, ids_ofertados):
+    # INSERT único para todas as linhas da tabela de relacionamento. Não faz commit.
+    if ids_ofertados:
+        db.session.execute(
+            insert(SolicitacaoProdutoOfertado),
+            [{'id_solicitacao': id_solicitacao, 'id_produto': id_produto} for id_produto in ids_ofertados]
+        )
+
+
+def criar_solicitacoes(itens, id_usuario):
+    # Cria as solicitações já validadas, sem travar nada (ver criar_pendentes). Não faz commit.
+    novas = [
+        Solicitacao(
+            id_usuario_solicitante=id_usuario,
+            id_produto_desejado=item.id_produto_desejado,
+            status=StatusSolicitacao.PENDENTE
+        )
+        for item in itens
+    ]
+    db.session.add_all(novas)
+    db.session.flush()  # Garante os IDs das solicitações
+
+    linhas = [
+        {'id_solicitacao': nova.id_solicitacao, 'id_produto': id_produto}
+        for nova, item in zip(novas, itens)
+        for id_produto in item.ids_ofertados
+    ]
+    if linhas:
+        db.session.execute(insert(SolicitacaoProdutoOfertado), linhas)
+
+    afetados = {item.id_produto_desejado for item in itens}
+    afetados.update(i for item in itens for i in item.ids_ofertados)
+    atualizar_disponibilidade(afetados)
+    return novas
+
+
+def solicitacoes_detalhadas(ids_solicitacoes):
+    # Carrega as solicitações com tudo o que to_dict(include_produtos_details=True)
+    # usa: solicitante, produto desejado, dono e categoria em um JOIN; imagens e
+    # ofertados (com dono e categoria) por selectin. Quatro consultas, para
+    # qualquer quantidade de solicitações.
+    def detalhes(relacao):
+        return relacao.options(joinedload(Produto.proprietario), joinedload(Produto.categoria), selectinload(Produto.imagens))
+    return db.session.execute(
+        db.select(Solicitacao)
+        .options(
+            joinedload(Solicitacao.usuario_solicitante_obj),
+            detalhes(joinedload(Solicitacao.produto_desejado_obj)),
+            detalhes(selectinload(Solicitacao.produtos_ofertados))
+        )
+        .where(Solicitacao.id_solicitacao.in_(ids_solicitacoes))
+        .order_by(Solicitacao.id_solicitacao)
+        .execution_options(populate_existing=True)
+    ).unique().scalars().all()
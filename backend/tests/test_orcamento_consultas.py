@@ -0,0 +1,18 @@
+# Orçamento de consultas (@orcamento_consultas) das rotas, contra o banco
+# temporário de benchmarks/ambiente.py populado com listas de vários itens.
+# As requisições e a contagem são as de benchmarks/orcamento_consultas.py.
+from benchmarks.orcamento_consultas import preparar, conferir
+
+QTD_ITENS = 20
+
+
+def test_rotas_dentro_do_orcamento():
+    falhas = []
+    for metodo, url, resposta, consultas, maximo, erro in conferir(*preparar(QTD_ITENS)):
+        if erro is not None:
+            falhas.append(str(erro))
+        elif maximo is None:
+            falhas.append(f'{metodo} {url} não declara @orcamento_consultas ({consultas} consultas)')
+        elif resposta.status_code >= 400:
+            falhas.append(f'{metodo} {url} respondeu {resposta.status_code}: {resposta.get_data(as_text=True)}')
+    assert not falhas, '\n\n'.join(falhas)
@@ -0,0 +1,131 @@
+import hashlib
+from functools import wraps
+
+from flask import current_app, request, make_response
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, VersaoTabela, RespostaIdempotente
+
+# Contador de alterações por tabela. Toda transação que altera uma tabela
+# incrementa o contador dela logo depois do commit; as rotas de leitura montam
+# o ETag a partir desses contadores e respondem 304 sem consultar os dados.
+#
+# O incremento roda em uma transação própria, curta, depois do commit dos
+# dados: a linha de VERSAO_TABELA fica travada só durante o UPDATE, em vez de
+# durante toda a transação de quem escreveu, e as escritas na mesma tabela não
+# ficam em fila umas das outras. Como o contador só muda depois que os dados
+# estão gravados, um ETag nunca corresponde a dados mais antigos que ele; se o
+# incremento falhar, o ETag da tabela só muda na próxima escrita nela.
+
+CHAVE_TABELAS_ALTERADAS = 'tabelas_alteradas'
+CHAVE_TABELAS_COMMIT = 'tabelas_no_commit'  # tabelas da transação em commit
+# Tabelas que nenhuma resposta com ETag lê
+TABELAS_SEM_VERSAO = {VersaoTabela.__tablename__, RespostaIdempotente.__tablename__}
+
+
+def _marcar_alterada(session, nome_tabela):
+    if nome_tabela in TABELAS_SEM_VERSAO:
+        return
+    session.info.setdefault(CHAVE_TABELAS_ALTERADAS, set()).add(nome_tabela)
+
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_alteracoes_do_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tabela = getattr(obj, '__table__', None)
+        if tabela is not None:
+            _marcar_alterada(session, tabela.name)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _registrar_alteracoes_em_lote(orm_execute_state):
+    # INSERT/UPDATE/DELETE em lote (db.update, Query.delete etc.) não passam pelo flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        tabela = getattr(orm_execute_state.statement, 'table', None)
+        if tabela is not None:
+            _marcar_alterada(orm_execute_state.session, tabela.name)
+
+
+@event.listens_for(Session, 'before_commit')
+def _separar_tabelas_do_commit(session):
+    if session.in_nested_transaction():
+        return  # SAVEPOINT (begin_nested): o commit de verdade ainda não aconteceu
+    session.flush()
+    tabelas = session.info.pop(CHAVE_TABELAS_ALTERADAS, None)
+    if tabelas:
+        session.info[CHAVE_TABELAS_COMMIT] = tabelas
+
+
+@event.listens_for(Session, 'after_commit')
+def _incrementar_versoes(session):
+    if session.in_nested_transaction():
+        return
+    tabelas = session.info.pop(CHAVE_TABELAS_COMMIT, None)
+    if not tabelas:
+        return
+    tabela_versao = VersaoTabela.__table__
+    try:
+        # Conexão própria do primário; a da sessão já foi devolvida ao pool
+        with db.engine.begin() as conexao:
+            for nome in sorted(tabelas):  # Ordem fixa para evitar deadlock entre transações
+                resultado = conexao.execute(
+                    tabela_versao.update()
+                    .where(tabela_versao.c.nome == nome)
+                    .values(versao=tabela_versao.c.versao + 1)
+                )
+                if resultado.rowcount == 0:
+                    conexao.execute(tabela_versao.insert().values(nome=nome, versao=1))
+    except Exception as e:
+        # Os dados já foram gravados; não transforma o commit em erro
+        current_app.logger.warning(f"Não foi possível atualizar as versões de {', '.join(sorted(tabelas))}: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_alteracoes(session):
+    session.info.pop(CHAVE_TABELAS_ALTERADAS, None)
+    session.info.pop(CHAVE_TABELAS_COMMIT, None)
+
+
+def obter_versoes(nomes_tabelas):
+    linhas = db.session.execute(
+        db.select(VersaoTabela.nome, VersaoTabela.versao)
+        .where(VersaoTabela.nome.in_(nomes_tabelas))
+    ).all()
+    versoes = {nome: 0 for nome in nomes_tabelas}
+    versoes.update({linha.nome: linha.versao for linha in linhas})
+    return versoes
+
+
+def com_etag(*nomes_tabelas):
+    # Decorator para rotas GET autenticadas. O ETag combina rota, parâmetros,
+    # usuário logado e as versões das tabelas que a resposta depende.
+    # As versões são lidas antes da rota executar; se algo mudar no meio, o
+    # cliente apenas recebe a resposta completa de novo na próxima requisição.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versoes = obter_versoes(nomes_tabelas)
+            base = '|'.join([
+                request.endpoint or '',
+                request.full_path,
+                str(get_jwt_identity()),
+                ','.join(f'{nome}:{versoes[nome]}' for nome in nomes_tabelas)
+            ])
+            etag = hashlib.sha1(base.encode('utf-8')).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                resposta = make_response('', 304)
+            else:
+                resposta = make_response(view(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta
+            # Fraco: identifica o conteúdo, não os bytes (a resposta pode sair
+            # comprimida ou não, ver compressao.py)
+            resposta.set_etag(etag, weak=True)
+            # O navegador pode guardar, mas precisa revalidar sempre (dados por usuário)
+            resposta.headers['Cache-Control'] = 'private, no-cache'
+            return resposta
+        return wrapper
+    return decorator
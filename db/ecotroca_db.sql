@@ -59,11 +59,13 @@ CREATE TABLE IF NOT EXISTS ecotroca.PRODUTO (
     data_cadastro DATE NOT NULL,
     quantidade INT NOT NULL,
     valor DECIMAL(10 , 2 ) NULL,
+    disponivel TINYINT(1) NOT NULL DEFAULT 1,
     id_usuario INT NOT NULL,
     id_categoria INT NOT NULL,
     PRIMARY KEY (id_produto),
     INDEX fk_PRODUTO_USUARIO_idx (id_usuario ASC),
     INDEX fk_PRODUTO_CATEGORIA_idx (id_categoria ASC),
+    INDEX idx_produto_disponivel_data (disponivel, data_cadastro, id_produto),
     CONSTRAINT fk_PRODUTO_USUARIO FOREIGN KEY (id_usuario)
         REFERENCES ecotroca.USUARIO (id_usuario)
         ON DELETE NO ACTION ON UPDATE NO ACTION,
@@ -80,6 +82,10 @@ CREATE TABLE IF NOT EXISTS ecotroca.IMAGEM (
     url_imagem VARCHAR(200) NOT NULL,
     descricao_imagem VARCHAR(100) NULL,
     id_produto INT NOT NULL,
+    url_thumb VARCHAR(200) NULL,
+    url_thumb_webp VARCHAR(200) NULL,
+    url_media VARCHAR(200) NULL,
+    url_media_webp VARCHAR(200) NULL,
     PRIMARY KEY (id_imagem),
     INDEX fk_IMAGEM_PRODUTO1_idx (id_produto ASC),
     CONSTRAINT fk_IMAGEM_PRODUTO1 FOREIGN KEY (id_produto)
@@ -132,7 +138,7 @@ CREATE TABLE IF NOT EXISTS ecotroca.MENSAGEM (
     id_solicitacao INT NOT NULL,
     PRIMARY KEY (id_mensagem),
     INDEX fk_MENSAGEM_USUARIO1_idx (id_usuario ASC),
-    INDEX fk_MENSAGEM_SOLICITACAO1_idx (id_solicitacao ASC),
+    INDEX idx_mensagem_solicitacao_id (id_solicitacao ASC, id_mensagem ASC),
     CONSTRAINT fk_MENSAGEM_USUARIO1 FOREIGN KEY (id_usuario)
         REFERENCES ecotroca.USUARIO (id_usuario)
         ON DELETE NO ACTION ON UPDATE NO ACTION,
@@ -156,9 +162,120 @@ CREATE TABLE IF NOT EXISTS ecotroca.SOLICITACAO_PRODUTO_OFERTADO (
         ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE=InnoDB;
 
+-- -----------------------------------------------------
+-- Table ecotroca.ARQUIVO (uploads endereçados pelo conteúdo)
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.ARQUIVO (
+    url_arquivo VARCHAR(200) NOT NULL,
+    referencias INT NOT NULL DEFAULT 0,
+    tamanho BIGINT NOT NULL,
+    data_cadastro DATETIME NOT NULL,
+    PRIMARY KEY (url_arquivo),
+    INDEX idx_arquivo_referencias (referencias)
+) ENGINE=InnoDB;
+
+-- -----------------------------------------------------
+-- Table ecotroca.PRODUTO_TERMO (índice de busca de produtos)
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.PRODUTO_TERMO (
+    termo VARCHAR(50) NOT NULL,
+    id_produto INT NOT NULL,
+    peso SMALLINT NOT NULL DEFAULT 1,
+    PRIMARY KEY (termo, id_produto),
+    INDEX fk_PRODUTO_TERMO_PRODUTO_idx (id_produto ASC),
+    CONSTRAINT fk_PRODUTO_TERMO_PRODUTO
+        FOREIGN KEY (id_produto) REFERENCES ecotroca.PRODUTO(id_produto)
+        ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB;
+
+-- -----------------------------------------------------
+-- Table ecotroca.PRODUTO_LOCALIDADE (índice da listagem "perto de mim")
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.PRODUTO_LOCALIDADE (
+    id_produto INT NOT NULL,
+    id_usuario INT NOT NULL,
+    cidade VARCHAR(80) NOT NULL,
+    estado VARCHAR(50) NOT NULL,
+    cep_prefixo VARCHAR(5) NOT NULL,
+    data_cadastro DATETIME NOT NULL,
+    PRIMARY KEY (id_produto),
+    INDEX idx_produto_localidade_cep (cep_prefixo, data_cadastro, id_produto),
+    INDEX idx_produto_localidade_cidade (estado, cidade, data_cadastro, id_produto),
+    INDEX idx_produto_localidade_data (data_cadastro, id_produto),
+    INDEX fk_PRODUTO_LOCALIDADE_USUARIO_idx (id_usuario ASC),
+    CONSTRAINT fk_PRODUTO_LOCALIDADE_PRODUTO
+        FOREIGN KEY (id_produto) REFERENCES ecotroca.PRODUTO(id_produto)
+        ON DELETE CASCADE ON UPDATE CASCADE,
+    CONSTRAINT fk_PRODUTO_LOCALIDADE_USUARIO
+        FOREIGN KEY (id_usuario) REFERENCES ecotroca.USUARIO(id_usuario)
+        ON DELETE NO ACTION ON UPDATE NO ACTION
+) ENGINE=InnoDB;
+
+-- -----------------------------------------------------
+-- Table ecotroca.VERSAO_TABELA (contadores usados nos ETags)
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.VERSAO_TABELA (
+    nome VARCHAR(64) NOT NULL,
+    versao BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (nome)
+) ENGINE=InnoDB;
+
+-- -----------------------------------------------------
+-- Table ecotroca.IDEMPOTENCIA (respostas guardadas por Idempotency-Key)
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.IDEMPOTENCIA (
+    chave CHAR(64) NOT NULL,
+    id_usuario INT NOT NULL,
+    impressao CHAR(64) NOT NULL,
+    status_http SMALLINT NULL,
+    tipo_conteudo VARCHAR(100) NULL,
+    corpo MEDIUMBLOB NULL,
+    data_expiracao DATETIME NOT NULL,
+    PRIMARY KEY (chave),
+    INDEX idx_idempotencia_expiracao (data_expiracao ASC)
+) ENGINE=InnoDB;
+
+-- -----------------------------------------------------
+-- Arquivo das negociações encerradas (RECUSADA/CANCELADA), sem chaves estrangeiras
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS ecotroca.SOLICITACAO_ARQUIVO (
+    id_solicitacao INT NOT NULL,
+    status ENUM('PROCESSANDO', 'PENDENTE', 'APROVADA', 'RECUSADA', 'CANCELADA') NOT NULL,
+    data_solicitacao DATETIME NOT NULL,
+    id_usuario_solicitante INT NOT NULL,
+    id_produto_desejado INT NULL,
+    id_transacao INT NULL,
+    data_arquivamento DATETIME NOT NULL,
+    PRIMARY KEY (id_solicitacao),
+    INDEX idx_solicitacao_arquivo_usuario (id_usuario_solicitante ASC),
+    INDEX idx_solicitacao_arquivo_produto (id_produto_desejado ASC)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS ecotroca.SOLICITACAO_PRODUTO_OFERTADO_ARQUIVO (
+    id_solicitacao INT NOT NULL,
+    id_produto INT NOT NULL,
+    PRIMARY KEY (id_solicitacao, id_produto)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS ecotroca.MENSAGEM_ARQUIVO (
+    id_mensagem INT NOT NULL,
+    conteudo_mensagem VARCHAR(500) NOT NULL,
+    data_envio DATETIME NOT NULL,
+    id_usuario INT NOT NULL,
+    id_solicitacao INT NOT NULL,
+    PRIMARY KEY (id_mensagem),
+    INDEX idx_mensagem_arquivo_solicitacao_id (id_solicitacao ASC, id_mensagem ASC)
+) ENGINE=InnoDB;
+
 -- -----------------------------------------------------
 -- Inserts iniciais
 -- -----------------------------------------------------
 INSERT INTO ecotroca.categoria (nome_categoria, descricao) VALUES
 ('TROCA', 'Produtos disponíveis para troca'),
-('DOAÇÃO', 'Produtos disponíveis para doação');
\ No newline at end of file
+('DOAÇÃO', 'Produtos disponíveis para doação');
+
+INSERT INTO ecotroca.VERSAO_TABELA (nome, versao) VALUES
+('PRODUTO', 0), ('IMAGEM', 0), ('CATEGORIA', 0), ('USUARIO', 0), ('ENDERECO_USUARIO', 0),
+('SOLICITACAO', 0), ('SOLICITACAO_PRODUTO_OFERTADO', 0), ('MENSAGEM', 0), ('TRANSACAO', 0),
+('PRODUTO_TERMO', 0), ('ARQUIVO', 0), ('PRODUTO_LOCALIDADE', 0), ('SOLICITACAO_ARQUIVO', 0),
+('SOLICITACAO_PRODUTO_OFERTADO_ARQUIVO', 0), ('MENSAGEM_ARQUIVO', 0);
@@ -133,7 +133,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                         }
                     }
 
-                    response = await fetch(`${CONFIG.API_BASE_URL}/produto`, {
+                    response = await fetchIdempotente(`${CONFIG.API_BASE_URL}/produto`, {
                         method: 'POST',
                         headers: {
                             'Authorization': 'Bearer ' + token
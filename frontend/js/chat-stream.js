@@ -0,0 +1,129 @@
+// Chat em tempo real: recebe as novas mensagens da negociação via Server-Sent Events
+let eventosChat = null;
+
+// Adiciona uma mensagem ao chat (ignora mensagens que já estão na tela)
+function adicionarMensagemChat(msg, noInicio = false) {
+    const chatMessages = document.getElementById('chat-messages');
+    if (!chatMessages || chatMessages.querySelector(`[data-id-mensagem="${msg.id_mensagem}"]`)) return;
+
+    const userId = localStorage.getItem('id_usuario');
+    const div = document.createElement('div');
+    div.dataset.idMensagem = msg.id_mensagem;
+    if (String(msg.id_usuario) === String(userId)) {
+        div.className = 'text-end mb-2';
+        div.innerHTML = `<span class="badge bg-primary">Você:</span> <span>${msg.conteudo_mensagem}</span>`;
+    } else {
+        const nomeRemetente = msg.nome_remetente || msg.nome_usuario || "Outro usuário";
+        div.className = 'text-start mb-2';
+        div.innerHTML = `<span class="badge bg-secondary">${nomeRemetente}:</span> <span>${msg.conteudo_mensagem}</span>`;
+    }
+    if (noInicio) {
+        // Mensagens antigas entram logo depois do botão "Carregar anteriores"
+        const botao = document.getElementById('carregar-mensagens-anteriores');
+        chatMessages.insertBefore(div, botao ? botao.nextSibling : chatMessages.firstChild);
+        return;
+    }
+    chatMessages.appendChild(div);
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+// A negociação traz só as últimas mensagens; o botão busca as anteriores sob demanda
+function configurarMensagensAnteriores(idSolicitacao, haAnteriores) {
+    const chatMessages = document.getElementById('chat-messages');
+    let botao = document.getElementById('carregar-mensagens-anteriores');
+    if (!haAnteriores) {
+        if (botao) botao.remove();
+        return;
+    }
+    if (!botao) {
+        botao = document.createElement('button');
+        botao.id = 'carregar-mensagens-anteriores';
+        botao.type = 'button';
+        botao.className = 'btn btn-link btn-sm d-block mx-auto mb-2';
+        botao.textContent = 'Carregar mensagens anteriores';
+        chatMessages.insertBefore(botao, chatMessages.firstChild);
+    }
+    botao.onclick = () => carregarMensagensAnteriores(idSolicitacao);
+}
+
+async function carregarMensagensAnteriores(idSolicitacao) {
+    const token = localStorage.getItem('access_token');
+    const primeira = document.querySelector('#chat-messages [data-id-mensagem]');
+    if (!token || !primeira) return;
+
+    try {
+        const resp = await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${idSolicitacao}/mensagens?before_id=${primeira.dataset.idMensagem}`, {
+            headers: { 'Authorization': 'Bearer ' + token }
+        });
+        if (!resp.ok) return;
+        const dados = await resp.json();
+        // Insere da mais nova para a mais antiga, sempre no topo
+        dados.mensagens.slice().reverse().forEach(msg => adicionarMensagemChat(msg, true));
+        configurarMensagensAnteriores(idSolicitacao, dados.tem_mais);
+    } catch (e) {
+        alert('Erro ao conectar ao servidor.');
+    }
+}
+
+// Abre (ou reabre) o stream de mensagens a partir da última mensagem já exibida.
+// O EventSource não envia cabeçalhos: antes de cada conexão o cliente pede um
+// token curto, válido só para os eventos desta negociação, em vez de pôr o JWT na URL
+let aberturaStreamChat = 0;
+
+async function iniciarStreamChat(idSolicitacao, ultimaMensagemId) {
+    const token = localStorage.getItem('access_token');
+    if (!token || !idSolicitacao || !window.EventSource) return;
+    if (eventosChat) eventosChat.close();
+    const abertura = ++aberturaStreamChat;
+
+    let tokenStream;
+    try {
+        const resp = await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${idSolicitacao}/eventos/token`, {
+            headers: { 'Authorization': 'Bearer ' + token }
+        });
+        if (!resp.ok) return;
+        tokenStream = (await resp.json()).token;
+    } catch (e) {
+        setTimeout(() => reabrirStreamChat(idSolicitacao), 5000);
+        return;
+    }
+    // Outra chamada abriu o stream enquanto o token era buscado
+    if (abertura !== aberturaStreamChat) return;
+
+    const params = new URLSearchParams({ token: tokenStream, apos_id: ultimaMensagemId || 0 });
+    const eventos = new EventSource(`${CONFIG.API_BASE_URL}/solicitacao/${idSolicitacao}/eventos?${params.toString()}`);
+    eventosChat = eventos;
+    let conectado = false;
+    eventos.onopen = () => { conectado = true; };
+    eventos.addEventListener('mensagem', event => {
+        adicionarMensagemChat(JSON.parse(event.data));
+    });
+    // A reconexão automática do navegador reusaria o token, que já expirou:
+    // fecha e reabre com um token novo. Se a conexão caiu depois de aberta (fim
+    // do tempo máximo do stream), reabre na hora; se o servidor recusou (ex.: 503
+    // por limite de conexões), espera alguns segundos
+    eventos.onerror = () => {
+        eventos.close();
+        if (eventosChat !== eventos) return;
+        setTimeout(() => reabrirStreamChat(idSolicitacao), conectado ? 0 : 5000);
+    };
+}
+
+async function reabrirStreamChat(idSolicitacao) {
+    const token = localStorage.getItem('access_token');
+    const mensagens = document.querySelectorAll('#chat-messages [data-id-mensagem]');
+    const ultima = mensagens.length ? mensagens[mensagens.length - 1].dataset.idMensagem : 0;
+    try {
+        const resp = await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${idSolicitacao}/mensagens?after_id=${ultima}`, {
+            headers: { 'Authorization': 'Bearer ' + token }
+        });
+        if (resp.ok) {
+            const dados = await resp.json();
+            dados.mensagens.forEach(msg => adicionarMensagemChat(msg));
+        }
+    } catch (e) {
+        // Sem conexão: tenta o stream mesmo assim
+    }
+    const exibidas = document.querySelectorAll('#chat-messages [data-id-mensagem]');
+    iniciarStreamChat(idSolicitacao, exibidas.length ? exibidas[exibidas.length - 1].dataset.idMensagem : ultima);
+}
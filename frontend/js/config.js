@@ -1,3 +1,43 @@
 const CONFIG = {
     API_BASE_URL: 'http://127.0.0.1:5000'
-};
\ No newline at end of file
+};
+
+// Leitura das próprias escritas: depois de gravar algo, a API devolve o cabeçalho
+// X-Ultima-Escrita; reenviado nas requisições seguintes, ele faz as leituras logo
+// após a escrita irem para o banco principal, e não para uma réplica atrasada.
+const fetchOriginal = window.fetch.bind(window);
+window.fetch = async (url, opcoes = {}) => {
+    const daApi = String(url).startsWith(CONFIG.API_BASE_URL);
+    const ultimaEscrita = daApi && localStorage.getItem('ultima_escrita');
+    if (ultimaEscrita) {
+        const headers = Object.assign({}, opcoes.headers, { 'X-Ultima-Escrita': ultimaEscrita });
+        opcoes = Object.assign({}, opcoes, { headers });
+    }
+    const response = await fetchOriginal(url, opcoes);
+    const escrita = daApi && response.headers.get('X-Ultima-Escrita');
+    if (escrita) localStorage.setItem('ultima_escrita', escrita);
+    return response;
+};
+
+// POST com Idempotency-Key: se a conexão cair, repete o envio com a mesma chave
+// e o servidor devolve a resposta da primeira tentativa em vez de gravar de novo.
+async function fetchIdempotente(url, opcoes, tentativas = 3) {
+    const chave = (window.crypto && crypto.randomUUID)
+        ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const headers = Object.assign({}, opcoes.headers, { 'Idempotency-Key': chave });
+    for (let tentativa = 1; ; tentativa++) {
+        try {
+            const response = await fetch(url, Object.assign({}, opcoes, { headers }));
+            // 409 com Retry-After: a primeira tentativa ainda está sendo processada
+            if (response.status === 409 && response.headers.get('Retry-After') && tentativa < tentativas) {
+                await new Promise(resolve => setTimeout(resolve, 1000 * tentativa));
+                continue;
+            }
+            return response;
+        } catch (erro) {
+            if (tentativa >= tentativas) throw erro;
+            await new Promise(resolve => setTimeout(resolve, 500 * tentativa));
+        }
+    }
+}
@@ -62,25 +62,17 @@ document.addEventListener('DOMContentLoaded', async () => {
         }
 
         // Preencher mensagens do chat
-        const chatMessages = document.getElementById('chat-messages');
-        chatMessages.innerHTML = '';
-        data.mensagens.forEach(msg => {
-            const div = document.createElement('div');
-            if (String(msg.id_usuario) === String(userId)) {
-                div.className = 'text-end mb-2';
-                div.innerHTML = `<span class="badge bg-primary">Você:</span> <span>${msg.conteudo_mensagem}</span>`;
-            } else {
-                const nomeRemetente = msg.nome_remetente || msg.nome_usuario || "Outro usuário";
-                div.className = 'text-start mb-2';
-                div.innerHTML = `<span class="badge bg-secondary">${nomeRemetente}:</span> <span>${msg.conteudo_mensagem}</span>`;
-            }
-            chatMessages.appendChild(div);
-        });
-        chatMessages.scrollTop = chatMessages.scrollHeight;
+        document.getElementById('chat-messages').innerHTML = '';
+        data.mensagens.forEach(adicionarMensagemChat);
 
         // Salva o id da solicitação para uso ao enviar mensagem
         window.idSolicitacaoAtual = data.solicitacao.id_solicitacao;
 
+        // Novas mensagens chegam pelo stream, sem recarregar a página
+        const ultimaMensagem = data.mensagens[data.mensagens.length - 1];
+        iniciarStreamChat(window.idSolicitacaoAtual, ultimaMensagem ? ultimaMensagem.id_mensagem : 0);
+        configurarMensagensAnteriores(window.idSolicitacaoAtual, data.mensagens_anteriores);
+
         // Botões de ação
         const btnContainer = document.querySelector('.text-center.mt-3');
         btnContainer.innerHTML = ''; // Limpa botões antigos
@@ -179,24 +171,34 @@ async function sendMessage() {
     const message = input.value.trim();
     if (!message) return;
     const token = localStorage.getItem('access_token');
-    if (!token || !window.idSolicitacaoAtual) return;
+    if (!token) return;
+
+    // Rascunho (negociação ainda não gravada): a primeira mensagem cria a solicitação
+    const corpo = { conteudo_mensagem: message };
+    if (window.idSolicitacaoAtual) {
+        corpo.id_solicitacao = window.idSolicitacaoAtual;
+    } else {
+        corpo.id_produto_desejado = getQueryParams().id;
+    }
 
     try {
-        const response = await fetch(`${CONFIG.API_BASE_URL}/mensagem`, {
+        const response = await fetchIdempotente(`${CONFIG.API_BASE_URL}/mensagem`, {
             method: 'POST',
             headers: {
                 'Authorization': 'Bearer ' + token,
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({
-                conteudo_mensagem: message,
-                id_solicitacao: window.idSolicitacaoAtual
-            })
+            body: JSON.stringify(corpo)
         });
         if (response.ok) {
-            // Recarrega as mensagens do chat
+            // A mensagem é exibida na hora; o stream ignora a repetição
             document.getElementById('chat-input').value = '';
-            document.dispatchEvent(new Event('DOMContentLoaded'));
+            const mensagem = await response.json();
+            if (!window.idSolicitacaoAtual) {
+                window.idSolicitacaoAtual = mensagem.id_solicitacao;
+                iniciarStreamChat(window.idSolicitacaoAtual, mensagem.id_mensagem);
+            }
+            adicionarMensagemChat(mensagem);
         } else {
             alert('Erro ao enviar mensagem.');
         }
@@ -208,16 +210,27 @@ async function sendMessage() {
 // Função para solicitar doação (ativar solicitação)
 async function finalizeDonation() {
     const token = localStorage.getItem('access_token');
-    if (!window.idSolicitacaoAtual || !token) return;
+    if (!token) return;
+    const headers = {
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'application/json'
+    };
     try {
-        const resp = await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${window.idSolicitacaoAtual}/pendente`, {
-            method: 'PUT',
-            headers: {
-                'Authorization': 'Bearer ' + token,
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({})
-        });
+        // Rascunho: cria a solicitação já PENDENTE; senão ativa a que foi gravada na primeira mensagem
+        const resp = window.idSolicitacaoAtual
+            ? await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${window.idSolicitacaoAtual}/pendente`, {
+                method: 'PUT',
+                headers,
+                body: JSON.stringify({})
+            })
+            : await fetchIdempotente(`${CONFIG.API_BASE_URL}/solicitacao`, {
+                method: 'POST',
+                headers,
+                body: JSON.stringify({
+                    id_produto_desejado: getQueryParams().id,
+                    tipo_solicitacao: 'DOAÇÃO'
+                })
+            });
         if (resp.ok) {
             alert('Solicitação realizada com sucesso!');
             // Atualize a tela ou recarregue os dados
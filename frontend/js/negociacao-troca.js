@@ -68,24 +68,16 @@ document.addEventListener('DOMContentLoaded', async () => {
     }
 
     // Preencher mensagens do chat (igual doação)
-    const chatMessages = document.getElementById('chat-messages');
-    chatMessages.innerHTML = '';
-    data.mensagens.forEach(msg => {
-        const div = document.createElement('div');
-        if (String(msg.id_usuario) === String(userId)) {
-            div.className = 'text-end mb-2';
-            div.innerHTML = `<span class="badge bg-primary">Você:</span> <span>${msg.conteudo_mensagem}</span>`;
-        } else {
-            const nomeRemetente = msg.nome_remetente || msg.nome_usuario || "Outro usuário";
-            div.className = 'text-start mb-2';
-            div.innerHTML = `<span class="badge bg-secondary">${nomeRemetente}:</span> <span>${msg.conteudo_mensagem}</span>`;
-        }
-        chatMessages.appendChild(div);
-    });
-    chatMessages.scrollTop = chatMessages.scrollHeight;
+    document.getElementById('chat-messages').innerHTML = '';
+    data.mensagens.forEach(adicionarMensagemChat);
 
     window.idSolicitacaoAtual = data.solicitacao.id_solicitacao;
 
+    // Novas mensagens chegam pelo stream, sem recarregar a página
+    const ultimaMensagem = data.mensagens[data.mensagens.length - 1];
+    iniciarStreamChat(window.idSolicitacaoAtual, ultimaMensagem ? ultimaMensagem.id_mensagem : 0);
+    configurarMensagensAnteriores(window.idSolicitacaoAtual, data.mensagens_anteriores);
+
     const isDono = String(produto.id_usuario) === String(userId);
 
     // Exibe o box de adicionar produtos só para quem NÃO é dono
@@ -324,17 +316,29 @@ async function finalizeTrade() {
         alert('Selecione ao menos um produto para ofertar na troca.');
         return;
     }
+    const headers = {
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'application/json'
+    };
     try {
-        const resp = await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${window.idSolicitacaoAtual}/pendente`, {
-            method: 'PUT',
-            headers: {
-                'Authorization': 'Bearer ' + token,
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                id_produto_ofertado: produtosOfertadosIds // Envia array
+        // Rascunho: cria a solicitação já PENDENTE; senão ativa a que foi gravada na primeira mensagem
+        const resp = window.idSolicitacaoAtual
+            ? await fetch(`${CONFIG.API_BASE_URL}/solicitacao/${window.idSolicitacaoAtual}/pendente`, {
+                method: 'PUT',
+                headers,
+                body: JSON.stringify({
+                    id_produto_ofertado: produtosOfertadosIds // Envia array
+                })
             })
-        });
+            : await fetchIdempotente(`${CONFIG.API_BASE_URL}/solicitacao`, {
+                method: 'POST',
+                headers,
+                body: JSON.stringify({
+                    id_produto_desejado: id,
+                    tipo_solicitacao: 'TROCA',
+                    id_produto_ofertado: produtosOfertadosIds
+                })
+            });
         if (resp.ok) {
             alert('Solicitação de troca realizada com sucesso!');
             window.location.reload();
@@ -353,23 +357,34 @@ async function sendMessage() {
     const message = input.value.trim();
     if (!message) return;
     const token = localStorage.getItem('access_token');
-    if (!token || !window.idSolicitacaoAtual) return;
+    if (!token) return;
+
+    // Rascunho (negociação ainda não gravada): a primeira mensagem cria a solicitação
+    const corpo = { conteudo_mensagem: message };
+    if (window.idSolicitacaoAtual) {
+        corpo.id_solicitacao = window.idSolicitacaoAtual;
+    } else {
+        corpo.id_produto_desejado = getQueryParams().id;
+    }
 
     try {
-        const response = await fetch(`${CONFIG.API_BASE_URL}/mensagem`, {
+        const response = await fetchIdempotente(`${CONFIG.API_BASE_URL}/mensagem`, {
             method: 'POST',
             headers: {
                 'Authorization': 'Bearer ' + token,
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({
-                conteudo_mensagem: message,
-                id_solicitacao: window.idSolicitacaoAtual
-            })
+            body: JSON.stringify(corpo)
         });
         if (response.ok) {
+            // A mensagem é exibida na hora; o stream ignora a repetição
             document.getElementById('chat-input').value = '';
-            document.dispatchEvent(new Event('DOMContentLoaded'));
+            const mensagem = await response.json();
+            if (!window.idSolicitacaoAtual) {
+                window.idSolicitacaoAtual = mensagem.id_solicitacao;
+                iniciarStreamChat(window.idSolicitacaoAtual, mensagem.id_mensagem);
+            }
+            adicionarMensagemChat(mensagem);
         } else {
             alert('Erro ao enviar mensagem.');
         }
@@ -12,33 +12,72 @@ document.addEventListener('DOMContentLoaded', async () => {
     const productList = document.getElementById('product-list');
     if (!token || !productList) return;
 
+    await carregarProdutos(true);
+});
+
+// Cursor da próxima página retornado pela API (null quando não há mais produtos)
+let proximoCursor = null;
+
+// Função para normalizar categoria
+function normalizarCategoria(nome) {
+    return nome
+        .toLowerCase()
+        .normalize('NFD')
+        .replace(/[\u0300-\u036f]/g, ''); // remove acentos
+}
+
+// Usa a miniatura (WebP quando o navegador suporta) e cai para o original se ainda não foi gerada
+function imagemCardHtml(img, classe) {
+    const base = CONFIG.API_BASE_URL.replace('/api', '');
+    const estilo = 'height: 200px; object-fit: cover;';
+    const imgTag = `<img src="${base}/${img.url_thumb || img.url_imagem}" class="${classe}" alt="Imagem do Produto" loading="lazy" style="${estilo}">`;
+    if (!img.url_thumb_webp) return imgTag;
+    return `<picture><source type="image/webp" srcset="${base}/${img.url_thumb_webp}">${imgTag}</picture>`;
+}
+
+async function carregarProdutos(reiniciar) {
+    const token = localStorage.getItem('access_token');
+    const productList = document.getElementById('product-list');
+    const btnCarregarMais = document.getElementById('carregar-mais');
+    if (!token || !productList) return;
+
+    const params = new URLSearchParams();
+    const categoriaFiltro = document.getElementById('filter-category').value;
+    const textoBusca = document.getElementById('search-name').value.trim();
+    const pertoFiltro = document.getElementById('filter-perto').value;
+    if (categoriaFiltro) params.set('categoria', categoriaFiltro);
+    if (textoBusca) params.set('q', textoBusca);
+    // A proximidade vale para a listagem geral (a busca continua ordenada por relevância)
+    if (pertoFiltro && !textoBusca) params.set('perto', pertoFiltro);
+    if (!reiniciar && proximoCursor) params.set('cursor', proximoCursor);
+
+    // Com texto digitado usa a busca (ordenada por relevância), senão a listagem geral
+    const endpoint = textoBusca ? '/produtos/busca' : '/produtos';
+
     try {
-        const response = await fetch(`${CONFIG.API_BASE_URL}/produtos`, {
+        const response = await fetch(`${CONFIG.API_BASE_URL}${endpoint}?${params.toString()}`, {
             headers: {
                 'Authorization': 'Bearer ' + token
             }
         });
-        const produtos = await response.json();
+        const dados = await response.json();
 
         if (!response.ok) {
-            productList.innerHTML = `<div class="alert alert-danger">${produtos.msg || 'Erro ao carregar produtos.'}</div>`;
+            productList.innerHTML = `<div class="alert alert-danger">${dados.msg || 'Erro ao carregar produtos.'}</div>`;
             return;
         }
 
-        if (!produtos.length) {
+        const produtos = dados.produtos;
+        proximoCursor = dados.next_cursor;
+        if (btnCarregarMais) btnCarregarMais.classList.toggle('d-none', !proximoCursor);
+
+        if (reiniciar) productList.innerHTML = '';
+
+        if (reiniciar && !produtos.length) {
             productList.innerHTML = '<div class="alert alert-info">Nenhum produto disponível no momento.</div>';
             return;
         }
 
-        productList.innerHTML = '';
-        // Função para normalizar categoria
-        function normalizarCategoria(nome) {
-            return nome
-                .toLowerCase()
-                .normalize('NFD')
-                .replace(/[\u0300-\u036f]/g, ''); // remove acentos
-        }
-
         produtos.forEach((produto, idx) => {
             // Imagens
             let imagensHtml = '';
@@ -51,7 +90,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                         <div class="carousel-inner">
                             ${produto.imagens.map((img, i) => `
                                 <div class="carousel-item${i === 0 ? ' active' : ''}">
-                                    <img src="${CONFIG.API_BASE_URL.replace('/api', '')}/${img.url_imagem}" class="d-block w-100 img-fluid" alt="Imagem do Produto" style="height: 200px; object-fit: cover;">
+                                    ${imagemCardHtml(img, 'd-block w-100 img-fluid')}
                                 </div>
                             `).join('')}
                         </div>
@@ -66,7 +105,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     </div>
                     `;
                 } else {
-                    imagensHtml = `<img src="${CONFIG.API_BASE_URL.replace('/api', '')}/${produto.imagens[0].url_imagem}" class="card-img-top img-fluid" alt="Produto" style="height: 200px; object-fit: cover;">`;
+                    imagensHtml = imagemCardHtml(produto.imagens[0], 'card-img-top img-fluid');
                 }
             } else {
                 imagensHtml = `<img src="../assets/placeholder.png" class="card-img-top img-fluid" alt="Produto" style="height: 200px; object-fit: cover;">`;
@@ -103,24 +142,30 @@ document.addEventListener('DOMContentLoaded', async () => {
     } catch (error) {
         productList.innerHTML = `<div class="alert alert-danger">Erro ao conectar ao servidor.</div>`;
     }
-});
+}
 
+// A busca é feita pela API; espera o usuário parar de digitar antes de consultar
+let timeoutBusca = null;
 document.getElementById('search-name').addEventListener('input', function () {
-    const searchValue = this.value.toLowerCase();
-    const products = document.querySelectorAll('#product-list .col-md-4');
-    products.forEach(product => {
-        const title = product.querySelector('.card-title').textContent.toLowerCase();
-        product.style.display = title.includes(searchValue) ? '' : 'none';
-    });
+    clearTimeout(timeoutBusca);
+    const texto = this.value.trim();
+    // A API só aceita termos com 2 ou mais letras
+    if (texto.length === 1) return;
+    timeoutBusca = setTimeout(() => carregarProdutos(true), 300);
 });
 
+// O filtro de categoria é aplicado pela API, recarregando a lista desde a primeira página
 document.getElementById('filter-category').addEventListener('change', function () {
-    const filterValue = this.value;
-    const products = document.querySelectorAll('#product-list .col-md-4');
-    products.forEach(product => {
-        const category = product.getAttribute('data-category');
-        product.style.display = filterValue === '' || category === filterValue ? '' : 'none';
-    });
+    carregarProdutos(true);
+});
+
+// Ordena pela proximidade do endereço do usuário (índice de localidade da API)
+document.getElementById('filter-perto').addEventListener('change', function () {
+    carregarProdutos(true);
+});
+
+document.getElementById('carregar-mais').addEventListener('click', function () {
+    carregarProdutos(false);
 });
 
 document.querySelector('#logout').addEventListener('click', function () {